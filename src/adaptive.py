@@ -0,0 +1,318 @@
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import sys
+
+import numpy as np
+
+from checkpoint import install_signal_handlers
+from dose_response import load_responses
+from manifest import get_results_file
+from registry import load_registry
+from simulation import get_condition_key, make_condition
+from sweep import run_sweep
+
+logger = logging.getLogger(__name__)
+
+# default sampled region, (lowest, highest) positive concentration per axis
+DEFAULT_AXES = {
+    'meki': (1e-3, 10.0),
+    'rafi': (1e-3, 10.0),
+    'egf': (1e-3, 1.0),
+}
+
+
+class AdaptiveGrid:
+    """Dyadic cells over log-concentration axes.
+
+    Points are integer index tuples on the finest lattice of max_level
+    subdivisions, so points shared by neighbouring cells are simulated once.
+    With include_zero, index 0 of every axis is the untreated condition
+    instead of the lowest concentration.
+    """
+
+    def __init__(self, axes, max_level, include_zero=True):
+        self.names = list(axes)
+        self.log_bounds = np.log10([axes[name] for name in self.names])
+        self.max_level = max_level
+        self.size = 2 ** max_level
+        self.include_zero = include_zero
+        self.corner_offsets = list(itertools.product((0, 1),
+                                                     repeat=len(self.names)))
+
+    def to_concentrations(self, point):
+        index = np.asarray(point, dtype=float)
+        low, high = self.log_bounds[:, 0], self.log_bounds[:, 1]
+        values = 10 ** (low + (high - low) * index / self.size)
+        if self.include_zero:
+            values[index == 0] = 0.0
+        return dict(zip(self.names, values))
+
+    def cell_width(self, level):
+        return self.size >> level
+
+    def corners(self, cell):
+        level, origin = cell
+        width = self.cell_width(level)
+        return [tuple(o + width * b for o, b in zip(origin, bits))
+                for bits in self.corner_offsets]
+
+    def center(self, cell):
+        level, origin = cell
+        half = self.cell_width(level) // 2
+        return tuple(o + half for o in origin)
+
+    def children(self, cell):
+        level, origin = cell
+        half = self.cell_width(level) // 2
+        return [(level + 1, tuple(o + half * b for o, b in zip(origin, bits)))
+                for bits in self.corner_offsets]
+
+    def can_split(self, cell):
+        return cell[0] < self.max_level
+
+    def cell_points(self, cell):
+        """Points needed to evaluate a cell: corners and, if it can be split,
+        the centre used for its error estimate."""
+        points = self.corners(cell)
+        if self.can_split(cell):
+            points.append(self.center(cell))
+        return points
+
+    def initial_cells(self, level):
+        width = self.cell_width(level)
+        starts = range(0, self.size, width)
+        return [(level, origin)
+                for origin in itertools.product(starts, repeat=len(self.names))]
+
+
+def cell_error(grid, cell, values):
+    """Deviation of the centre from the multilinear interpolation of the
+    corners, which at the centre is the mean of the corner values."""
+    corners = [values[p] for p in grid.corners(cell)]
+    return abs(values[grid.center(cell)] - np.mean(corners))
+
+
+def run_adaptive(store_dir, cell_line, axes=None, fixed=None,
+                 observable='pERK', feature='steady_state', tolerance=0.02,
+                 max_simulations=500, initial_level=1, max_level=6,
+                 include_zero=True, processes=1):
+    """Sample a response surface with recursive refinement.
+
+    Starts from a coarse grid of cells over the axes (MEKi, RAFi and EGF by
+    default), estimates the interpolation error of every cell from its
+    centre and splits cells whose error, relative to the response range,
+    exceeds tolerance. Cells are split in order of decreasing error until no
+    cell exceeds the tolerance or the simulation budget is spent. Conditions
+    are simulated in batches through the sweep into the store, so reruns and
+    other analyses reuse them. Returns the sample file, or None if the sweep
+    was stopped by a signal (rerun to resume).
+    """
+    if axes is None:
+        axes = DEFAULT_AXES
+    fixed = dict(fixed or {})
+    grid = AdaptiveGrid(axes, max_level, include_zero)
+    overlap = set(fixed).intersection(grid.names)
+    if overlap:
+        raise ValueError(f"{', '.join(sorted(overlap))} cannot be both a "
+                         f"sampled axis and fixed")
+    values = {}
+
+    def evaluate(points):
+        points = [p for p in dict.fromkeys(points) if p not in values]
+        if not points:
+            return True
+        conditions = [
+            make_condition(cell_line, **{
+                'meki': 0.0, 'egf': 0.0, 'rafi': 0.0, 'prafi': 0.0,
+                **fixed, **grid.to_concentrations(p)
+            })
+            for p in points
+        ]
+        if processes > 1:
+            from distributed import run_local
+            finished = run_local(conditions, store_dir, processes)
+        else:
+            finished = run_sweep(conditions, store_dir)
+        if not finished:
+            return False
+        # conditions where all integrators failed have no results file
+        done = [os.path.exists(get_results_file(store_dir,
+                                                get_condition_key(c)))
+                for c in conditions]
+        responses = load_responses(
+            store_dir, [c for c, ok in zip(conditions, done) if ok],
+            observable, feature
+        )
+        responses = iter(responses)
+        for point, ok in zip(points, done):
+            values[point] = next(responses) if ok else np.nan
+        return True
+
+    cells = grid.initial_cells(initial_level)
+    if not evaluate([p for cell in cells for p in grid.cell_points(cell)]):
+        return None
+
+    leaves = set(cells)
+    while True:
+        response_range = np.nanmax(list(values.values())) \
+            - np.nanmin(list(values.values()))
+        scale = response_range if response_range > 0 else 1.0
+        queue = []
+        for cell in leaves:
+            if grid.can_split(cell):
+                error = cell_error(grid, cell, values) / scale
+                if error > tolerance:
+                    heapq.heappush(queue, (-error, cell))
+        if not queue:
+            logger.info(f"All cells within tolerance {tolerance}")
+            break
+
+        # split the worst cells that fit into the remaining budget
+        new_points = set()
+        split = []
+        while queue:
+            _, cell = heapq.heappop(queue)
+            points = {p for child in grid.children(cell)
+                      for p in grid.cell_points(child) if p not in values}
+            if len(values) + len(new_points | points) > max_simulations:
+                continue
+            new_points |= points
+            split.append(cell)
+        if not split:
+            logger.info(f"Simulation budget of {max_simulations} reached")
+            break
+        logger.info(f"Splitting {len(split)} cells, "
+                    f"{len(new_points)} new conditions")
+        if not evaluate(sorted(new_points)):
+            return None
+        for cell in split:
+            leaves.remove(cell)
+            leaves.update(grid.children(cell))
+
+    return save_samples(store_dir, cell_line, grid, values, leaves, fixed,
+                        observable, feature)
+
+
+def get_adaptive_file(store_dir, cell_line):
+    return os.path.join(store_dir, 'adaptive', f'{cell_line}.h5')
+
+
+def save_samples(store_dir, cell_line, grid, values, leaves, fixed,
+                 observable, feature):
+    """Store the sampled points and the final cells next to the results."""
+    import h5py
+
+    points = sorted(values)
+    output_file = get_adaptive_file(store_dir, cell_line)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('points', data=np.array(points, dtype='i4'))
+        f.create_dataset('responses',
+                         data=np.array([values[p] for p in points]))
+        for name in grid.names:
+            f.create_dataset(f'{name}_concentration', data=np.array(
+                [grid.to_concentrations(p)[name] for p in points]
+            ))
+        leaves = sorted(leaves)
+        f.create_dataset('cell_level',
+                         data=np.array([c[0] for c in leaves], dtype='i4'))
+        f.create_dataset('cell_origin',
+                         data=np.array([c[1] for c in leaves], dtype='i4'))
+        f.attrs['axes'] = grid.names
+        f.attrs['log_bounds'] = grid.log_bounds
+        f.attrs['max_level'] = grid.max_level
+        f.attrs['include_zero'] = grid.include_zero
+        f.attrs['cell_line'] = cell_line
+        f.attrs['observable'] = observable
+        f.attrs['feature'] = feature
+        for name, value in fixed.items():
+            f.attrs[f'{name}_concentration'] = value
+    os.replace(tmp_file, output_file)
+    logger.info(f"Sampled {len(points)} conditions in {len(leaves)} cells, "
+                f"saved to {output_file}")
+    return output_file
+
+
+def interpolate_samples(sample_file, concentrations):
+    """Multilinear interpolation of an adaptive sample at new concentrations.
+
+    concentrations has shape (points, axes) in the axis order of the sample.
+    Every point is interpolated within the finest cell containing it.
+    """
+    import h5py
+
+    with h5py.File(sample_file, 'r') as f:
+        points = [tuple(p) for p in f['points'][:]]
+        responses = f['responses'][:]
+        levels = f['cell_level'][:]
+        origins = f['cell_origin'][:]
+        log_bounds = f.attrs['log_bounds']
+        size = 2 ** int(f.attrs['max_level'])
+        include_zero = bool(f.attrs['include_zero'])
+    values = dict(zip(points, responses))
+
+    # concentrations -> continuous lattice coordinates
+    concentrations = np.asarray(concentrations, dtype=float)
+    low, high = log_bounds[:, 0], log_bounds[:, 1]
+    with np.errstate(divide='ignore'):
+        logs = np.log10(concentrations)
+    if include_zero:
+        logs = np.where(concentrations > 0, logs, low)
+    coords = np.clip((logs - low) / (high - low), 0, 1) * size
+
+    result = np.full(len(coords), np.nan)
+    n_axes = coords.shape[1]
+    offsets = np.array(list(itertools.product((0, 1), repeat=n_axes)))
+    for level, origin in zip(levels, origins):
+        width = size >> int(level)
+        inside = np.all((coords >= origin) & (coords <= origin + width),
+                        axis=1) & np.isnan(result)
+        if not np.any(inside):
+            continue
+        fraction = (coords[inside] - origin) / width
+        corner_values = np.array([values[tuple(origin + width * b)]
+                                  for b in offsets])
+        weights = np.prod(np.where(offsets[None], fraction[:, None],
+                                   1 - fraction[:, None]), axis=2)
+        result[inside] = weights @ corner_values
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Adaptively sample a MEKi x RAFi x EGF response surface'
+    )
+    parser.add_argument('--store', type=str, default='results/sweep')
+    parser.add_argument('--cell-line', choices=list(load_registry().cell_lines),
+                        default='mutant')
+    for name, (low, high) in DEFAULT_AXES.items():
+        parser.add_argument(f'--{name}-range', nargs=2, type=float,
+                            default=[low, high], metavar=('LOW', 'HIGH'))
+    parser.add_argument('--prafi', type=float, default=0.0)
+    parser.add_argument('--observable', type=str, default='pERK')
+    parser.add_argument('--feature', type=str, default='steady_state')
+    parser.add_argument('--tolerance', type=float, default=0.02,
+                        help='Maximal interpolation error of a cell relative '
+                             'to the response range')
+    parser.add_argument('--max-simulations', type=int, default=500)
+    parser.add_argument('--initial-level', type=int, default=1)
+    parser.add_argument('--max-level', type=int, default=6)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    install_signal_handlers()
+    axes = {name: tuple(getattr(args, f'{name}_range'))
+            for name in DEFAULT_AXES}
+    if run_adaptive(args.store, args.cell_line, axes,
+                    fixed={'prafi': args.prafi}, observable=args.observable,
+                    feature=args.feature, tolerance=args.tolerance,
+                    max_simulations=args.max_simulations,
+                    initial_level=args.initial_level,
+                    max_level=args.max_level,
+                    processes=args.processes) is None:
+        sys.exit(1)
@@ -0,0 +1,501 @@
+"""Batched simulation of many conditions in lockstep.
+
+The reaction network is translated once into Python source for a RHS,
+Jacobian and initial values that operate on (batch, species) arrays, either
+as NumPy array expressions or as a Numba kernel parallelized over the batch.
+A Rosenbrock integrator advances all conditions of a batch together, so
+Python overhead is paid once per step for the whole batch instead of once per
+condition.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from manifest import compute_run_hash, get_results_file, is_complete, \
+    mark_done, mark_running
+from model_cache import (expand_expression, hash_model_source, load_model,
+                         normalize_modifications)
+from paths import get_model_batched_dir
+from registry import load_registry
+from simulation import INTEGRATOR_OPTIONS, MODEL_NAME, MODEL_VARIANT, \
+    get_condition_key, get_tspan, save_results
+from solver_health import check_health, get_conservation_matrix
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['numpy', 'numba']
+# bump when the generated source changes
+CODEGEN_FORMAT = 1
+
+INTEGRATOR = 'batched_ros23'
+BATCHED_OPTIONS = {
+    'rtol': INTEGRATOR_OPTIONS['rtol'],
+    'atol': INTEGRATOR_OPTIONS['atol'],
+    'max_steps': 100000,
+}
+# conditions integrated together, bounds the (batch, species, species)
+# Jacobian and iteration matrix
+DEFAULT_CHUNK_SIZE = 128
+
+# Rosenbrock 2(3) coefficients of Shampine & Reichelt (MATLAB ode23s)
+ROS_D = 1 / (2 + np.sqrt(2))
+ROS_E32 = 6 + np.sqrt(2)
+
+
+def _import_numba():
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+def default_backend():
+    return 'numba' if _import_numba() is not None else 'numpy'
+
+
+def _terms(coefficients):
+    """Source of a sum of coefficient * name for (name, coefficient) pairs."""
+    parts = []
+    for name, coefficient in coefficients:
+        if coefficient == 1:
+            parts.append(f'+ {name}')
+        elif coefficient == -1:
+            parts.append(f'- {name}')
+        else:
+            parts.append(f'+ {float(coefficient)!r}*{name}')
+    source = ' '.join(parts)
+    return source[2:] if source.startswith('+ ') else '-' + source[2:]
+
+
+def _loads(expressions, idx):
+    """Assignments of the species and parameters used by expressions."""
+    names = set()
+    for expression in expressions:
+        names.update(str(s) for s in expression.free_symbols)
+    lines = []
+    for prefix in ['x', 'p']:
+        indices = sorted(int(name[1:]) for name in names
+                         if name[0] == prefix and name[1:].isdigit())
+        lines += [f'{prefix}{i} = {prefix}[{idx}, {i}]' for i in indices]
+    return lines
+
+
+def _function(name, arguments, body, backend):
+    """Source of a generated function that writes into out."""
+    if backend == 'numba':
+        lines = ['@numba.njit(parallel=True, cache=True)',
+                 f'def {name}({arguments}, out):',
+                 '    out[:] = 0.0']
+        body_lines = body('b')
+        if body_lines:
+            lines.append('    for b in numba.prange(out.shape[0]):')
+            lines += [f'        {line}' for line in body_lines]
+    else:
+        lines = [f'def {name}({arguments}, out):',
+                 '    out[:] = 0.0']
+        lines += [f'    {line}' for line in body(':')]
+    lines.append('    return out')
+    return '\n'.join(lines)
+
+
+def generate_source(model, backend='numpy'):
+    """Python source of rhs(x, p, out), jacobian(x, p, out) and
+    initials(p, out) of a network.
+
+    x has shape (batch, species) and p (batch, parameters) in the order of
+    model.parameters, so every condition of a batch may use its own
+    parameter values. Rows of fixed species are zero.
+    """
+    import sympy
+    try:
+        from sympy.printing.numpy import NumPyPrinter
+    except ImportError:
+        from sympy.printing.pycode import NumPyPrinter
+
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}')
+    printer = NumPyPrinter()
+    symbols = {sympy.Symbol(f'__s{i}'): sympy.Symbol(f'x{i}')
+               for i in range(len(model.species))}
+    symbols.update({parameter: sympy.Symbol(f'p{j}')
+                    for j, parameter in enumerate(model.parameters)})
+    species = [sympy.Symbol(f'x{i}') for i in range(len(model.species))]
+
+    rates = [expand_expression(model, r['rate']).xreplace(symbols)
+             for r in model.reactions]
+    fixed = set()
+    initials = {}
+    for initial in model.initials:
+        index = model.get_species_index(initial.pattern)
+        initials[index] = expand_expression(
+            model, sympy.sympify(initial.value)
+        ).xreplace(symbols)
+        if initial.fixed:
+            fixed.add(index)
+
+    # species rows of the stoichiometry as (rate index, coefficient)
+    rows = {i: {} for i in range(len(model.species)) if i not in fixed}
+    for r, reaction in enumerate(model.reactions):
+        for i in reaction['reactants']:
+            if i in rows:
+                rows[i][r] = rows[i].get(r, 0) - 1
+        for i in reaction['products']:
+            if i in rows:
+                rows[i][r] = rows[i].get(r, 0) + 1
+
+    derivatives = []
+    entries = {}
+    for r, rate in enumerate(rates):
+        for j, symbol in enumerate(species):
+            if symbol not in rate.free_symbols:
+                continue
+            k = len(derivatives)
+            derivatives.append(sympy.diff(rate, symbol))
+            for i, row in rows.items():
+                if row.get(r):
+                    entries.setdefault((i, j), []).append((f'd{k}', row[r]))
+
+    def rhs_body(idx):
+        lines = _loads(rates, idx)
+        lines += [f'v{r} = {printer.doprint(rate)}'
+                  for r, rate in enumerate(rates)]
+        lines += [
+            f'out[{idx}, {i}] = '
+            + _terms([(f'v{r}', c) for r, c in sorted(row.items()) if c])
+            for i, row in rows.items() if any(row.values())
+        ]
+        return lines
+
+    def jacobian_body(idx):
+        lines = _loads(derivatives, idx)
+        lines += [f'd{k} = {printer.doprint(derivative)}'
+                  for k, derivative in enumerate(derivatives)]
+        lines += [f'out[{idx}, {i}, {j}] = {_terms(terms)}'
+                  for (i, j), terms in sorted(entries.items())]
+        return lines
+
+    def initials_body(idx):
+        values = [initials[i] for i in sorted(initials)]
+        lines = _loads(values, idx)
+        lines += [f'out[{idx}, {i}] = {printer.doprint(initials[i])}'
+                  for i in sorted(initials)]
+        return lines
+
+    header = [
+        f'"""Batched RHS of {model.name}, generated by batched.py."""',
+        'import numpy',
+    ]
+    if backend == 'numba':
+        header.append('import numba')
+    header += [
+        '',
+        f'PARAMETERS = {[p.name for p in model.parameters]!r}',
+        f'N_SPECIES = {len(model.species)}',
+    ]
+    return '\n\n\n'.join([
+        '\n'.join(header),
+        _function('rhs', 'x, p', rhs_body, backend),
+        _function('jacobian', 'x, p', jacobian_body, backend),
+        _function('initials', 'p', initials_body, backend),
+    ]) + '\n'
+
+
+def _import_source(source_file):
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    spec = importlib.util.spec_from_file_location(name, source_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BatchedModel:
+    """Generated batched RHS, Jacobian and initial values of a network.
+
+    The source is written to build_dir and imported from there, so Numba
+    can cache its compiled kernels next to it. With model_hash the file is
+    looked up before any symbolic work, which makes reloading a known
+    network cheap; otherwise it is keyed by the hash of the source.
+    """
+
+    def __init__(self, model, backend=None, build_dir=None, model_hash=None):
+        backend = backend or default_backend()
+        if backend == 'numba' and _import_numba() is None:
+            raise ImportError('The numba backend requires numba '
+                              '(pip install numba)')
+        self.model = model
+        self.backend = backend
+        self.parameter_names = [p.name for p in model.parameters]
+        self.n_species = len(model.species)
+
+        build_dir = build_dir or get_model_batched_dir(MODEL_NAME,
+                                                       MODEL_VARIANT)
+        source = None
+        if model_hash is None:
+            source = generate_source(model, backend)
+            key = hashlib.sha256(source.encode()).hexdigest()
+        else:
+            key = hashlib.sha256(json.dumps(
+                [model_hash, self.parameter_names, backend, CODEGEN_FORMAT]
+            ).encode()).hexdigest()
+        self.source_file = os.path.join(build_dir,
+                                        f'rhs_{backend}_{key[:16]}.py')
+        if not os.path.exists(self.source_file):
+            if source is None:
+                source = generate_source(model, backend)
+            os.makedirs(build_dir, exist_ok=True)
+            tmp_file = f'{self.source_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(source)
+            os.replace(tmp_file, self.source_file)
+            logger.info(f"Generated {backend} RHS {self.source_file}")
+        self._module = _import_source(self.source_file)
+
+    def parameter_values(self, model=None):
+        """Current parameter values of a configured model as a vector."""
+        model = model or self.model
+        return np.array([model.parameters[name].value
+                         for name in self.parameter_names])
+
+    def rhs(self, x, p):
+        x = np.ascontiguousarray(x, dtype=float)
+        return self._module.rhs(x, np.ascontiguousarray(p, dtype=float),
+                                np.empty_like(x))
+
+    def jacobian(self, x, p):
+        x = np.ascontiguousarray(x, dtype=float)
+        out = np.empty((len(x), self.n_species, self.n_species))
+        return self._module.jacobian(x, np.ascontiguousarray(p, dtype=float),
+                                     out)
+
+    def initial_values(self, p):
+        p = np.ascontiguousarray(p, dtype=float)
+        return self._module.initials(p, np.empty((len(p), self.n_species)))
+
+
+def rosenbrock_step(batched_model, y, p, f0, h):
+    """One Rosenbrock 2(3) step of every condition with its own step size.
+
+    Returns the new states, their derivatives (reused as f0 of the next
+    step) and the componentwise local error estimates.
+    """
+    from scipy.linalg import lu_factor, lu_solve
+
+    n_species = y.shape[1]
+    jacobian = batched_model.jacobian(y, p)
+    iteration = np.eye(n_species) - (ROS_D * h)[:, None, None] * jacobian
+    # one LU factorization for the three stage solves of each condition
+    factors = [lu_factor(matrix, check_finite=False) for matrix in iteration]
+
+    def solve(b):
+        return np.array([lu_solve(factor, row, check_finite=False)
+                         for factor, row in zip(factors, b)])
+
+    h = h[:, None]
+    k1 = solve(f0)
+    f1 = batched_model.rhs(y + 0.5 * h * k1, p)
+    k2 = solve(f1 - k1) + k1
+    y_new = y + h * k2
+    f2 = batched_model.rhs(y_new, p)
+    k3 = solve(f2 - ROS_E32 * (k2 - f1) - 2 * (k1 - f0))
+    error = h / 6 * (k1 - 2 * k2 + k3)
+    return y_new, f2, error
+
+
+def integrate(batched_model, tspan, param_values, initials=None,
+              rtol=BATCHED_OPTIONS['rtol'], atol=BATCHED_OPTIONS['atol'],
+              max_steps=BATCHED_OPTIONS['max_steps']):
+    """Integrate a batch of conditions over tspan in lockstep.
+
+    Each condition (row of param_values) has its own adaptive step size
+    and steps exactly onto the output times; every iteration advances all
+    unfinished conditions with one vectorized step. Conditions whose step
+    size underflows or that exceed max_steps stop and are reported as
+    failed. Returns (species of shape (batch, time, species), success flags,
+    number of steps per condition).
+    """
+    tspan = np.asarray(tspan, dtype=float)
+    p = np.atleast_2d(np.asarray(param_values, dtype=float))
+    n_batch = len(p)
+    y = batched_model.initial_values(p) if initials is None \
+        else np.array(np.atleast_2d(initials), dtype=float)
+    species = np.full((n_batch, len(tspan), y.shape[1]), np.nan)
+    species[:, 0] = y
+
+    t = np.full(n_batch, tspan[0])
+    next_output = np.ones(n_batch, dtype=int)
+    n_steps = np.zeros(n_batch, dtype=int)
+    failed = np.zeros(n_batch, dtype=bool)
+    f = batched_model.rhs(y, p)
+
+    # initial step from the size of the derivatives, as in ode23s
+    scale = atol + rtol * np.abs(y)
+    rate = np.max(np.abs(f) / scale, axis=1) / (0.8 * rtol ** (1 / 3))
+    span = tspan[-1] - tspan[0]
+    h = np.minimum(span, 1 / np.maximum(rate, 1 / max(span, 1e-300)))
+
+    active = np.arange(n_batch) if len(tspan) > 1 else np.arange(0)
+    while len(active):
+        target = tspan[next_output[active]]
+        step = h[active]
+        hit = t[active] + step >= target
+        step = np.where(hit, target - t[active], step)
+
+        y_new, f_new, error = rosenbrock_step(batched_model, y[active],
+                                              p[active], f[active], step)
+        scale = atol + rtol * np.maximum(np.abs(y[active]), np.abs(y_new))
+        norm = np.max(np.abs(error) / scale, axis=1)
+        accept = np.isfinite(norm) & (norm <= 1)
+
+        done = active[accept]
+        t[done] = np.where(hit[accept], target[accept], t[done] + step[accept])
+        y[done] = y_new[accept]
+        f[done] = f_new[accept]
+        reached = done[hit[accept]]
+        species[reached, next_output[reached]] = y[reached]
+        next_output[reached] += 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.clip(0.8 * norm ** (-1 / 3), 0.1, 5.0)
+        factor = np.where(np.isfinite(factor), factor, 0.1)
+        factor = np.where(accept, factor, np.minimum(factor, 0.5))
+        # steps shortened to hit an output time keep the proposed size
+        h[active] = np.where(accept & hit, np.maximum(h[active],
+                                                      step * factor),
+                             step * factor)
+        n_steps[active] += 1
+
+        too_small = h[active] < 16 * np.finfo(float).eps \
+            * np.maximum(np.abs(t[active]), 1.0)
+        failed[active] = too_small | (n_steps[active] >= max_steps)
+        active = active[(next_output[active] < len(tspan))
+                        & ~failed[active]]
+    return species, ~failed, n_steps
+
+
+def get_batched_run_hash(parameter_names, parameter_values, model_hash,
+                         condition, tspan, options=None):
+    return compute_run_hash(model_hash, parameter_names, parameter_values,
+                            condition, tspan, INTEGRATOR,
+                            options or BATCHED_OPTIONS)
+
+
+def run_batched(conditions, store_dir, force=False, backend=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, options=None,
+                variant=MODEL_VARIANT, modifications=None, parameter_index=0):
+    """Simulate conditions into a result store with the batched integrator.
+
+    As in simulation.simulate, each condition starts from the model initial
+    values at the first time point with its EGF applied; the separate
+    pre-equilibration run of simulate does not feed into its output and is
+    skipped. Conditions are integrated chunk_size at a time. Results that
+    fail or are unhealthy are simulated again with sweep.run_sweep and its
+    fallback integrators. parameter_index is the row of the multistart
+    parameter table. Returns the number of conditions simulated here.
+    """
+    from sweep import run_sweep
+
+    options = dict(BATCHED_OPTIONS, **(options or {}))
+    os.makedirs(store_dir, exist_ok=True)
+    modifications = normalize_modifications(modifications)
+    model = load_model(MODEL_NAME, variant, modifications=modifications)
+    model_hash = hash_model_source(MODEL_NAME, variant, modifications)
+    _, tspan = get_tspan()
+
+    # parameter vectors come from the registry, the model is not modified
+    compiled = load_registry().compile(model)
+    pending = []
+    for condition in conditions:
+        key = get_condition_key(condition)
+        values = compiled.parameter_values(condition, parameter_index)
+        run_hash = get_batched_run_hash(compiled.parameter_names, values,
+                                        model_hash, condition, tspan, options)
+        if not force and is_complete(store_dir, key, run_hash):
+            continue
+        pending.append((condition, key, run_hash, values))
+    if not pending:
+        logger.info("All conditions already complete")
+        return 0
+
+    # the network and thus the generated code are shared by modified
+    # instances
+    batched_model = BatchedModel(
+        model, backend, get_model_batched_dir(MODEL_NAME, variant),
+        hash_model_source(MODEL_NAME, variant)
+    )
+    conservation = get_conservation_matrix(model)
+
+    n_simulated = 0
+    retry = []
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        for _, key, run_hash, _ in chunk:
+            mark_running(store_dir, key, run_hash)
+        logger.info(f"Integrating conditions {start + 1}-"
+                    f"{start + len(chunk)} of {len(pending)}")
+        start_time = time.time()
+        species, success, n_steps = integrate(
+            batched_model, tspan, [values for *_, values in chunk],
+            rtol=options['rtol'], atol=options['atol'],
+            max_steps=options['max_steps']
+        )
+        runtime = (time.time() - start_time) / len(chunk)
+
+        for j, (condition, key, run_hash, _) in enumerate(chunk):
+            problems = check_health(species[j], conservation, options) \
+                if success[j] else ['integration failed']
+            if problems:
+                logger.warning(f"{key}: {', '.join(problems)}; retrying "
+                               f"with the sweep integrators")
+                retry.append(condition)
+                continue
+            solver_info = {'integrator': INTEGRATOR,
+                           'n_steps': int(n_steps[j]),
+                           'backend': batched_model.backend}
+            save_results(get_results_file(store_dir, key), tspan, species[j],
+                         condition, attrs=dict(
+                             solver_info, run_hash=run_hash,
+                             model_variant=variant,
+                             modifications=modifications or ''))
+            mark_done(store_dir, key, run_hash,
+                      dict(solver_info, runtime=runtime))
+            n_simulated += 1
+
+    if retry:
+        run_sweep(retry, store_dir, force=True, variant=variant,
+                  modifications=modifications,
+                  parameter_index=parameter_index)
+    logger.info(f"Batched run finished: {n_simulated} simulated, "
+                f"{len(retry)} passed to the sweep integrators")
+    return n_simulated
+
+
+if __name__ == '__main__':
+    from sweep import add_condition_arguments, get_conditions
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Simulate conditions in batches with a generated '
+                    'vectorized RHS'
+    )
+    add_condition_arguments(parser)
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='Code generation backend (default: numba if '
+                             'installed)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Conditions integrated together')
+    parser.add_argument('--rtol', type=float, default=BATCHED_OPTIONS['rtol'])
+    parser.add_argument('--atol', type=float, default=BATCHED_OPTIONS['atol'])
+    args = parser.parse_args()
+
+    if args.checkpoint_interval:
+        parser.error('--checkpoint-interval is not supported by batched runs')
+    run_batched(get_conditions(args), args.store, force=args.force,
+                backend=args.backend, chunk_size=args.chunk_size,
+                options={'rtol': args.rtol, 'atol': args.atol})
@@ -0,0 +1,133 @@
+import logging
+import os
+import signal
+import time
+
+import numpy as np
+
+from registry import MIN_CONC
+
+logger = logging.getLogger(__name__)
+
+
+_stop_signal = None
+
+
+class SimulationInterrupted(Exception):
+    """Raised after a checkpoint was written because a stop was requested."""
+
+
+def _request_stop(signum, frame):
+    global _stop_signal
+    logger.warning(f"Received signal {signum}, stopping at the next "
+                   f"checkpoint")
+    _stop_signal = signum
+
+
+def install_signal_handlers():
+    """Turn SIGTERM/SIGUSR1 from the scheduler into a checkpoint and stop."""
+    for signum in (signal.SIGTERM, signal.SIGUSR1):
+        signal.signal(signum, _request_stop)
+
+
+def stop_requested():
+    return _stop_signal is not None
+
+
+def get_checkpoint_file(store_dir, key):
+    return os.path.join(store_dir, 'checkpoints', f'{key}.h5')
+
+
+def write_checkpoint(checkpoint_file, run_hash, t_reached, state, tout,
+                     species):
+    """Atomically store the integration progress of one condition."""
+    import h5py
+
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    tmp_file = f'{checkpoint_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('state', data=state)
+        f.create_dataset('time', data=np.asarray(tout, dtype=float))
+        f.create_dataset('trajectories',
+                         data=np.asarray(species, dtype=float).reshape(
+                             len(tout), len(state)))
+        f.attrs['run_hash'] = run_hash
+        f.attrs['t_reached'] = t_reached
+        f.attrs['written'] = time.time()
+    os.replace(tmp_file, checkpoint_file)
+
+
+def read_checkpoint(checkpoint_file, run_hash):
+    """Return (t_reached, state, tout, species) of a matching checkpoint."""
+    import h5py
+
+    if not os.path.exists(checkpoint_file):
+        return None
+    with h5py.File(checkpoint_file, 'r') as f:
+        if f.attrs.get('run_hash') != run_hash:
+            logger.info(f"Ignoring checkpoint {checkpoint_file} of a "
+                        f"different run")
+            return None
+        return (float(f.attrs['t_reached']), f['state'][:],
+                list(f['time'][:]), list(f['trajectories'][:]))
+
+
+def remove_checkpoint(checkpoint_file):
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+def simulate_checkpointed(sim, model, equil_time, egf, tspan, checkpoint_file,
+                          run_hash, checkpoint_interval=None):
+    """Run simulation.simulate segment by segment, checkpointing on the way.
+
+    The stimulation is integrated from one requested time point to the next,
+    and a stop request is honored after every segment. The state vector and
+    the trajectory so far are written to the checkpoint file every
+    checkpoint_interval seconds of wall time (never if None) and when a stop
+    was requested, which then raises SimulationInterrupted. An existing
+    checkpoint of the same run is continued instead of starting over.
+    Returns (tout, species).
+    """
+    tspan = np.asarray(tspan, dtype=float)
+
+    checkpoint = read_checkpoint(checkpoint_file, run_hash)
+    if checkpoint is not None:
+        t_reached, state, tout, species = checkpoint
+        logger.info(f"Resuming from checkpoint at t={t_reached:g}")
+        model.parameters['EGF_0'].value = egf
+    else:
+        # Set initial EGF to zero, then add it at t=0
+        model.parameters['EGF_0'].value = MIN_CONC
+
+        # Run pre-equilibration
+        sim.run(tspan=equil_time)
+
+        # Set EGF stimulus and continue simulation
+        model.parameters['EGF_0'].value = egf
+        t_reached, state = tspan[0], None
+        tout, species = [tspan[0]], None
+
+    last_checkpoint = time.monotonic()
+    for t_end in tspan[tspan > t_reached]:
+        output = sim.run(tspan=[t_reached, t_end], initials=state)
+        segment_species = np.asarray(output.species).reshape(2, -1)
+        if species is None:
+            species = [segment_species[0]]
+        tout.append(t_end)
+        species.append(segment_species[1])
+        t_reached, state = t_end, segment_species[1]
+
+        stopping = stop_requested() and t_end < tspan[-1]
+        if stopping or (checkpoint_interval is not None and
+                        time.monotonic() - last_checkpoint
+                        >= checkpoint_interval):
+            write_checkpoint(checkpoint_file, run_hash, t_reached, state,
+                             tout, species)
+            last_checkpoint = time.monotonic()
+        if stopping:
+            raise SimulationInterrupted(
+                f'Stopped at t={t_reached:g}, checkpoint in {checkpoint_file}'
+            )
+
+    return np.array(tout), np.array(species)
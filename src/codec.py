@@ -0,0 +1,233 @@
+"""Lossy compression of stored trajectories with error bounds.
+
+Each species is stored as the knots of a piecewise-linear approximation
+that stays within a tolerance of every original sample, so long flat
+stretches cost two values and peaks (global maximum and minimum are always
+knots) are kept exactly. Knot positions are delta-encoded time indices;
+indices and values are written with the HDF5 shuffle filter and gzip.
+Readers use read_trajectories, which returns the dense (time, species)
+array for both compressed and uncompressed results files.
+"""
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CODEC = 'pla'
+COMPRESSED_GROUP = 'compressed_trajectories'
+
+# tolerance of each species: atol + rtol * max(|species|)
+CODEC_OPTIONS = {
+    'rtol': 1e-4,
+    'atol': 1e-8,
+}
+
+
+def _chord_fits(time, values, start, end, tolerance):
+    """Whether the straight line from start to end is within tolerance."""
+    if end - start < 2:
+        return True
+    t = time[start:end + 1]
+    chord = values[start] + (values[end] - values[start]) \
+        * (t - t[0]) / (t[-1] - t[0])
+    return np.max(np.abs(chord - values[start:end + 1])) <= tolerance
+
+
+def _segment_end(time, values, start, stop, tolerance):
+    """End of the next segment from start, at most stop.
+
+    The segment is grown by doubling and then refined by bisection; only
+    lengths that were checked are returned, so the bound always holds.
+    """
+    good = start + 1
+    probe = start + 2
+    while probe <= stop and _chord_fits(time, values, start, probe,
+                                        tolerance):
+        good = probe
+        probe = start + 2 * (probe - start)
+    bad = probe
+    if probe > stop:
+        if _chord_fits(time, values, start, stop, tolerance):
+            return stop
+        bad = stop
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if _chord_fits(time, values, start, middle, tolerance):
+            good = middle
+        else:
+            bad = middle
+    return good
+
+
+def pla_knots(time, values, tolerance):
+    """Time indices of a piecewise-linear approximation of one series.
+
+    Linear interpolation between the returned knots differs from values by
+    at most tolerance at every time point. Series with non-finite values
+    keep all points.
+    """
+    n_times = len(values)
+    if n_times <= 2 or not np.all(np.isfinite(values)):
+        return np.arange(n_times)
+    # peaks are knots, so they are reproduced exactly
+    mandatory = np.unique([0, n_times - 1, int(np.argmax(values)),
+                           int(np.argmin(values))])
+    knots = [0]
+    for start, stop in zip(mandatory[:-1], mandatory[1:]):
+        index = start
+        while index < stop:
+            index = _segment_end(time, values, index, stop, tolerance)
+            knots.append(index)
+    return np.array(knots)
+
+
+def compress_trajectories(time, species, rtol=CODEC_OPTIONS['rtol'],
+                          atol=CODEC_OPTIONS['atol']):
+    """Knot representation of a (time, species) array.
+
+    Returns a dict with the per-species knot counts, the delta-encoded knot
+    indices, the knot values and the largest error of each species.
+    """
+    time = np.asarray(time, dtype=float).flatten()
+    species = np.asarray(species, dtype=float)
+    finite = np.isfinite(species)
+    scale = np.abs(np.where(finite, species, 0.0)).max(axis=0) \
+        if len(species) else np.zeros(species.shape[1])
+    tolerance = atol + rtol * scale
+
+    knots = [pla_knots(time, species[:, j], tolerance[j])
+             for j in range(species.shape[1])]
+    counts = np.array([len(k) for k in knots], dtype=np.int64)
+    compressed = {
+        'counts': counts,
+        'index_delta': np.concatenate(
+            [np.diff(k, prepend=0) for k in knots]
+        ) if knots else np.zeros(0, dtype=np.int64),
+        'values': np.concatenate(
+            [species[k, j] for j, k in enumerate(knots)]
+        ) if knots else np.zeros(0),
+    }
+    # non-finite series are stored point by point, without error
+    error = np.abs(decompress_trajectories(time, **compressed) - species)
+    compressed['max_error'] = np.where(finite, error, 0.0).max(axis=0) \
+        if len(species) else np.zeros(species.shape[1])
+    return compressed
+
+
+def decompress_trajectories(time, counts, index_delta, values, columns=None):
+    """Dense (time, species) array of a knot representation.
+
+    With columns, only those species are reconstructed.
+    """
+    time = np.asarray(time, dtype=float).flatten()
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if columns is None:
+        columns = range(len(counts))
+    species = np.empty((len(time), len(columns)))
+    for out, j in enumerate(columns):
+        segment = slice(offsets[j], offsets[j + 1])
+        indices = np.cumsum(index_delta[segment])
+        species[:, out] = np.interp(time, time[indices], values[segment])
+    return species
+
+
+def write_trajectories(f, species, time, codec_options=None):
+    """Write the trajectories of a results file, compressed with
+    codec_options (rtol and atol) or dense without."""
+    if codec_options is None:
+        f.create_dataset('trajectories', data=species)
+        return
+    options = dict(CODEC_OPTIONS, **codec_options)
+    compressed = compress_trajectories(time, species, options['rtol'],
+                                       options['atol'])
+    group = f.create_group(COMPRESSED_GROUP)
+    delta = compressed['index_delta']
+    index_dtype = np.uint16 if not len(delta) or delta.max() < 2 ** 16 \
+        else np.uint32
+    group.create_dataset('counts', data=compressed['counts'])
+    group.create_dataset('index_delta', data=delta.astype(index_dtype),
+                         compression='gzip', shuffle=True)
+    group.create_dataset('values', data=compressed['values'],
+                         compression='gzip', shuffle=True)
+    group.create_dataset('max_error', data=compressed['max_error'])
+    group.attrs['codec'] = CODEC
+    group.attrs['shape'] = np.shape(species)
+    group.attrs['rtol'] = options['rtol']
+    group.attrs['atol'] = options['atol']
+
+
+def is_compressed(f):
+    return COMPRESSED_GROUP in f
+
+
+def trajectories_shape(f):
+    """(time, species) shape of the trajectories of an open results file."""
+    if is_compressed(f):
+        return tuple(f[COMPRESSED_GROUP].attrs['shape'])
+    return f['trajectories'].shape
+
+
+def read_trajectories(f, columns=None):
+    """Dense trajectories of an open results file, compressed or not."""
+    if not is_compressed(f):
+        trajectories = f['trajectories'][:]
+        return trajectories if columns is None else trajectories[:, columns]
+    group = f[COMPRESSED_GROUP]
+    return decompress_trajectories(
+        f['time'][:], group['counts'][:],
+        group['index_delta'][:].astype(np.int64), group['values'][:],
+        columns
+    )
+
+
+def compress_results_file(results_file, codec_options=None):
+    """Rewrite a results file compressed; returns (bytes before, after)."""
+    import h5py
+
+    size = os.path.getsize(results_file)
+    tmp_file = f'{results_file}.{os.getpid()}.tmp'
+    with h5py.File(results_file, 'r') as f:
+        if is_compressed(f):
+            return size, size
+        with h5py.File(tmp_file, 'w') as out:
+            time = f['time'][:]
+            out.create_dataset('time', data=time, compression='gzip',
+                               shuffle=True)
+            write_trajectories(out, f['trajectories'][:], time,
+                               codec_options or {})
+            for key, value in f.attrs.items():
+                out.attrs[key] = value
+    os.replace(tmp_file, results_file)
+    return size, os.path.getsize(results_file)
+
+
+def compress_store(store_dir, codec_options=None):
+    """Compress all dense results files of a store in place."""
+    before, after = 0, 0
+    for results_file in sorted(glob.glob(os.path.join(store_dir, '*.h5'))):
+        size_before, size_after = compress_results_file(results_file,
+                                                        codec_options)
+        before += size_before
+        after += size_after
+    logger.info(f"Compressed {store_dir}: {before / 1e6:.1f} MB -> "
+                f"{after / 1e6:.1f} MB")
+    return before, after
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Compress the trajectories of a result store with '
+                    'bounded error'
+    )
+    parser.add_argument('--store', type=str, default='results/sweep')
+    parser.add_argument('--rtol', type=float, default=CODEC_OPTIONS['rtol'],
+                        help='Tolerance relative to the maximum of a species')
+    parser.add_argument('--atol', type=float, default=CODEC_OPTIONS['atol'])
+    args = parser.parse_args()
+
+    compress_store(args.store, {'rtol': args.rtol, 'atol': args.atol})
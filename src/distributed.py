@@ -0,0 +1,227 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+from checkpoint import install_signal_handlers
+from codec import read_trajectories, trajectories_shape
+from manifest import STATUS_DONE, get_results_file, read_manifest
+from model_cache import load_model
+from simulation import (MODEL_NAME, MODEL_VARIANT, configure_model,
+                        create_simulator, get_condition_key, get_tspan)
+from sweep import add_condition_arguments, get_conditions, run_sweep
+
+logger = logging.getLogger(__name__)
+
+
+def get_merged_file(store_dir):
+    # kept out of the store's top level, which only holds per-condition files
+    return os.path.join(store_dir, 'merged', 'results.h5')
+
+
+def get_shard():
+    """Return (shard index, number of shards) from the SLURM environment.
+
+    Array tasks and the tasks of a multi-task step (srun) are combined, so an
+    array of A tasks with N tasks each yields A*N shards. Without SLURM this
+    is a single shard.
+    """
+    env = os.environ
+    n_tasks = int(env.get('SLURM_NTASKS', 1))
+    task_id = int(env.get('SLURM_PROCID', 0))
+    if 'SLURM_ARRAY_TASK_ID' in env:
+        array_min = int(env.get('SLURM_ARRAY_TASK_MIN', 0))
+        array_index = int(env['SLURM_ARRAY_TASK_ID']) - array_min
+        array_count = int(env.get(
+            'SLURM_ARRAY_TASK_COUNT',
+            int(env.get('SLURM_ARRAY_TASK_MAX', array_min)) - array_min + 1
+        ))
+    else:
+        array_index, array_count = 0, 1
+    return array_index * n_tasks + task_id, array_count * n_tasks
+
+
+def shard_conditions(conditions, shard, n_shards):
+    """Deterministically select the conditions handled by one shard.
+
+    Conditions are ordered by key before striding, so every shard computes
+    the same partition regardless of input order.
+    """
+    if not 0 <= shard < n_shards:
+        raise ValueError(f'Invalid shard {shard} of {n_shards}')
+    ordered = sorted(conditions, key=get_condition_key)
+    return ordered[shard::n_shards]
+
+
+def get_shard_file(store_dir, shard, n_shards):
+    return os.path.join(store_dir, 'shards',
+                        f'shard_{shard:04d}_of_{n_shards:04d}.json')
+
+
+def run_shard(conditions, store_dir, shard, n_shards, force=False,
+              checkpoint_interval=None, variant=MODEL_VARIANT,
+              modifications=None, parameter_index=0):
+    """Simulate one shard of a sweep and record that the shard finished.
+
+    Returns False if the shard was stopped by a signal before finishing.
+    """
+    shard_conds = shard_conditions(conditions, shard, n_shards)
+    logger.info(f"Shard {shard}/{n_shards}: {len(shard_conds)} conditions")
+    start_time = time.time()
+    if not run_sweep(shard_conds, store_dir, force=force,
+                     checkpoint_interval=checkpoint_interval,
+                     variant=variant, modifications=modifications,
+                     parameter_index=parameter_index):
+        return False
+
+    shard_file = get_shard_file(store_dir, shard, n_shards)
+    os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+    tmp_file = f'{shard_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            'keys': [get_condition_key(c) for c in shard_conds],
+            'host': socket.gethostname(),
+            'runtime': time.time() - start_time,
+        }, f, indent=1)
+    os.replace(tmp_file, shard_file)
+    return True
+
+
+def _run_shard_process(args):
+    (conditions, store_dir, shard, n_shards, force, checkpoint_interval,
+     variant, modifications, parameter_index) = args
+    logging.basicConfig(level=logging.INFO)
+    install_signal_handlers()
+    return run_shard(conditions, store_dir, shard, n_shards, force=force,
+                     checkpoint_interval=checkpoint_interval,
+                     variant=variant, modifications=modifications,
+                     parameter_index=parameter_index)
+
+
+def warm_up(conditions, variant=MODEL_VARIANT, modifications=None):
+    """Restore the model and compile the RHS once before starting workers.
+
+    Compiled modules end up in the persistent Cython cache next to the model
+    snapshot, so workers only import them instead of all compiling at once.
+    """
+    model = load_model(MODEL_NAME, variant, modifications=modifications)
+    configure_model(model, conditions[0])
+    create_simulator(model, get_tspan()[1])
+
+
+def run_local(conditions, store_dir, n_processes, force=False,
+              checkpoint_interval=None, variant=MODEL_VARIANT,
+              modifications=None, parameter_index=0):
+    """Run a sweep as n_processes local shards, e.g. without a scheduler."""
+    from multiprocessing import Pool
+
+    warm_up(conditions, variant, modifications)
+    tasks = [(conditions, store_dir, shard, n_processes, force,
+              checkpoint_interval, variant, modifications, parameter_index)
+             for shard in range(n_processes)]
+    with Pool(n_processes) as pool:
+        return all(pool.map(_run_shard_process, tasks))
+
+
+def merge_store(store_dir, conditions=None):
+    """Reduce the per-condition results of a store into a single HDF5 file.
+
+    The merged file holds ``trajectories`` as (condition, time, species) with
+    the condition metadata as columns ordered by condition key, and the
+    model variant and modifications of the runs as attributes. If conditions
+    are given, all of them must have completed.
+    """
+    import h5py
+
+    entries = read_manifest(store_dir)
+    keys = sorted(key for key, entry in entries.items()
+                  if entry['status'] == STATUS_DONE)
+    if conditions is not None:
+        expected = {get_condition_key(c) for c in conditions}
+        missing = expected.difference(keys)
+        if missing:
+            raise RuntimeError(f'{len(missing)} conditions have not completed, '
+                               f'e.g. {sorted(missing)[0]}')
+        keys = sorted(expected)
+    if not keys:
+        raise RuntimeError(f'No completed results in {store_dir}')
+
+    merged_file = get_merged_file(store_dir)
+    os.makedirs(os.path.dirname(merged_file), exist_ok=True)
+    tmp_file = f'{merged_file}.{os.getpid()}.tmp'
+    with h5py.File(get_results_file(store_dir, keys[0]), 'r') as f:
+        time_points = f['time'][:]
+        n_species = trajectories_shape(f)[1]
+        instance = {name: f.attrs[name]
+                    for name in ['model_variant', 'modifications']
+                    if name in f.attrs}
+
+    with h5py.File(tmp_file, 'w') as out:
+        out.create_dataset('time', data=time_points)
+        trajectories = out.create_dataset(
+            'trajectories', shape=(len(keys), len(time_points), n_species),
+            dtype='f8', chunks=(1, len(time_points), n_species)
+        )
+        cell_lines, meki, egf, rafi, prafi, run_hashes = [], [], [], [], [], []
+        for index, key in enumerate(keys):
+            with h5py.File(get_results_file(store_dir, key), 'r') as f:
+                if not np.array_equal(f['time'][:], time_points):
+                    raise ValueError(f'Time points of {key} differ')
+                if any(f.attrs.get(name) != value
+                       for name, value in instance.items()):
+                    raise ValueError(f'{key} was simulated with another '
+                                     f'model instance')
+                trajectories[index] = read_trajectories(f)
+                cell_lines.append(str(f.attrs['cell_line']))
+                meki.append(f.attrs['meki_concentration'])
+                egf.append(f.attrs['egf_concentration'])
+                rafi.append(f.attrs.get('rafi_concentration', 0.0))
+                prafi.append(f.attrs.get('prafi_concentration', 0.0))
+                run_hashes.append(str(f.attrs.get('run_hash', '')))
+        out.create_dataset('key', data=np.array(keys, dtype='S'))
+        out.create_dataset('cell_line', data=np.array(cell_lines, dtype='S'))
+        out.create_dataset('meki_concentration', data=np.array(meki))
+        out.create_dataset('egf_concentration', data=np.array(egf))
+        out.create_dataset('rafi_concentration', data=np.array(rafi))
+        out.create_dataset('prafi_concentration', data=np.array(prafi))
+        out.create_dataset('run_hash', data=np.array(run_hashes, dtype='S'))
+        for name, value in instance.items():
+            out.attrs[name] = value
+    os.replace(tmp_file, merged_file)
+    logger.info(f"Merged {len(keys)} conditions into {merged_file}")
+    return merged_file
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Run a sweep sharded over SLURM tasks or local processes'
+    )
+    parser.add_argument('command', choices=['run', 'merge'])
+    add_condition_arguments(parser)
+    parser.add_argument('--local-processes', type=int, default=None,
+                        help='Run this many local shards instead of reading '
+                             'the shard from the SLURM environment')
+    args = parser.parse_args()
+    conditions = get_conditions(args)
+
+    if args.command == 'merge':
+        merge_store(args.store, conditions)
+    elif args.local_processes is not None:
+        if not run_local(conditions, args.store, args.local_processes,
+                         force=args.force,
+                         checkpoint_interval=args.checkpoint_interval):
+            sys.exit(1)
+        merge_store(args.store, conditions)
+    else:
+        install_signal_handlers()
+        shard, n_shards = get_shard()
+        if not run_shard(conditions, args.store, shard, n_shards,
+                         force=args.force,
+                         checkpoint_interval=args.checkpoint_interval):
+            sys.exit(1)
@@ -0,0 +1,375 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from codec import read_trajectories
+from features import compute_features, get_observable_matrix
+from manifest import get_results_file
+from registry import load_registry
+from simulation import get_condition_key, make_condition
+from sweep import run_sweep
+
+logger = logging.getLogger(__name__)
+
+# grids of the Hill fit, log10 IC50 relative to the tested dose range
+IC50_GRID_SIZE = 41
+HILL_GRID = np.logspace(np.log10(0.3), np.log10(5.0), 25)
+
+
+def get_parameter_set_store(store_dir, parameter_index):
+    """Result store of one multistart parameter set; row 0 uses store_dir."""
+    if parameter_index == 0:
+        return store_dir
+    return os.path.join(store_dir, 'parameter_sets', str(parameter_index))
+
+
+def get_dose_response_file(store_dir, cell_line, egf, prafi=0.0):
+    name = f'{cell_line}_egf{egf:g}'
+    if prafi:
+        name += f'_prafi{prafi:g}'
+    return os.path.join(store_dir, 'dose_response', f'{name}.h5')
+
+
+def load_responses(store_dir, conditions, observable='pERK',
+                   feature='steady_state'):
+    """Reduce the results of conditions to one response value each."""
+    import h5py
+    from model_cache import load_model
+    from simulation import MODEL_NAME, MODEL_VARIANT
+
+    matrix = get_observable_matrix(load_model(MODEL_NAME, MODEL_VARIANT),
+                                   [observable])
+    values = []
+    for condition in conditions:
+        results_file = get_results_file(store_dir,
+                                        get_condition_key(condition))
+        with h5py.File(results_file, 'r') as f:
+            time = f['time'][:].flatten()
+            values.append(read_trajectories(f) @ matrix[:, 0])
+    return compute_features(time, np.array(values))[feature]
+
+
+def make_combination_grid(cell_line, egf, meki_doses, rafi_doses, prafi=0.0):
+    return [make_condition(cell_line, meki, egf, rafi, prafi)
+            for meki in meki_doses for rafi in rafi_doses]
+
+
+def build_surface(store_dir, cell_line, egf, meki_doses, rafi_doses,
+                  prafi=0.0, observable='pERK', feature='steady_state',
+                  parameter_indices=None):
+    """Response surface of shape (MEKi doses, RAFi doses).
+
+    With parameter_indices, the surfaces of those parameter sets are stacked
+    to shape (parameter sets, MEKi doses, RAFi doses).
+    """
+    conditions = make_combination_grid(cell_line, egf, meki_doses,
+                                       rafi_doses, prafi)
+    shape = (len(meki_doses), len(rafi_doses))
+    if parameter_indices is None:
+        return load_responses(store_dir, conditions, observable,
+                              feature).reshape(shape)
+    return np.array([
+        load_responses(get_parameter_set_store(store_dir, index), conditions,
+                       observable, feature).reshape(shape)
+        for index in parameter_indices
+    ])
+
+
+def hill_curve(doses, bottom, top, ic50, hill):
+    """Decreasing Hill curve, top at zero dose, bottom at saturation."""
+    doses = np.asarray(doses, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(doses > 0, (doses / ic50) ** hill, 0.0)
+    return bottom + (top - bottom) / (1 + ratio)
+
+
+def _fit_hill_grid(doses, responses, log_ic50_grid, hill_grid):
+    # basis g = 1 / (1 + (d / IC50)^h) for every grid point: (..., I, H, D)
+    log_ic50 = log_ic50_grid[..., :, None, None]
+    hill = hill_grid[..., None, :, None]
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        ratio = np.where(doses > 0, (doses / 10 ** log_ic50) ** hill, 0.0)
+    g = 1 / (1 + ratio)
+
+    # bottom and span enter linearly and are solved in closed form
+    y = responses[..., None, None, :]
+    g_centered = g - g.mean(axis=-1, keepdims=True)
+    y_centered = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        span = (g_centered * y_centered).sum(axis=-1) \
+            / (g_centered ** 2).sum(axis=-1)
+    span = np.nan_to_num(span)
+    bottom = y.mean(axis=-1) - span * g.mean(axis=-1)
+    rss = ((bottom[..., None] + span[..., None] * g - y) ** 2).sum(axis=-1)
+
+    # best grid point per curve
+    flat = rss.reshape(rss.shape[:-2] + (-1,))
+    best = np.argmin(flat, axis=-1)[..., None]
+    i, h = np.unravel_index(best, rss.shape[-2:])
+    log_ic50_best = np.take_along_axis(
+        np.broadcast_to(log_ic50_grid, rss.shape[:-2] + log_ic50_grid.shape[-1:]),
+        i, axis=-1)[..., 0]
+    hill_best = np.take_along_axis(
+        np.broadcast_to(hill_grid, rss.shape[:-2] + hill_grid.shape[-1:]),
+        h, axis=-1)[..., 0]
+    take = lambda a: np.take_along_axis(a, best, axis=-1)[..., 0]  # noqa: E731
+    return (take(bottom.reshape(flat.shape)), take(span.reshape(flat.shape)),
+            log_ic50_best, hill_best, take(flat))
+
+
+def fit_hill(doses, responses):
+    """Fit Hill curves to many dose-response curves at once.
+
+    responses has shape (..., doses), e.g. one curve per parameter set and
+    fixed dose of a second drug. The nonlinear parameters are found on a
+    coarse grid that is refined once around the best point, the linear ones
+    (bottom, top) by least squares. Returns a dict of arrays with the leading
+    shape of responses.
+    """
+    doses = np.asarray(doses, dtype=float)
+    responses = np.asarray(responses, dtype=float)
+    positive = doses[doses > 0]
+    log_min, log_max = np.log10(positive.min()), np.log10(positive.max())
+    log_ic50_grid = np.linspace(log_min - 1, log_max + 1, IC50_GRID_SIZE)
+
+    bottom, span, log_ic50, hill, rss = _fit_hill_grid(
+        doses, responses, log_ic50_grid, HILL_GRID
+    )
+
+    # refine within one coarse grid step of the optimum
+    ic50_step = log_ic50_grid[1] - log_ic50_grid[0]
+    hill_step = np.log10(HILL_GRID[1] / HILL_GRID[0])
+    offsets = np.linspace(-1, 1, 11)
+    bottom, span, log_ic50, hill, rss = _fit_hill_grid(
+        doses, responses,
+        log_ic50[..., None] + ic50_step * offsets,
+        hill[..., None] * 10 ** (hill_step * offsets),
+    )
+
+    return {
+        'bottom': bottom,
+        'top': bottom + span,
+        'ic50': 10 ** log_ic50,
+        'hill': hill,
+        'rss': rss,
+    }
+
+
+def inverse_hill(responses, fit):
+    """Dose of a single agent producing the given responses (NaN if none)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (fit['top'] - fit['bottom']) / (responses - fit['bottom']) - 1
+        doses = fit['ic50'] * ratio ** (1 / fit['hill'])
+    return np.where(ratio > 0, doses, np.nan)
+
+
+def bliss_excess(surface):
+    """Observed minus Bliss-independent expected inhibition.
+
+    surface has shape (..., doses A, doses B) with zero dose of both drugs
+    first. Positive values indicate synergy.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inhibition = 1 - surface / surface[..., :1, :1]
+    inhibition_a = inhibition[..., :, :1]
+    inhibition_b = inhibition[..., :1, :]
+    expected = inhibition_a + inhibition_b - inhibition_a * inhibition_b
+    return inhibition - expected
+
+
+def loewe_combination_index(surface, doses_a, doses_b, fit_a=None,
+                            fit_b=None):
+    """Loewe combination index of every combination on the surface.
+
+    Iso-effective single-agent doses are taken from Hill fits of the zero-dose
+    row and column. CI < 1 indicates synergy, CI > 1 antagonism.
+    """
+    if fit_a is None:
+        fit_a = fit_hill(doses_a, surface[..., :, 0])
+    if fit_b is None:
+        fit_b = fit_hill(doses_b, surface[..., 0, :])
+    expand = lambda fit, axis: {  # noqa: E731
+        k: np.expand_dims(v, axis) for k, v in fit.items()
+    }
+    dose_a_alone = inverse_hill(surface, expand(expand(fit_a, -1), -1))
+    dose_b_alone = inverse_hill(surface, expand(expand(fit_b, -1), -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(doses_a)[:, None] / dose_a_alone \
+            + np.asarray(doses_b)[None, :] / dose_b_alone
+
+
+def synergy_scores(surface, doses_a, doses_b):
+    """Hill fits of both agents plus Bliss and Loewe synergy."""
+    fit_a = fit_hill(doses_a, surface[..., :, 0])
+    fit_b = fit_hill(doses_b, surface[..., 0, :])
+    bliss = bliss_excess(surface)
+    ci = loewe_combination_index(surface, doses_a, doses_b, fit_a, fit_b)
+    combinations = (slice(None),) * (surface.ndim - 2) \
+        + (slice(1, None), slice(1, None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loewe = -np.log10(ci[combinations])
+    return {
+        'fit_a': fit_a,
+        'fit_b': fit_b,
+        'bliss_excess': bliss,
+        'bliss_score': np.nanmean(bliss[combinations], axis=(-2, -1)),
+        'loewe_ci': ci,
+        'loewe_score': np.nanmean(
+            np.where(np.isfinite(loewe), loewe, np.nan), axis=(-2, -1)
+        ),
+    }
+
+
+def refine_doses(doses, surface, axis, tolerance=0.05, max_new=4):
+    """Add geometric midpoints where the response curves along an axis.
+
+    Curvature is measured as the deviation of each interior point from the
+    log-linear interpolation of its neighbours, relative to the response
+    range and maximised over the other axis. The zero-dose control is kept
+    but not refined.
+    """
+    doses = np.asarray(doses, dtype=float)
+    y = np.moveaxis(surface, axis, -1)
+    y = y.reshape(-1, y.shape[-1])
+    positive = np.flatnonzero(doses > 0)
+    if len(positive) < 3:
+        return doses
+    x = np.log10(doses[positive])
+    y = y[:, positive]
+
+    weight = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+    interpolated = y[:, :-2] + weight * (y[:, 2:] - y[:, :-2])
+    response_range = np.ptp(surface)
+    deviation = np.abs(y[:, 1:-1] - interpolated).max(axis=0) \
+        / (response_range if response_range > 0 else 1.0)
+
+    new = set()
+    for k in np.argsort(deviation)[::-1]:
+        if deviation[k] <= tolerance or len(new) >= max_new:
+            break
+        # interior point k + 1 of the positive doses, refine both sides
+        new.add(10 ** ((x[k] + x[k + 1]) / 2))
+        new.add(10 ** ((x[k + 1] + x[k + 2]) / 2))
+    return np.unique(np.concatenate([doses, sorted(new)]))
+
+
+def simulate_grid(conditions, store_dir, engine='sweep', processes=1,
+                  parameter_index=0):
+    """Simulate conditions of one parameter set into its result store."""
+    if engine == 'batched':
+        from batched import run_batched
+        run_batched(conditions, store_dir, parameter_index=parameter_index)
+    elif processes > 1:
+        from distributed import run_local
+        run_local(conditions, store_dir, processes,
+                  parameter_index=parameter_index)
+    else:
+        run_sweep(conditions, store_dir, parameter_index=parameter_index)
+
+
+def run_dose_response(store_dir, cell_line, egf, meki_doses, rafi_doses,
+                      prafi=0.0, observable='pERK', feature='steady_state',
+                      refinement_rounds=2, tolerance=0.05, processes=1,
+                      engine='sweep', n_parameter_sets=None):
+    """Simulate a MEKi x RAFi grid, refine it and compute synergy.
+
+    Conditions go through the regular sweep, or with engine='batched'
+    through batched.run_batched, so doses that were simulated in an earlier
+    round or run are not simulated again. With n_parameter_sets, the grid is
+    simulated for the best parameter sets of the cell line (see
+    ensemble.select_ensemble), each into its own store, and Hill curves and
+    synergy scores are fitted per parameter set. Writes and returns the
+    dose-response file of the combination.
+    """
+    import h5py
+
+    parameter_indices = None
+    if n_parameter_sets is not None:
+        from ensemble import select_ensemble
+        parameter_indices = select_ensemble(cell_line,
+                                            max_members=n_parameter_sets)
+    meki_doses = np.unique(np.concatenate([[0.0], meki_doses]))
+    rafi_doses = np.unique(np.concatenate([[0.0], rafi_doses]))
+    for round_index in range(refinement_rounds + 1):
+        conditions = make_combination_grid(cell_line, egf, meki_doses,
+                                           rafi_doses, prafi)
+        for index in parameter_indices or [0]:
+            simulate_grid(conditions, get_parameter_set_store(store_dir, index),
+                          engine, processes, index)
+        surface = build_surface(store_dir, cell_line, egf, meki_doses,
+                                rafi_doses, prafi, observable, feature,
+                                parameter_indices)
+        if round_index == refinement_rounds:
+            break
+        new_meki = refine_doses(meki_doses, surface, -2, tolerance)
+        new_rafi = refine_doses(rafi_doses, surface, -1, tolerance)
+        if len(new_meki) == len(meki_doses) \
+                and len(new_rafi) == len(rafi_doses):
+            break
+        logger.info(f"Refinement round {round_index + 1}: "
+                    f"{len(new_meki)} MEKi x {len(new_rafi)} RAFi doses")
+        meki_doses, rafi_doses = new_meki, new_rafi
+
+    scores = synergy_scores(surface, meki_doses, rafi_doses)
+    output_file = get_dose_response_file(store_dir, cell_line, egf, prafi)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('meki_doses', data=meki_doses)
+        f.create_dataset('rafi_doses', data=rafi_doses)
+        f.create_dataset('surface', data=surface)
+        f.create_dataset('bliss_excess', data=scores['bliss_excess'])
+        f.create_dataset('loewe_ci', data=scores['loewe_ci'])
+        if parameter_indices is not None:
+            f.create_dataset('parameter_indices', data=parameter_indices)
+        for drug, fit in [('meki', scores['fit_a']), ('rafi', scores['fit_b'])]:
+            for name, value in fit.items():
+                f.attrs[f'{drug}_{name}'] = value
+        f.attrs['bliss_score'] = scores['bliss_score']
+        f.attrs['loewe_score'] = scores['loewe_score']
+        f.attrs['observable'] = observable
+        f.attrs['feature'] = feature
+    os.replace(tmp_file, output_file)
+    # medians over parameter sets, if there are several
+    logger.info(f"MEKi IC50 {np.median(scores['fit_a']['ic50']):.3g}, "
+                f"RAFi IC50 {np.median(scores['fit_b']['ic50']):.3g}, "
+                f"Bliss {np.median(scores['bliss_score']):.3g}, "
+                f"Loewe {np.median(scores['loewe_score']):.3g}; "
+                f"saved to {output_file}")
+    return output_file
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='MEKi x RAFi dose-response surfaces and synergy'
+    )
+    parser.add_argument('--store', type=str, default='results/dose_response')
+    parser.add_argument('--cell-line', choices=list(load_registry().cell_lines),
+                        default='mutant')
+    parser.add_argument('--egf', type=float, default=0.0)
+    parser.add_argument('--prafi', type=float, default=0.0)
+    parser.add_argument('--meki', nargs='+', type=float,
+                        default=list(np.logspace(-3, 1, 5)))
+    parser.add_argument('--rafi', nargs='+', type=float,
+                        default=list(np.logspace(-3, 1, 5)))
+    parser.add_argument('--observable', type=str, default='pERK')
+    parser.add_argument('--feature', type=str, default='steady_state')
+    parser.add_argument('--refinement-rounds', type=int, default=2)
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--engine', choices=['sweep', 'batched'],
+                        default='sweep')
+    parser.add_argument('--parameter-sets', type=int, default=None,
+                        help='Fit the surfaces of this many best parameter '
+                             'sets (default: parameter set 0 only)')
+    args = parser.parse_args()
+
+    run_dose_response(args.store, args.cell_line, args.egf, args.meki,
+                      args.rafi, prafi=args.prafi, observable=args.observable,
+                      feature=args.feature,
+                      refinement_rounds=args.refinement_rounds,
+                      tolerance=args.tolerance, processes=args.processes,
+                      engine=args.engine, n_parameter_sets=args.parameter_sets)
@@ -0,0 +1,340 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import numpy as np
+
+from checkpoint import install_signal_handlers, stop_requested
+from features import get_observable_matrix
+from parameter_store import open_parameter_store
+from simulation import (MODEL_NAME, MODEL_VARIANT, configure_model,
+                        create_simulator, get_condition_key, get_settings,
+                        get_tspan, simulate)
+from solver_health import SolverFailure, simulate_with_fallback
+from sweep import add_condition_arguments, get_conditions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OBSERVABLES = ['pERK', 'pMEK']
+QUANTILES = [0.025, 0.25, 0.5, 0.75, 0.975]
+# parameter sets within this fval of the best one form the ensemble
+# (0.5 * chi2 95% quantile with one degree of freedom)
+FVAL_THRESHOLD = 0.5 * 3.841
+# fixed log-spaced histogram bins shared by all workers, so sketches of
+# different shards can be merged by adding counts
+BIN_RANGE = (1e-6, 1e6)
+BINS_PER_DECADE = 50
+
+
+def get_bin_edges():
+    n_decades = np.log10(BIN_RANGE[1]) - np.log10(BIN_RANGE[0])
+    return np.logspace(np.log10(BIN_RANGE[0]), np.log10(BIN_RANGE[1]),
+                       int(n_decades * BINS_PER_DECADE) + 1)
+
+
+def get_ensemble_dir(store_dir):
+    return os.path.join(store_dir, 'ensemble')
+
+
+def get_sketch_file(store_dir, shard, n_shards):
+    return os.path.join(get_ensemble_dir(store_dir), 'sketches',
+                        f'shard_{shard:04d}_of_{n_shards:04d}.h5')
+
+
+def get_bands_file(store_dir):
+    return os.path.join(get_ensemble_dir(store_dir), 'bands.h5')
+
+
+def select_ensemble(cell_line, fval_threshold=FVAL_THRESHOLD,
+                    max_members=None):
+    """Row labels of the parameter sets within fval_threshold of the best."""
+    settings = get_settings(cell_line)
+    store = open_parameter_store(settings['model_name'], settings['variant'],
+                                 settings['dataset'])
+    best = np.nanmin(store.fval)
+    positions = store.top_k(max_members or len(store),
+                            max_fval=best + fval_threshold)
+    return [store.labels[position] for position in positions]
+
+
+class EnsembleSketch:
+    """Mergeable per-time-point distribution of ensemble trajectories.
+
+    Holds histogram counts on fixed bins plus sums for mean and std, per
+    (condition, observable, time point). Sketches of disjoint members are
+    merged by adding them.
+    """
+
+    def __init__(self, n_conditions, n_observables, n_times):
+        self.edges = get_bin_edges()
+        shape = (n_conditions, n_observables, n_times)
+        # bin 0 and the last bin collect values outside BIN_RANGE
+        self.counts = np.zeros(shape + (len(self.edges) + 1,), dtype='i4')
+        self.sums = np.zeros(shape)
+        self.squares = np.zeros(shape)
+        self.n_members = np.zeros(n_conditions, dtype='i8')
+        self.n_failed = np.zeros(n_conditions, dtype='i8')
+
+    def add(self, condition_index, values):
+        """Add one member's trajectories of shape (observables, times)."""
+        bins = np.searchsorted(self.edges, values, side='right')
+        n_observables, n_times = values.shape
+        np.add.at(self.counts[condition_index],
+                  (np.arange(n_observables)[:, None],
+                   np.arange(n_times)[None, :], bins), 1)
+        self.sums[condition_index] += values
+        self.squares[condition_index] += values ** 2
+        self.n_members[condition_index] += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.sums += other.sums
+        self.squares += other.squares
+        self.n_members += other.n_members
+        self.n_failed += other.n_failed
+        return self
+
+    def quantiles(self, levels=QUANTILES):
+        """Quantiles interpolated log-linearly within bins, (..., levels)."""
+        cumulative = np.cumsum(self.counts, axis=-1)
+        total = cumulative[..., -1:]
+        # bin i spans edges[i - 1] to edges[i]; outer bins are clamped
+        lower = np.concatenate([[self.edges[0]], self.edges])
+        upper = np.concatenate([self.edges, [self.edges[-1]]])
+        result = np.full(self.counts.shape[:-1] + (len(levels),), np.nan)
+        for q, level in enumerate(levels):
+            target = level * total
+            index = np.minimum(
+                (cumulative < target).sum(axis=-1, keepdims=True),
+                self.counts.shape[-1] - 1)
+            before = np.take_along_axis(cumulative, index, axis=-1) \
+                - np.take_along_axis(self.counts, index, axis=-1)
+            count = np.take_along_axis(self.counts, index, axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.clip((target - before) / count, 0, 1)
+            log_lower = np.log10(lower[index])
+            log_upper = np.log10(upper[index])
+            value = 10 ** (log_lower + fraction * (log_upper - log_lower))
+            result[..., q] = np.where(total > 0, value, np.nan)[..., 0]
+        return result
+
+    def mean_std(self):
+        n = np.maximum(self.n_members, 1)[:, None, None]
+        mean = self.sums / n
+        std = np.sqrt(np.maximum(self.squares / n - mean ** 2, 0.0))
+        return mean, std
+
+    def write(self, output_file, attrs=None):
+        import h5py
+
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        tmp_file = f'{output_file}.{os.getpid()}.tmp'
+        with h5py.File(tmp_file, 'w') as f:
+            f.create_dataset('counts', data=self.counts, compression='gzip')
+            f.create_dataset('sums', data=self.sums)
+            f.create_dataset('squares', data=self.squares)
+            f.create_dataset('n_members', data=self.n_members)
+            f.create_dataset('n_failed', data=self.n_failed)
+            for key, value in (attrs or {}).items():
+                f.attrs[key] = value
+        os.replace(tmp_file, output_file)
+
+    @classmethod
+    def read(cls, sketch_file):
+        import h5py
+
+        with h5py.File(sketch_file, 'r') as f:
+            sketch = cls(*f['sums'].shape)
+            sketch.counts = f['counts'][:]
+            sketch.sums = f['sums'][:]
+            sketch.squares = f['squares'][:]
+            sketch.n_members = f['n_members'][:]
+            sketch.n_failed = f['n_failed'][:]
+        return sketch
+
+
+def run_ensemble_shard(conditions, store_dir, shard=0, n_shards=1,
+                       observable_names=None, fval_threshold=FVAL_THRESHOLD,
+                       max_members=None, save_trajectories=False):
+    """Simulate one shard of the ensemble members into a sketch file.
+
+    Members (parameter sets) are distributed over shards by stride.
+    Trajectories are projected onto the observables and added to the
+    sketch immediately; with save_trajectories they are also written to
+    a per-shard file. Returns False if stopped by a signal.
+    """
+    import h5py
+    from model_cache import load_model
+
+    if observable_names is None:
+        observable_names = DEFAULT_OBSERVABLES
+    model = load_model(MODEL_NAME, MODEL_VARIANT)
+    equil_time, tspan = get_tspan()
+    members = {cell_line: select_ensemble(cell_line, fval_threshold,
+                                          max_members)
+               for cell_line in sorted({c['cell_line'] for c in conditions})}
+    n_members = max(len(labels) for labels in members.values())
+    member_indices = range(shard, n_members, n_shards)
+    logger.info(f"Shard {shard}/{n_shards}: {len(member_indices)} of "
+                f"{n_members} ensemble members, {len(conditions)} "
+                f"conditions")
+
+    sketch = EnsembleSketch(len(conditions), len(observable_names),
+                            len(tspan))
+    matrix = None
+    sim = None
+    raw = None
+    if save_trajectories:
+        raw_file = get_sketch_file(store_dir, shard, n_shards)[:-3] \
+            + '_trajectories.h5'
+        raw = h5py.File(f'{raw_file}.{os.getpid()}.tmp', 'w')
+        raw_values = raw.create_dataset(
+            'trajectories', dtype='f4',
+            shape=(len(conditions), len(member_indices),
+                   len(observable_names), len(tspan)),
+            fillvalue=np.nan, chunks=(1, 1, len(observable_names), len(tspan)),
+            compression='gzip'
+        )
+
+    for m, member in enumerate(member_indices):
+        for c, condition in enumerate(conditions):
+            labels = members[condition['cell_line']]
+            if member >= len(labels):
+                continue
+            egf = configure_model(model, condition,
+                                  parameter_index=labels[member])
+            if sim is None:
+                sim = create_simulator(model, tspan)
+                matrix = get_observable_matrix(model, observable_names)
+
+            def simulate_fn(sim):
+                output = simulate(sim, model, equil_time, egf)
+                return output.tout, output.species
+            try:
+                _, species, _ = simulate_with_fallback(model, tspan,
+                                                       simulate_fn, sim=sim)
+            except SolverFailure as e:
+                logger.warning(f"{get_condition_key(condition)}, member "
+                               f"{labels[member]}: {e}")
+                sketch.n_failed[c] += 1
+                continue
+            values = (np.asarray(species) @ matrix).T
+            sketch.add(c, values)
+            if raw is not None:
+                raw_values[c, m] = values
+        if stop_requested():
+            logger.warning("Stopping ensemble after signal")
+            if raw is not None:
+                raw.close()
+            return False
+
+    attrs = {'observables': observable_names, 'member_shard': shard,
+             'n_shards': n_shards}
+    sketch.write(get_sketch_file(store_dir, shard, n_shards), attrs)
+    if raw is not None:
+        raw.close()
+        os.replace(f'{raw_file}.{os.getpid()}.tmp', raw_file)
+    return True
+
+
+def merge_sketches(conditions, store_dir, levels=QUANTILES):
+    """Merge all shard sketches and write the prediction bands."""
+    import h5py
+
+    sketch_files = sorted(glob.glob(os.path.join(
+        get_ensemble_dir(store_dir), 'sketches', 'shard_*_of_*[0-9].h5'
+    )))
+    if not sketch_files:
+        raise RuntimeError(f'No ensemble sketches in {store_dir}')
+    with h5py.File(sketch_files[0], 'r') as f:
+        observable_names = list(f.attrs['observables'])
+        n_shards = int(f.attrs['n_shards'])
+    if len(sketch_files) != n_shards:
+        raise RuntimeError(f'{len(sketch_files)} of {n_shards} shards '
+                           f'finished')
+    sketch = EnsembleSketch.read(sketch_files[0])
+    for sketch_file in sketch_files[1:]:
+        sketch.merge(EnsembleSketch.read(sketch_file))
+
+    mean, std = sketch.mean_std()
+    bands_file = get_bands_file(store_dir)
+    tmp_file = f'{bands_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('time', data=get_tspan()[1])
+        f.create_dataset('quantiles', data=sketch.quantiles(levels))
+        f.create_dataset('mean', data=mean)
+        f.create_dataset('std', data=std)
+        f.create_dataset('n_members', data=sketch.n_members)
+        f.create_dataset('n_failed', data=sketch.n_failed)
+        f.create_dataset('key', data=np.array(
+            [get_condition_key(c) for c in conditions], dtype='S'))
+        f.create_dataset('cell_line', data=np.array(
+            [c['cell_line'] for c in conditions], dtype='S'))
+        for drug in ['meki', 'egf', 'rafi', 'prafi']:
+            f.create_dataset(f'{drug}_concentration', data=np.array(
+                [c.get(drug, 0.0) for c in conditions]))
+        f.attrs['observables'] = observable_names
+        f.attrs['quantile_levels'] = levels
+    os.replace(tmp_file, bands_file)
+    logger.info(f"Wrote bands of {int(sketch.n_members.max())} members to "
+                f"{bands_file}")
+    return bands_file
+
+
+def _run_shard_process(args):
+    logging.basicConfig(level=logging.INFO)
+    install_signal_handlers()
+    return run_ensemble_shard(*args)
+
+
+if __name__ == '__main__':
+    from distributed import get_shard
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Simulate the multistart ensemble and write prediction '
+                    'bands'
+    )
+    parser.add_argument('command', choices=['run', 'merge'])
+    add_condition_arguments(parser)
+    parser.add_argument('--observables', nargs='+',
+                        default=DEFAULT_OBSERVABLES)
+    parser.add_argument('--fval-threshold', type=float,
+                        default=FVAL_THRESHOLD,
+                        help='Include parameter sets within this fval of '
+                             'the best one')
+    parser.add_argument('--max-members', type=int, default=None)
+    parser.add_argument('--save-trajectories', action='store_true',
+                        help='Also keep raw observable trajectories')
+    parser.add_argument('--local-processes', type=int, default=None,
+                        help='Run this many local shards instead of reading '
+                             'the shard from the SLURM environment')
+    args = parser.parse_args()
+    conditions = get_conditions(args)
+
+    if args.command == 'merge':
+        merge_sketches(conditions, args.store)
+        sys.exit(0)
+
+    if args.local_processes is not None:
+        from multiprocessing import Pool
+
+        tasks = [(conditions, args.store, shard, args.local_processes,
+                  args.observables, args.fval_threshold, args.max_members,
+                  args.save_trajectories)
+                 for shard in range(args.local_processes)]
+        with Pool(args.local_processes) as pool:
+            finished = all(pool.map(_run_shard_process, tasks))
+        if finished:
+            merge_sketches(conditions, args.store)
+    else:
+        install_signal_handlers()
+        shard, n_shards = get_shard()
+        finished = run_ensemble_shard(conditions, args.store, shard,
+                                      n_shards, args.observables,
+                                      args.fval_threshold, args.max_members,
+                                      args.save_trajectories)
+    if not finished:
+        sys.exit(1)
@@ -0,0 +1,179 @@
+import argparse
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+from codec import read_trajectories
+from features import get_observable_matrix
+from manifest import STATUS_DONE, get_manifest_dir, get_results_file, \
+    read_manifest
+from paths import get_model_name_variant, parse_model_instance_name
+from simulation import MODEL_NAME, MODEL_VARIANT
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['long', 'wide']
+CONDITION_COLUMNS = ['meki_concentration', 'egf_concentration',
+                     'rafi_concentration', 'prafi_concentration']
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Exporting to Parquet requires pyarrow '
+                          '(pip install pyarrow)') from None
+    return pyarrow
+
+
+def find_stores(results_dir):
+    """Result stores below results_dir, keyed by their variant name.
+
+    results_dir is either a store itself, which holds the default variant,
+    or contains one store per model instance as written by variants.py.
+    """
+    if os.path.isdir(get_manifest_dir(results_dir)):
+        return {get_model_name_variant(MODEL_NAME, MODEL_VARIANT): results_dir}
+    store_dirs = [os.path.dirname(manifest_dir) for manifest_dir in
+                  glob.glob(os.path.join(results_dir, '*', 'manifest'))]
+    return {os.path.basename(store_dir): store_dir
+            for store_dir in sorted(store_dirs)}
+
+
+def get_partition_dir(output_dir, variant, cell_line, key):
+    return os.path.join(output_dir, f'variant={variant}',
+                        f'cell_line={cell_line}', f'condition={key}')
+
+
+def get_partition_file(output_dir, variant, cell_line, key, run_hash):
+    # the run hash in the name makes exports of unchanged runs skippable
+    return os.path.join(get_partition_dir(output_dir, variant, cell_line, key),
+                        f'part-{run_hash[:16]}.parquet')
+
+
+def results_to_table(results_file, matrix, names, form='long'):
+    """Arrow table of one results file projected onto observables.
+
+    Long form has one row per time point and observable (``time``,
+    ``observable``, ``value``), wide form one row per time point with a
+    column per observable. Condition concentrations are added as columns;
+    cell line and condition key are encoded in the partition path.
+    """
+    import h5py
+    pa = _import_pyarrow()
+
+    with h5py.File(results_file, 'r') as f:
+        tout = f['time'][:].flatten()
+        values = read_trajectories(f) @ matrix
+        attrs = {name: float(f.attrs.get(name, 0.0))
+                 for name in CONDITION_COLUMNS}
+
+    if form == 'long':
+        n_rows = values.size
+        columns = {
+            'time': pa.array(np.repeat(tout, len(names))),
+            'observable': pa.DictionaryArray.from_arrays(
+                pa.array(np.tile(np.arange(len(names), dtype='i4'),
+                                 len(tout))),
+                pa.array(names)
+            ),
+            'value': pa.array(values.ravel()),
+        }
+    elif form == 'wide':
+        n_rows = len(tout)
+        columns = {'time': pa.array(tout)}
+        columns.update({name: pa.array(values[:, j])
+                        for j, name in enumerate(names)})
+    else:
+        raise ValueError(f'Unknown table form {form}')
+    for name, value in attrs.items():
+        columns[name] = pa.array(np.full(n_rows, value))
+    return pa.table(columns)
+
+
+def export_store(store_dir, output_dir, variant, observable_names=None,
+                 form='long', species=False):
+    """Export the completed runs of a store to partitioned Parquet files.
+
+    Runs are converted one at a time, so memory is bounded by a single
+    trajectory. Partitions whose file already matches the run hash are
+    skipped and outdated files of a condition are replaced, so repeated
+    exports only write runs that finished since the last one. With species,
+    all species are exported instead of observables. Returns the number of
+    files written.
+    """
+    from model_cache import load_model
+
+    pq = _import_pyarrow().parquet
+    name, model_variant, _, modifications = parse_model_instance_name(variant)
+    model = load_model(name, model_variant, modifications=modifications)
+    if species:
+        names = [f'__s{i}' for i in range(len(model.species))]
+        matrix = np.eye(len(model.species))
+    else:
+        names = observable_names or [o.name for o in model.observables]
+        matrix = get_observable_matrix(model, names)
+
+    n_written = 0
+    for key, entry in read_manifest(store_dir).items():
+        if entry['status'] != STATUS_DONE:
+            continue
+        cell_line = key.split('_', 1)[0]
+        partition_file = get_partition_file(output_dir, variant, cell_line,
+                                            key, entry['hash'])
+        if os.path.exists(partition_file):
+            continue
+        table = results_to_table(get_results_file(store_dir, key), matrix,
+                                 names, form)
+        os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+        tmp_file = f'{partition_file}.{os.getpid()}.tmp'
+        pq.write_table(table, tmp_file, compression='zstd')
+        # drop exports of earlier runs of the condition
+        for old_file in glob.glob(os.path.join(
+                os.path.dirname(partition_file), 'part-*.parquet')):
+            os.remove(old_file)
+        os.replace(tmp_file, partition_file)
+        n_written += 1
+    return n_written
+
+
+def export_results(results_dir, output_dir, observable_names=None,
+                   form='long', species=False):
+    n_written = 0
+    for variant, store_dir in find_stores(results_dir).items():
+        n_written += export_store(store_dir, output_dir, variant,
+                                  observable_names, form, species)
+    logger.info(f"Exported {n_written} new runs to {output_dir}")
+    return n_written
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Export result stores to partitioned Parquet tables'
+    )
+    parser.add_argument('--store', type=str, default='results/sweep',
+                        help='Result store, or directory of variant stores')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output directory (default: <store>/parquet)')
+    parser.add_argument('--form', choices=FORMATS, default='long')
+    parser.add_argument('--observables', nargs='+', default=None,
+                        help='Observables to export (default: all)')
+    parser.add_argument('--species', action='store_true',
+                        help='Export all species instead of observables')
+    parser.add_argument('--watch', type=float, default=None,
+                        help='Keep exporting new runs every this many '
+                             'seconds')
+    args = parser.parse_args()
+
+    output_dir = args.output or os.path.join(args.store, 'parquet')
+    while True:
+        export_results(args.store, output_dir, args.observables, args.form,
+                       args.species)
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
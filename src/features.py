@@ -0,0 +1,252 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OBSERVABLES = ['pERK', 'pMEK']
+
+FEATURES = [
+    'baseline',
+    'peak',
+    'time_to_peak',
+    'auc',
+    'steady_state',
+    'adaptation_index',
+    'n_peaks',
+    'oscillation_period',
+    'oscillation_damping',
+]
+
+# local maxima smaller than this fraction of the response range are noise
+PEAK_PROMINENCE = 0.05
+# fraction of the time course averaged for the steady state
+STEADY_STATE_FRACTION = 0.1
+
+# np.trapz was renamed to np.trapezoid in NumPy 2.0
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+def get_observable_matrix(model, observable_names):
+    """Species coefficients of observables, shape (species, observables)."""
+    matrix = np.zeros((len(model.species), len(observable_names)))
+    for j, name in enumerate(observable_names):
+        observable = model.observables[name]
+        matrix[observable.species, j] = observable.coefficients
+    return matrix
+
+
+def feature_column(observable, feature):
+    """Column of a feature table; use (observable, feature) pairs to refer
+    to features, since both names may contain underscores."""
+    return f'{observable}_{feature}'
+
+
+def get_feature_file(store_dir):
+    return os.path.join(store_dir, 'features', 'features.h5')
+
+
+def _safe_divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator / denominator, np.nan)
+
+
+def _oscillation_features(t, y, steady_state, prominence):
+    """Number of peaks, oscillation period and damping; needs 3 time points.
+    """
+    # local maxima with a minimal prominence relative to the response range
+    response_range = y.max(axis=-1) - y.min(axis=-1)
+    is_peak = (y[..., 1:-1] > y[..., :-2]) & (y[..., 1:-1] >= y[..., 2:])
+    is_peak &= (y[..., 1:-1] - np.minimum(y[..., :-2], y[..., 2:])
+                > prominence * response_range[..., None])
+    n_peaks = is_peak.sum(axis=-1)
+
+    peak_times = np.broadcast_to(t[1:-1], is_peak.shape)
+    first_peak = np.argmax(is_peak, axis=-1)
+    last_peak = is_peak.shape[-1] - 1 - np.argmax(is_peak[..., ::-1], axis=-1)
+    first_time = np.take_along_axis(peak_times, first_peak[..., None],
+                                    axis=-1)[..., 0]
+    last_time = np.take_along_axis(peak_times, last_peak[..., None],
+                                   axis=-1)[..., 0]
+    inner = y[..., 1:-1]
+    first_value = np.take_along_axis(inner, first_peak[..., None],
+                                     axis=-1)[..., 0]
+    last_value = np.take_along_axis(inner, last_peak[..., None],
+                                    axis=-1)[..., 0]
+    oscillating = n_peaks > 1
+    oscillation_period = np.where(
+        oscillating, _safe_divide(last_time - first_time, n_peaks - 1), np.nan
+    )
+    oscillation_damping = np.where(
+        oscillating,
+        _safe_divide(last_value - steady_state, first_value - steady_state),
+        np.nan
+    )
+    return n_peaks, oscillation_period, oscillation_damping
+
+
+def compute_features(time, values, t_start=0.0,
+                     prominence=PEAK_PROMINENCE):
+    """Compute response features along the last axis of values.
+
+    values may have any leading shape, e.g. (condition, ensemble,
+    observable, time). Only time points at or after t_start (the stimulus)
+    are used. Returns a dict of arrays with the leading shape of values.
+    With fewer than 3 such time points there are no local maxima, so
+    n_peaks is 0 and the oscillation features are NaN.
+    """
+    time = np.asarray(time, dtype=float)
+    mask = time >= t_start
+    t = time[mask]
+    y = np.asarray(values, dtype=float)[..., mask]
+    if not len(t):
+        raise ValueError(f'No time points at or after t_start={t_start:g}')
+
+    baseline = y[..., 0]
+    peak_index = np.argmax(y, axis=-1)
+    peak = np.take_along_axis(y, peak_index[..., None], axis=-1)[..., 0]
+    n_steady = max(1, int(np.ceil(STEADY_STATE_FRACTION * len(t))))
+    steady_state = y[..., -n_steady:].mean(axis=-1)
+    auc = _trapezoid(y, t, axis=-1)
+
+    if len(t) >= 3:
+        n_peaks, oscillation_period, oscillation_damping = \
+            _oscillation_features(t, y, steady_state, prominence)
+    else:
+        n_peaks = np.zeros(y.shape[:-1], dtype=int)
+        oscillation_period = np.full(y.shape[:-1], np.nan)
+        oscillation_damping = np.full(y.shape[:-1], np.nan)
+
+    return {
+        'baseline': baseline,
+        'peak': peak,
+        'time_to_peak': t[peak_index] - t[0],
+        'auc': auc,
+        'steady_state': steady_state,
+        'adaptation_index': _safe_divide(peak - steady_state,
+                                         peak - baseline),
+        'n_peaks': n_peaks,
+        'oscillation_period': oscillation_period,
+        'oscillation_damping': oscillation_damping,
+    }
+
+
+def iter_store_chunks(merged_file, chunk_size=1024):
+    """Yield (condition slice, trajectories) chunks of a merged result store."""
+    import h5py
+
+    with h5py.File(merged_file, 'r') as f:
+        trajectories = f['trajectories']
+        for start in range(0, trajectories.shape[0], chunk_size):
+            stop = min(start + chunk_size, trajectories.shape[0])
+            yield slice(start, stop), trajectories[start:stop]
+
+
+def extract_features(merged_file, output_file, observable_names=None,
+                     chunk_size=1024, t_start=0.0):
+    """Write a feature table for all trajectories of a merged result store.
+
+    Trajectories are read in chunks of conditions and projected onto the
+    observables, so memory use is bounded by chunk_size. The table holds one
+    row per condition (and ensemble member, if the store has an ensemble
+    axis) with a column per observable and feature, named
+    ``<observable>_<feature>``, plus the condition columns of the store.
+    The model instance (variant and modifications) is the one recorded in
+    the store, or the default variant for stores that predate the record.
+    """
+    import h5py
+    from model_cache import load_model
+    from simulation import MODEL_NAME, MODEL_VARIANT
+
+    if observable_names is None:
+        observable_names = DEFAULT_OBSERVABLES
+
+    with h5py.File(merged_file, 'r') as f:
+        variant = f.attrs.get('model_variant', MODEL_VARIANT)
+        modifications = f.attrs.get('modifications') or None
+        time = f['time'][:].flatten()
+        leading_shape = f['trajectories'].shape[:-2]
+        condition_columns = {
+            name: f[name][:] for name in
+            ['key', 'cell_line', 'meki_concentration', 'egf_concentration',
+             'rafi_concentration', 'prafi_concentration']
+            if name in f
+        }
+    model = load_model(MODEL_NAME, variant, modifications=modifications)
+    matrix = get_observable_matrix(model, observable_names)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as out:
+        columns = {}
+        for name in observable_names:
+            for feature in FEATURES:
+                column = feature_column(name, feature)
+                columns[column] = out.create_dataset(
+                    column, shape=leading_shape, dtype='f4'
+                )
+        for rows, trajectories in iter_store_chunks(merged_file, chunk_size):
+            # (..., time, species) -> (..., observable, time)
+            values = np.swapaxes(trajectories @ matrix, -1, -2)
+            features = compute_features(time, values, t_start=t_start)
+            for j, name in enumerate(observable_names):
+                for feature in FEATURES:
+                    columns[feature_column(name, feature)][rows] = \
+                        features[feature][..., j]
+        for name, column in condition_columns.items():
+            out.create_dataset(name, data=column)
+        out.attrs['observables'] = observable_names
+        out.attrs['source'] = os.path.abspath(merged_file)
+    os.replace(tmp_file, output_file)
+    logger.info(f"Wrote features of {int(np.prod(leading_shape))} "
+                f"trajectories to {output_file}")
+    return output_file
+
+
+def load_feature_table(feature_file):
+    """Load a feature table as a pandas DataFrame, one row per trajectory."""
+    import h5py
+    import pandas as pd
+
+    with h5py.File(feature_file, 'r') as f:
+        observables = list(f.attrs['observables'])
+        leading_shape = f[feature_column(observables[0], FEATURES[0])].shape
+        data = {name: f[name][:] for name in f}
+
+    # condition columns are repeated for every ensemble member
+    n_members = int(np.prod(leading_shape[1:]))
+    table = {}
+    for name, values in data.items():
+        if values.dtype.kind == 'S':
+            values = values.astype(str)
+        if values.shape == leading_shape:
+            table[name] = values.ravel()
+        else:
+            table[name] = np.repeat(values, n_members)
+    if n_members > 1:
+        table['member'] = np.tile(np.arange(n_members), leading_shape[0])
+    return pd.DataFrame(table)
+
+
+if __name__ == '__main__':
+    from distributed import get_merged_file
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Extract trajectory features from a merged result store'
+    )
+    parser.add_argument('--store', type=str, default='results/sweep')
+    parser.add_argument('--observables', nargs='+',
+                        default=DEFAULT_OBSERVABLES)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--output', type=str, default=None,
+                        help='Feature file (default: '
+                             '<store>/features/features.h5)')
+    args = parser.parse_args()
+
+    extract_features(get_merged_file(args.store),
+                     args.output or get_feature_file(args.store),
+                     observable_names=args.observables,
+                     chunk_size=args.chunk_size)
@@ -0,0 +1,290 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from codec import read_trajectories
+from manifest import STATUS_DONE, get_results_file, read_manifest
+from model_cache import expand_expression
+from simulation import MODEL_NAME, MODEL_VARIANT, configure_model, \
+    make_condition
+
+logger = logging.getLogger(__name__)
+
+# time points at which the Jacobian spectrum is computed
+DEFAULT_STIFFNESS_POINTS = 10
+
+
+def get_flux_file(store_dir, key):
+    return os.path.join(store_dir, 'fluxes', f'{key}.h5')
+
+
+def _species_symbols(model):
+    import sympy
+
+    return [sympy.Symbol(f'__s{i}') for i in range(len(model.species))]
+
+
+class FluxModel:
+    """Vectorized reaction rates and rate derivatives of a network.
+
+    Rate laws and their derivatives with respect to species are lambdified
+    once and evaluated on whole trajectories of shape (time, species).
+    """
+
+    def __init__(self, model):
+        import sympy
+
+        self.model = model
+        species = _species_symbols(model)
+        parameters = list(model.parameters)
+        self.rates = [expand_expression(model, r['rate'])
+                      for r in model.reactions]
+        self._rate_fn = sympy.lambdify(species + parameters, self.rates,
+                                       'numpy')
+
+        # derivatives of each rate w.r.t. the species it depends on
+        self.derivative_index = []
+        derivatives = []
+        for r, rate in enumerate(self.rates):
+            for i, symbol in enumerate(species):
+                if symbol in rate.free_symbols:
+                    self.derivative_index.append((r, i))
+                    derivatives.append(sympy.diff(rate, symbol))
+        self.derivative_index = np.array(self.derivative_index,
+                                         dtype=int).reshape(-1, 2)
+        self._derivative_fn = sympy.lambdify(species + parameters,
+                                             derivatives, 'numpy')
+
+        # stoichiometry (species, reactions)
+        self.stoichiometry = np.zeros((len(model.species),
+                                       len(model.reactions)))
+        for r, reaction in enumerate(model.reactions):
+            for i in reaction['reactants']:
+                self.stoichiometry[i, r] -= 1
+            for i in reaction['products']:
+                self.stoichiometry[i, r] += 1
+
+        self.reaction_names = [
+            ' + '.join(f'__s{i}' for i in reaction['reactants'])
+            + ' -> ' + ' + '.join(f'__s{i}' for i in reaction['products'])
+            for reaction in model.reactions
+        ]
+        self.reaction_rules = [
+            reaction['rule'][0]
+            + ('__reverse' if reaction['reverse'][0] else '')
+            for reaction in model.reactions
+        ]
+
+    def _arguments(self, species):
+        species = np.atleast_2d(species)
+        values = [p.value for p in self.model.parameters]
+        return [species[:, i] for i in range(species.shape[1])] + values
+
+    def fluxes(self, species):
+        """Reaction fluxes, shape (time, reactions)."""
+        n_times = np.atleast_2d(species).shape[0]
+        return np.column_stack([
+            np.broadcast_to(np.asarray(v, dtype=float), (n_times,))
+            for v in self._rate_fn(*self._arguments(species))
+        ])
+
+    def rate_derivatives(self, species):
+        """Nonzero d(rate)/d(species) at each time, (time, entries)."""
+        n_times = np.atleast_2d(species).shape[0]
+        if not len(self.derivative_index):
+            return np.zeros((n_times, 0))
+        return np.column_stack([
+            np.broadcast_to(np.asarray(v, dtype=float), (n_times,))
+            for v in self._derivative_fn(*self._arguments(species))
+        ])
+
+    def jacobians(self, species):
+        """Jacobians N * dv/dx at each time, (time, species, species)."""
+        from scipy.sparse import csr_matrix
+
+        derivatives = self.rate_derivatives(species)
+        shape = (len(self.rates), len(self.model.species))
+        jacobians = []
+        for row in derivatives:
+            # the rate Jacobian is sparse, each rate has few reactants
+            rate_jacobian = csr_matrix(
+                (row, (self.derivative_index[:, 0],
+                       self.derivative_index[:, 1])), shape=shape
+            )
+            jacobians.append((rate_jacobian.T @ self.stoichiometry.T).T)
+        return np.array(jacobians)
+
+    def evaluation_cost(self):
+        """Relative RHS cost of each reaction.
+
+        Counted as the operations of the rate law plus one update per
+        species whose derivative the reaction changes.
+        """
+        import sympy
+
+        cost = np.array([
+            sympy.count_ops(rate) + np.count_nonzero(self.stoichiometry[:, r])
+            for r, rate in enumerate(self.rates)
+        ], dtype=float)
+        return cost / cost.sum()
+
+
+def stiffness(jacobians):
+    """Eigenvalue-based stiffness of each Jacobian.
+
+    Returns (stiffness ratio, fastest rate): the ratio of the largest to the
+    smallest nonzero magnitude of the eigenvalues' real parts, and the
+    largest magnitude itself (inverse of the fastest time scale).
+    """
+    ratios, fastest = [], []
+    for jacobian in jacobians:
+        real = np.abs(np.linalg.eigvals(jacobian).real)
+        nonzero = real[real > 1e-12 * max(real.max(), 1e-300)]
+        fastest.append(real.max())
+        ratios.append(nonzero.max() / nonzero.min() if len(nonzero)
+                      else np.nan)
+    return np.array(ratios), np.array(fastest)
+
+
+def analyze_fluxes(flux_model, time, species,
+                   n_stiffness_points=DEFAULT_STIFFNESS_POINTS):
+    """Fluxes, rule fluxes, costs and stiffness of one trajectory."""
+    fluxes = flux_model.fluxes(species)
+    rules = sorted(set(flux_model.reaction_rules))
+    membership = np.zeros((len(flux_model.rates), len(rules)))
+    membership[np.arange(len(flux_model.rates)),
+               [rules.index(rule) for rule in flux_model.reaction_rules]] = 1
+    rule_fluxes = fluxes @ membership
+
+    points = np.unique(np.linspace(0, len(time) - 1,
+                                   n_stiffness_points).astype(int))
+    jacobians = flux_model.jacobians(species[points])
+    ratio, fastest = stiffness(jacobians)
+
+    # fastest time scale each reaction imposes on the species it changes
+    derivatives = np.abs(flux_model.rate_derivatives(species[points]))
+    reaction_rate_scale = np.zeros(len(flux_model.rates))
+    if derivatives.size:
+        np.maximum.at(reaction_rate_scale,
+                      flux_model.derivative_index[:, 0],
+                      derivatives.max(axis=0))
+
+    return {
+        'fluxes': fluxes,
+        'rules': rules,
+        'rule_fluxes': rule_fluxes,
+        'stiffness_time': np.asarray(time)[points],
+        'stiffness_ratio': ratio,
+        'fastest_rate': fastest,
+        'reaction_rate_scale': reaction_rate_scale,
+    }
+
+
+def write_flux_file(output_file, flux_model, results, attrs=None):
+    """Store flux results compactly: float32, compressed, names once."""
+    import h5py
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        for name in ['fluxes', 'rule_fluxes']:
+            f.create_dataset(name, data=results[name].astype('f4'),
+                             compression='gzip', shuffle=True)
+        for name in ['stiffness_time', 'stiffness_ratio', 'fastest_rate',
+                     'reaction_rate_scale']:
+            f.create_dataset(name, data=results[name])
+        f.create_dataset('rules', data=np.array(results['rules'], dtype='S'))
+        f.create_dataset('reaction_rules', data=np.array(
+            flux_model.reaction_rules, dtype='S'))
+        f.create_dataset('reactions', data=np.array(
+            flux_model.reaction_names, dtype='S'))
+        f.create_dataset('reaction_cost', data=flux_model.evaluation_cost())
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def rule_summary(flux_file):
+    """Per-rule table of mean absolute flux, RHS cost and fastest rate."""
+    import h5py
+    import pandas as pd
+
+    with h5py.File(flux_file, 'r') as f:
+        rules = f['rules'][:].astype(str)
+        reaction_rules = f['reaction_rules'][:].astype(str)
+        rule_fluxes = f['rule_fluxes'][:]
+        cost = f['reaction_cost'][:]
+        rate_scale = f['reaction_rate_scale'][:]
+    table = pd.DataFrame({
+        'rule': rules,
+        'mean_abs_flux': np.abs(rule_fluxes).mean(axis=0),
+    }).set_index('rule')
+    per_reaction = pd.DataFrame({'rule': reaction_rules, 'cost': cost,
+                                 'rate_scale': rate_scale})
+    grouped = per_reaction.groupby('rule')
+    table['cost'] = grouped['cost'].sum()
+    table['n_reactions'] = grouped.size()
+    table['max_rate_scale'] = grouped['rate_scale'].max()
+    return table.sort_values('mean_abs_flux', ascending=False)
+
+
+def analyze_store(store_dir, n_stiffness_points=DEFAULT_STIFFNESS_POINTS,
+                  force=False):
+    """Write flux files for all completed results of a store."""
+    import h5py
+    from model_cache import load_model
+
+    model = load_model(MODEL_NAME, MODEL_VARIANT)
+    flux_model = None
+    n_written = 0
+    for key, entry in read_manifest(store_dir).items():
+        if entry['status'] != STATUS_DONE:
+            continue
+        flux_file = get_flux_file(store_dir, key)
+        if not force and os.path.exists(flux_file):
+            continue
+        with h5py.File(get_results_file(store_dir, key), 'r') as f:
+            time = f['time'][:].flatten()
+            species = read_trajectories(f)
+            condition = make_condition(
+                str(f.attrs['cell_line']), f.attrs['meki_concentration'],
+                f.attrs['egf_concentration'],
+                f.attrs.get('rafi_concentration', 0.0),
+                f.attrs.get('prafi_concentration', 0.0)
+            )
+        # rate laws use the parameter values of the condition
+        configure_model(model, condition)
+        if flux_model is None:
+            flux_model = FluxModel(model)
+        results = analyze_fluxes(flux_model, time, species,
+                                 n_stiffness_points)
+        write_flux_file(flux_file, flux_model, results,
+                        {'run_hash': entry['hash']})
+        n_written += 1
+    logger.info(f"Wrote {n_written} flux files to "
+                f"{os.path.join(store_dir, 'fluxes')}")
+    return n_written
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Per-reaction and per-rule fluxes, RHS cost and '
+                    'stiffness of stored trajectories'
+    )
+    parser.add_argument('--store', type=str, default='results/sweep')
+    parser.add_argument('--stiffness-points', type=int,
+                        default=DEFAULT_STIFFNESS_POINTS)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='Print the rule summary of this condition key')
+    args = parser.parse_args()
+
+    if args.summary:
+        print(rule_summary(get_flux_file(args.store, args.summary))
+              .to_string())
+    else:
+        analyze_store(args.store, args.stiffness_points, args.force)
@@ -0,0 +1,152 @@
+"""Content-hashed run manifest of a result store.
+
+A result store is a directory holding one ``<key>.h5`` results file per
+condition. Next to it, ``manifest/<key>.json`` records the hash of everything
+that determines that result (model, parameter vector, condition, time points
+and integrator options) and whether the run is in progress or done. Entries
+are written with an atomic rename, one file per key, so concurrent workers
+never clobber each other's bookkeeping.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def get_manifest_dir(store_dir):
+    return os.path.join(store_dir, 'manifest')
+
+
+def get_entry_file(store_dir, key):
+    return os.path.join(get_manifest_dir(store_dir), f'{key}.json')
+
+
+def get_results_file(store_dir, key):
+    return os.path.join(store_dir, f'{key}.h5')
+
+
+def compute_run_hash(model_hash, parameter_names, parameter_values, condition,
+                     tspan, integrator, integrator_options):
+    """Hash all inputs that determine a simulation result."""
+    digest = hashlib.sha256()
+    digest.update(str(model_hash).encode())
+    digest.update(json.dumps(list(parameter_names)).encode())
+    digest.update(np.ascontiguousarray(parameter_values,
+                                       dtype=np.float64).tobytes())
+    digest.update(json.dumps(condition, sort_keys=True, default=str).encode())
+    digest.update(np.ascontiguousarray(tspan, dtype=np.float64).tobytes())
+    digest.update(str(integrator).encode())
+    digest.update(json.dumps(integrator_options, sort_keys=True,
+                             default=str).encode())
+    return digest.hexdigest()
+
+
+def get_run_hash(model, model_hash, condition, tspan, integrator,
+                 integrator_options):
+    """Run hash of a configured PySB model for one condition."""
+    return compute_run_hash(
+        model_hash,
+        [p.name for p in model.parameters],
+        [p.value for p in model.parameters],
+        condition,
+        tspan,
+        integrator,
+        integrator_options,
+    )
+
+
+def _write_entry(store_dir, key, entry):
+    entry_file = get_entry_file(store_dir, key)
+    os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+    tmp_file = f'{entry_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(tmp_file, entry_file)
+
+
+def read_entry(store_dir, key):
+    try:
+        with open(get_entry_file(store_dir, key)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def read_manifest(store_dir):
+    """Return all manifest entries of a store, keyed by condition key."""
+    manifest_dir = get_manifest_dir(store_dir)
+    if not os.path.isdir(manifest_dir):
+        return {}
+    entries = {}
+    for filename in sorted(os.listdir(manifest_dir)):
+        if filename.endswith('.json'):
+            key = filename[:-len('.json')]
+            entry = read_entry(store_dir, key)
+            if entry is not None:
+                entries[key] = entry
+    return entries
+
+
+def is_complete(store_dir, key, run_hash):
+    """Whether a valid result for exactly these inputs already exists."""
+    entry = read_entry(store_dir, key)
+    return entry is not None \
+        and entry['status'] == STATUS_DONE \
+        and entry['hash'] == run_hash \
+        and os.path.exists(get_results_file(store_dir, key))
+
+
+def mark_running(store_dir, key, run_hash):
+    _write_entry(store_dir, key, {
+        'status': STATUS_RUNNING,
+        'hash': run_hash,
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'started': time.time(),
+    })
+
+
+def mark_done(store_dir, key, run_hash, metadata=None):
+    entry = read_entry(store_dir, key) or {}
+    entry.update(metadata or {})
+    entry.update({
+        'status': STATUS_DONE,
+        'hash': run_hash,
+        'finished': time.time(),
+    })
+    _write_entry(store_dir, key, entry)
+
+
+def mark_failed(store_dir, key, run_hash, metadata=None):
+    entry = read_entry(store_dir, key) or {}
+    entry.update(metadata or {})
+    entry.update({
+        'status': STATUS_FAILED,
+        'hash': run_hash,
+        'finished': time.time(),
+    })
+    _write_entry(store_dir, key, entry)
+
+
+def is_failed(store_dir, key, run_hash):
+    """Whether the solver already failed on exactly these inputs."""
+    entry = read_entry(store_dir, key)
+    return entry is not None \
+        and entry['status'] == STATUS_FAILED \
+        and entry['hash'] == run_hash
+
+
+def get_interrupted(store_dir):
+    """Keys of runs that were started but never finished."""
+    return [key for key, entry in read_manifest(store_dir).items()
+            if entry['status'] == STATUS_RUNNING]
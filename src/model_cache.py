@@ -0,0 +1,238 @@
+import copy
+import hashlib
+import importlib
+import json
+import logging
+import os
+import pickle
+
+from paths import (DATASET, get_directory, get_model_compile_dir,
+                   get_model_module_dir_dataset, get_model_name_dataset,
+                   get_model_name_variant, get_model_snapshot_file)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 2
+
+# models restored in this process, keyed by (name, variant, modifications)
+_loaded_models = {}
+
+
+def get_model_source_file(name, variant):
+    return os.path.join(get_directory(), 'models',
+                        f'{get_model_name_variant(name, variant)}.py')
+
+
+def get_modification_file(modification):
+    return os.path.join(get_directory(), 'models', 'modifications',
+                        f'{modification}.json')
+
+
+def normalize_modifications(modifications):
+    """Sorted, underscore-joined modification set, or None if empty."""
+    if not modifications:
+        return None
+    if isinstance(modifications, str):
+        modifications = modifications.split('_')
+    return '_'.join(sorted(set(modifications)))
+
+
+def load_modifications(modifications):
+    """Merged parameter overrides of a modification set.
+
+    Every modification is a JSON file mapping parameter names to values.
+    Modifications are applied in sorted order, so later names win.
+    """
+    overrides = {}
+    modifications = normalize_modifications(modifications)
+    if modifications is None:
+        return overrides
+    for modification in modifications.split('_'):
+        with open(get_modification_file(modification)) as f:
+            overrides.update(json.load(f))
+    return overrides
+
+
+def apply_modifications(model, overrides):
+    """Set parameter overrides on a model and record them on it.
+
+    The condition registry applies the recorded overrides after the values
+    of the parameter tables, which would otherwise replace them.
+    """
+    for parameter, value in overrides.items():
+        model.parameters[parameter].value = value
+    model.parameter_overrides = dict(overrides)
+    return model
+
+
+def get_parameter_overrides(model):
+    """Parameter overrides of a modified model instance, or {}."""
+    return getattr(model, 'parameter_overrides', {})
+
+
+def expand_expression(model, expression):
+    """Rate law or initial value in species and parameters only.
+
+    Expressions are substituted and observables expanded into species sums.
+    """
+    return expression.xreplace({
+        e: e.expand_expr(expand_observables=True) for e in model.expressions
+    }).xreplace({
+        o: o.expand_obs() for o in model.observables
+    })
+
+
+def hash_model_source(name, variant, modifications=None):
+    """Hash of the flat model module, used to invalidate stale snapshots.
+
+    With modifications, their parameter overrides are part of the hash.
+    """
+    with open(get_model_source_file(name, variant), 'rb') as f:
+        source_hash = hashlib.sha256(f.read())
+    overrides = load_modifications(modifications)
+    if overrides:
+        source_hash.update(json.dumps(overrides, sort_keys=True).encode())
+    return source_hash.hexdigest()
+
+
+def get_snapshot_file(name, variant, modifications=None):
+    """Snapshot of a variant, or of a modified instance in its build dir."""
+    modifications = normalize_modifications(modifications)
+    if modifications is None:
+        return get_model_snapshot_file(name, variant)
+    full_name = get_model_name_dataset(name, variant, DATASET, modifications)
+    return os.path.join(
+        get_model_module_dir_dataset(name, variant, DATASET, modifications),
+        f'{full_name}.pkl'
+    )
+
+
+def use_persistent_compile_dir(name, variant):
+    """Keep compiled Cython RHS modules next to the model snapshot.
+
+    Cython.inline caches compiled modules by code hash, so pointing its cache
+    at the build directory lets every task reuse the extension that the first
+    task compiled instead of recompiling it in a fresh home directory.
+    """
+    compile_dir = get_model_compile_dir(name, variant)
+    os.makedirs(compile_dir, exist_ok=True)
+    os.environ.setdefault('CYTHON_CACHE_DIR', compile_dir)
+    return compile_dir
+
+
+def build_model_snapshot(name='RTKERK', variant='pRAF', modifications=None):
+    """Import the flat model, generate its network and pickle the result.
+
+    A modified instance is a copy of the variant's network with the
+    parameter overrides of its modifications applied.
+    """
+    import pysb
+    import pysb.bng
+    from registry import MIN_CONC
+
+    modifications = normalize_modifications(modifications)
+    if modifications is None:
+        logger.info(f"Building model snapshot for "
+                    f"{get_model_name_variant(name, variant)}")
+        module = importlib.import_module(
+            f'models.{get_model_name_variant(name, variant)}'
+        )
+        model = module.model
+        # BioNetGen evaluates expressions such as log(kf) while generating
+        # the network, so zero defaults are raised for the generation only
+        zeros = [p for p in model.parameters if p.value == 0]
+        for parameter in zeros:
+            parameter.value = MIN_CONC
+        try:
+            pysb.bng.generate_equations(model)
+        finally:
+            for parameter in zeros:
+                parameter.value = 0.0
+    else:
+        full_name = get_model_name_dataset(name, variant, DATASET,
+                                           modifications)
+        logger.info(f"Building model snapshot for {full_name}")
+        # start from the stored network, not an instance that callers of
+        # load_model may have configured
+        model = read_model_snapshot(name, variant)
+        if model is None:
+            model = copy.deepcopy(build_model_snapshot(name, variant))
+        apply_modifications(model, load_modifications(modifications))
+
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'source_hash': hash_model_source(name, variant, modifications),
+        'pysb_version': pysb.__version__,
+        'model': model,
+    }
+    snapshot_file = get_snapshot_file(name, variant, modifications)
+    os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+    tmp_file = f'{snapshot_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+    logger.info(f"Model snapshot saved to {snapshot_file}")
+    return model
+
+
+def read_model_snapshot(name='RTKERK', variant='pRAF', modifications=None):
+    """Return the snapshotted model, or None if missing or stale."""
+    snapshot_file = get_snapshot_file(name, variant, modifications)
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"Could not read model snapshot {snapshot_file}: {e}")
+        return None
+
+    import pysb
+    if snapshot.get('format') != SNAPSHOT_FORMAT \
+            or snapshot.get('pysb_version') != pysb.__version__ \
+            or snapshot.get('source_hash') != hash_model_source(
+                name, variant, modifications):
+        logger.info(f"Model snapshot {snapshot_file} is stale")
+        return None
+    return snapshot['model']
+
+
+def load_model(name='RTKERK', variant='pRAF', rebuild=False,
+               modifications=None):
+    """Load a network-generated model, restoring it from its snapshot.
+
+    The model is built (module import plus BioNetGen network generation) only
+    if no valid snapshot exists. Within a process the model is restored once;
+    callers that mutate parameters should work on the returned instance.
+    Modified instances share the variant's network and compiled RHS.
+    """
+    modifications = normalize_modifications(modifications)
+    key = (name, variant, modifications)
+    if key in _loaded_models and not rebuild:
+        return _loaded_models[key]
+
+    use_persistent_compile_dir(name, variant)
+    model = None if rebuild else read_model_snapshot(name, variant,
+                                                     modifications)
+    if model is None:
+        model = build_model_snapshot(name, variant, modifications)
+    else:
+        logger.info(f"Restored {get_model_name_variant(name, variant)} "
+                    f"{modifications or ''} from snapshot")
+    _loaded_models[key] = model
+    return model
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Build the pickled model snapshot ahead of array jobs'
+    )
+    parser.add_argument('--model-name', type=str, default='RTKERK')
+    parser.add_argument('--variant', type=str, default='pRAF')
+    parser.add_argument('--modifications', type=str, default=None,
+                        help='Underscore-separated modification set')
+    args = parser.parse_args()
+
+    build_model_snapshot(args.model_name, args.variant, args.modifications)
@@ -0,0 +1,203 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from paths import get_parameter_store_file, get_parameters_file
+
+logger = logging.getLogger(__name__)
+
+# stores opened in this process, keyed by file name
+_open_stores = {}
+
+
+def _source_signature(csv_file):
+    stat = os.stat(csv_file)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype='i8')
+
+
+def write_parameter_store(store_file, names, values, labels, fval=None,
+                          source_signature=None):
+    """Write a multistart table as a contiguous HDF5 parameter matrix.
+
+    The matrix is stored unchunked and uncompressed so readers can memory-map
+    it. fval_order holds the row positions sorted by fval, NaN last.
+    """
+    import h5py
+
+    values = np.ascontiguousarray(values, dtype='f8')
+    if fval is None:
+        fval = np.full(len(values), np.nan)
+    fval = np.asarray(fval, dtype='f8')
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    tmp_file = f'{store_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('parameters', data=values)
+        f.create_dataset('names', data=np.array(names, dtype='S'))
+        labels = np.asarray(labels)
+        if labels.dtype.kind in 'OU':
+            labels = labels.astype('S')
+        f.create_dataset('labels', data=labels)
+        f.create_dataset('fval', data=fval)
+        f.create_dataset('fval_order', data=np.argsort(fval, kind='stable'))
+        if source_signature is not None:
+            f.attrs['source_signature'] = source_signature
+    os.replace(tmp_file, store_file)
+    return store_file
+
+
+def import_csv(csv_file, store_file):
+    """Convert a multistart CSV (index column, fval, parameters) to a store."""
+    import pandas as pd
+
+    table = pd.read_csv(csv_file, index_col=0)
+    fval = table.pop('fval').to_numpy() if 'fval' in table else None
+    logger.info(f"Importing {len(table)} parameter sets from {csv_file}")
+    return write_parameter_store(store_file, list(table.columns),
+                                 table.to_numpy(dtype=float),
+                                 table.index.to_numpy(), fval,
+                                 _source_signature(csv_file))
+
+
+class ParameterStore:
+    """Read access to a parameter store.
+
+    The parameter matrix is memory-mapped, so rows and columns are only read
+    from disk when used and pages are shared between worker processes.
+    """
+
+    def __init__(self, store_file):
+        import h5py
+
+        self.store_file = store_file
+        with h5py.File(store_file, 'r') as f:
+            dataset = f['parameters']
+            self.names = list(f['names'][:].astype(str))
+            self.labels = f['labels'][:]
+            if self.labels.dtype.kind == 'S':
+                self.labels = self.labels.astype(str)
+            self.fval = f['fval'][:]
+            self.fval_order = f['fval_order'][:]
+            self.source_signature = f.attrs.get('source_signature')
+            offset = dataset.id.get_offset()
+            shape, dtype = dataset.shape, dataset.dtype
+            if offset is None:
+                # empty or not contiguous, fall back to reading it
+                self._matrix = dataset[:]
+        if offset is not None:
+            self._matrix = np.memmap(store_file, mode='r', dtype=dtype,
+                                     shape=shape, offset=offset)
+        self._columns = {name: j for j, name in enumerate(self.names)}
+        self._rows = {label: i for i, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    @property
+    def matrix(self):
+        """Parameter matrix of shape (parameter sets, parameters)."""
+        return self._matrix
+
+    def column(self, name):
+        return self._matrix[:, self._columns[name]]
+
+    def columns(self, names):
+        return self._matrix[:, [self._columns[name] for name in names]]
+
+    def position(self, label):
+        """Row position of a label of the original CSV index."""
+        return self._rows[label]
+
+    def row(self, position):
+        """Parameter values of one row as a dict."""
+        return dict(zip(self.names, self._matrix[position]))
+
+    def top_k(self, k, max_fval=None):
+        """Row positions of the k best parameter sets by fval."""
+        order = self.fval_order[:k]
+        if max_fval is not None:
+            order = order[self.fval[order] <= max_fval]
+        return order
+
+    def as_dataframe(self, positions=None):
+        import pandas as pd
+
+        if positions is None:
+            positions = np.arange(len(self))
+        table = pd.DataFrame(np.asarray(self._matrix[positions]),
+                             columns=self.names,
+                             index=self.labels[positions])
+        table.insert(0, 'fval', self.fval[positions])
+        return table
+
+
+def export_csv(store_file, csv_file):
+    """Write a store back to the multistart CSV format."""
+    ParameterStore(store_file).as_dataframe().to_csv(csv_file)
+    return csv_file
+
+
+def open_parameter_store(model_name, variant, dataset):
+    """Open the store of a parameter table, importing its CSV if needed.
+
+    The store is re-imported whenever the CSV changed since the last import,
+    so the CSV remains the file that optimizations write and users edit.
+    """
+    csv_file = get_parameters_file(model_name, variant, dataset)
+    store_file = get_parameter_store_file(model_name, variant, dataset)
+
+    store = _open_stores.get(store_file)
+    signature = _source_signature(csv_file) \
+        if os.path.exists(csv_file) else None
+    if store is not None and (signature is None or np.array_equal(
+            store.source_signature, signature)):
+        return store
+
+    if signature is not None:
+        try:
+            store = ParameterStore(store_file)
+        except (OSError, KeyError):
+            store = None
+        if store is None or not np.array_equal(store.source_signature,
+                                               signature):
+            import_csv(csv_file, store_file)
+            store = ParameterStore(store_file)
+    else:
+        store = ParameterStore(store_file)
+    _open_stores[store_file] = store
+    return store
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Convert between multistart CSV files and parameter '
+                    'stores'
+    )
+    parser.add_argument('command', choices=['import', 'export', 'top'])
+    parser.add_argument('--model-name', type=str, default='RTKERK')
+    parser.add_argument('--variant', type=str, default='pRAF')
+    parser.add_argument('--dataset', type=str,
+                        default='EGF_EGFR_MEKi_PRAFi_RAFi')
+    parser.add_argument('--csv', type=str, default=None,
+                        help='CSV file (default: the parameters file)')
+    parser.add_argument('-k', type=int, default=10,
+                        help='Number of parameter sets shown by top')
+    args = parser.parse_args()
+
+    csv_file = args.csv or get_parameters_file(args.model_name, args.variant,
+                                               args.dataset)
+    store_file = get_parameter_store_file(args.model_name, args.variant,
+                                          args.dataset)
+    if args.command == 'import':
+        import_csv(csv_file, store_file)
+    elif args.command == 'export':
+        export_csv(store_file, csv_file)
+    else:
+        store = open_parameter_store(args.model_name, args.variant,
+                                     args.dataset)
+        print(store.as_dataframe(store.top_k(args.k))[['fval']].to_string())
@@ -3,33 +3,23 @@ import os
 import pandas as pd
 import numpy as np
 
-from paths import get_parameters_file
+from parameter_store import import_csv, open_parameter_store
+from paths import get_parameter_store_file, get_parameters_file
+from registry import specialise_par_name
 
 
-def specialise_par_name(name, panrafi, rafi, meki):
-
-    if panrafi is not None:
-        name = name.replace('PRAFi', panrafi)
-
-    if rafi is not None:
-        name = name.replace('RAFi', rafi)
-
-    if meki is not None:
-        name = name.replace('MEKi', meki)
-
-    return name
-
 def load_parameters(model, settings, prafi, rafi, meki, index=0,
                     allow_missing_pars=False):
-    df_parameters = load_parameters_as_dataframe(settings['model_name'],
-                                               settings['variant'],
-                                               settings['dataset'])
+    store = open_parameter_store(settings['model_name'],
+                                 settings['variant'],
+                                 settings['dataset'])
+    values = store.row(store.position(index))
 
     par = []
     for name in model.parameters.keys():  # Using PySB's parameter interface
         specialized_name = specialise_par_name(name, prafi, rafi, meki)
-        if specialized_name in df_parameters:
-            val = df_parameters.loc[index, specialized_name]
+        if specialized_name in values:
+            val = values[specialized_name]
             model.parameters[name].value = val  # Set parameter using PySB
         elif allow_missing_pars:
             val = model.parameters[name].value
@@ -43,12 +33,11 @@ def load_parameters(model, settings, prafi, rafi, meki, index=0,
 def load_pysb_parameters(model, model_name, variant, dataset, index=0,
                          allow_missing_pars=False):
 
-    df_parameters = load_parameters_as_dataframe(model_name, variant, dataset)
+    values = open_parameter_store(model_name, variant, dataset).row(index)
 
     for par_name in model.parameters.keys():
-        if par_name in df_parameters:
-            model.parameters[par_name].value = \
-                df_parameters[par_name].values[index]
+        if par_name in values:
+            model.parameters[par_name].value = values[par_name]
         elif allow_missing_pars:
             raise RuntimeError(f'Model parameter {par_name} was not estimated')
 
@@ -75,6 +64,9 @@ def save_parameters(result, model_name, variant, dataset):
         for i in range(result.problem.dim_full)
     })
     parameters_export = pd.DataFrame(parameter_dict)
-    parameters_export.to_csv(get_parameters_file(model_name, variant, dataset))
+    parameter_file = get_parameters_file(model_name, variant, dataset)
+    parameters_export.to_csv(parameter_file)
+    import_csv(parameter_file,
+               get_parameter_store_file(model_name, variant, dataset))
 
     return parameters_export
@@ -1,5 +1,8 @@
 import os
 
+# dataset of the model instances that are built and simulated
+DATASET = 'EGF_EGFR_MEKi_PRAFi_RAFi'
+
 
 def get_directory():
     return os.path.dirname(__file__)
@@ -52,6 +55,11 @@ def get_multimodel_speedup_result_file(model, variant, dataset, index):
                         f'{dataset}_multimodel_objective_{index}.csv')
 
 
+def get_profile_file(model, variant, dataset, parameter, index):
+    return os.path.join(get_profile_dir(model, variant),
+                        f'{dataset}_profile_{parameter}_{index:03}.csv')
+
+
 def get_model_variant_file(name, variant):
     full_name = get_model_name_variant(name, variant)
     return os.path.join(
@@ -84,6 +92,11 @@ def get_parameters_file(model, variant, dataset):
     return os.path.join(par_dir, f'{model}_{variant}_{dataset}.csv')
 
 
+def get_parameter_store_file(model, variant, dataset):
+    return os.path.splitext(get_parameters_file(model, variant, dataset))[0] \
+        + '.h5'
+
+
 def get_model_module_file_instance(name, variant, instance,
                                    modifications=None):
     full_name = get_model_instance_name(name, variant, instance, modifications)
@@ -123,6 +136,19 @@ def get_model_instance_name(name, variant, instance, modifications):
     return full_name
 
 
+def parse_model_instance_name(full_name):
+    """(name, variant, instance, modifications) of a name made by
+    get_model_instance_name or get_model_name_variant.
+
+    instance and modifications are None where the name has none.
+    """
+    parts = full_name.split('__')
+    name, variant = parts[:2]
+    instance = parts[2] if len(parts) > 2 else None
+    modifications = parts[3] or None if len(parts) > 3 else None
+    return name, variant, instance, modifications
+
+
 def get_model_name_dataset(name, variant, dataset, modifications=None):
     return get_model_instance_name(name, variant, dataset_to_instance(dataset),
                                    modifications)
@@ -134,3 +160,33 @@ def dataset_to_instance(dataset):
         for pert in dataset.split('_')
         if pert in ['EGF', 'NRAS', 'RAFi', 'PRAFi', 'MEKi']
     )
+
+
+def get_model_snapshot_file(name, variant):
+    full_name = get_model_name_variant(name, variant)
+    return os.path.join(
+        get_directory(),
+        'build',
+        full_name,
+        f'{full_name}.pkl'
+    )
+
+
+def get_model_compile_dir(name, variant):
+    full_name = get_model_name_variant(name, variant)
+    return os.path.join(
+        get_directory(),
+        'build',
+        full_name,
+        'cython',
+    )
+
+
+def get_model_batched_dir(name, variant):
+    full_name = get_model_name_variant(name, variant)
+    return os.path.join(
+        get_directory(),
+        'build',
+        full_name,
+        'batched',
+    )
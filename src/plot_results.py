@@ -1,72 +1,256 @@
 import h5py
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 from pathlib import Path
 import logging
+import os
+
+from codec import read_trajectories
 
 logger = logging.getLogger(__name__)
 
-def plot_cell_trajectories(results_file, n_cells_to_plot=1):
-    """Plot trajectories from simulation results."""
+# (label, species index, panel title) of the species shown per condition
+TRAJECTORY_SPECIES = [
+    ('pERK', 16, 'ERK Phosphorylation'),
+    ('pMEK', 14, 'MEK Phosphorylation'),
+    ('gtpRAS', 8, 'RAS Activity'),
+]
+
+# Figures are expensive to set up, so pool workers keep one per layout and
+# only swap the data before saving; other callers close it after saving
+_figure_templates = {}
+
+
+def close_figure_template(name):
+    if name in _figure_templates:
+        plt.close(_figure_templates.pop(name)[0])
+
+
+def read_results(results_file):
+    """Read time, trajectories and condition metadata from a results file."""
     with h5py.File(results_file, 'r') as f:
         time = f['time'][:].flatten()  # Ensure 1D array
-        trajectories = f['trajectories'][:]
-        # Try to get metadata if it exists
-        cell_type = f.attrs.get('cell_line', 'unknown')
-        meki_conc = f.attrs.get('meki_concentration', 0)
-        egf_conc = f.attrs.get('egf_concentration', 0)
-    
-    # Create results directory if it doesn't exist
-    results_dir = Path('results')
-    results_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Create figure with subplots
-    fig = plt.figure(figsize=(15, 10))
-    gs = GridSpec(2, 2, figure=fig)
-    
-    # Plot with condition information in title
-    title = f"{cell_type.upper()} cells\nMEKi: {meki_conc:.1f}, EGF: {egf_conc:.1f}"
-    fig.suptitle(title, fontsize=12)
-    
-    # Create subplots
-    ax1 = fig.add_subplot(gs[0, 0])
-    ax2 = fig.add_subplot(gs[0, 1])
-    ax3 = fig.add_subplot(gs[1, :])
-    
-    # Plot key species (ensure 1D arrays)
-    ax1.plot(time, trajectories[:, 16], alpha=0.7, label='pERK')
-    ax2.plot(time, trajectories[:, 14], alpha=0.7, label='pMEK')
-    ax3.plot(time, trajectories[:, 8], alpha=0.7, label='gtpRAS')
-    
-    # Customize plots
-    ax1.set_title('ERK Phosphorylation')
-    ax1.set_xlabel('Time (min)')  # Changed to minutes
-    ax1.set_ylabel('Concentration')
-    ax1.legend()
-    
-    ax2.set_title('MEK Phosphorylation')
-    ax2.set_xlabel('Time (min)')  # Changed to minutes
-    ax2.set_ylabel('Concentration')
-    ax2.legend()
-    
-    ax3.set_title('RAS Activity')
-    ax3.set_xlabel('Time (min)')  # Changed to minutes
-    ax3.set_ylabel('Concentration')
-    ax3.legend()
-    
-    plt.tight_layout()
-    plot_path = results_dir / 'trajectories.png'
-    plt.savefig(plot_path, dpi=300)
-    plt.close()
+        trajectories = read_trajectories(f)
+        attrs = {
+            'cell_line': f.attrs.get('cell_line', 'unknown'),
+            'meki_concentration': f.attrs.get('meki_concentration', 0),
+            'egf_concentration': f.attrs.get('egf_concentration', 0),
+        }
+    return time, trajectories, attrs
+
+
+def condition_title(attrs):
+    return (f"{str(attrs['cell_line']).upper()} cells\n"
+            f"MEKi: {attrs['meki_concentration']:.1f}, "
+            f"EGF: {attrs['egf_concentration']:.1f}")
+
+
+def is_stale(plot_path, *data_files):
+    """Whether a figure is missing or older than any of its data files."""
+    plot_path = Path(plot_path)
+    if not plot_path.exists():
+        return True
+    plot_mtime = plot_path.stat().st_mtime
+    return any(Path(f).stat().st_mtime > plot_mtime for f in data_files)
+
+
+def _get_trajectory_template():
+    if 'trajectories' not in _figure_templates:
+        # Create figure with subplots
+        fig = plt.figure(figsize=(15, 10))
+        gs = GridSpec(2, 2, figure=fig)
+        fig.suptitle('', fontsize=12)
+
+        axes = [
+            fig.add_subplot(gs[0, 0]),
+            fig.add_subplot(gs[0, 1]),
+            fig.add_subplot(gs[1, :]),
+        ]
+        lines = []
+        for ax, (label, _, title) in zip(axes, TRAJECTORY_SPECIES):
+            line, = ax.plot([], [], alpha=0.7, label=label)
+            lines.append(line)
+            ax.set_title(title)
+            ax.set_xlabel('Time (min)')
+            ax.set_ylabel('Concentration')
+            ax.legend()
+        # Fixed layout instead of tight_layout on every save
+        fig.subplots_adjust(left=0.07, right=0.97, bottom=0.07, top=0.88,
+                            wspace=0.25, hspace=0.35)
+        _figure_templates['trajectories'] = (fig, axes, lines)
+    return _figure_templates['trajectories']
+
+
+def render_trajectory_figure(time, trajectories, attrs, plot_path, dpi=300,
+                             keep_template=False):
+    """Draw the pERK/pMEK/gtpRAS panels for one condition into plot_path.
+
+    With keep_template, the figure stays open for the next call.
+    """
+    fig, axes, lines = _get_trajectory_template()
+    fig.suptitle(condition_title(attrs), fontsize=12)
+    for ax, line, (_, index, _) in zip(axes, lines, TRAJECTORY_SPECIES):
+        line.set_data(time, trajectories[:, index])
+        ax.relim()
+        ax.autoscale_view()
+
+    plot_path = Path(plot_path)
+    plot_path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(plot_path, dpi=dpi)
+    if not keep_template:
+        close_figure_template('trajectories')
+    return plot_path
+
+
+def plot_cell_trajectories(results_file, n_cells_to_plot=1, plot_path=None,
+                           dpi=300):
+    """Plot trajectories from simulation results."""
+    time, trajectories, attrs = read_results(results_file)
+    if plot_path is None:
+        plot_path = Path('results') / 'trajectories.png'
+    plot_path = render_trajectory_figure(time, trajectories, attrs, plot_path,
+                                         dpi=dpi)
     logger.info(f"Plot saved to {plot_path}")
+    return plot_path
+
+
+def get_condition_figure_dir(figure_dir, results_file):
+    """Per-condition figure directory, named after the results file."""
+    return Path(figure_dir) / Path(results_file).stem
+
+
+def render_results_file(task):
+    """Render all per-condition figures of one results file (pool worker).
+
+    Templates are kept open between tasks; they are released when the pool
+    terminates its workers.
+    Returns the condition metadata together with the pERK summary values used
+    for the dose-response figures.
+    """
+    from postprocess import render_species_figure
+
+    results_file, figure_dir, dpi, force = task
+    condition_dir = get_condition_figure_dir(figure_dir, results_file)
+    trajectory_path = condition_dir / 'trajectories.png'
+    species_path = condition_dir / 'species_trajectories.png'
+
+    time, trajectories, attrs = read_results(results_file)
+    if force or is_stale(trajectory_path, results_file):
+        render_trajectory_figure(time, trajectories, attrs, trajectory_path,
+                                 dpi=dpi, keep_template=True)
+    if force or is_stale(species_path, results_file):
+        render_species_figure(time, trajectories, attrs, species_path, dpi=dpi,
+                              keep_template=True)
+
+    perk = trajectories[:, TRAJECTORY_SPECIES[0][1]]
+    return dict(
+        attrs,
+        results_file=str(results_file),
+        peak_perk=float(np.max(perk)),
+        final_perk=float(perk[-1]),
+    )
+
+
+def render_dose_response_figure(task):
+    """Plot peak and final pERK against MEKi for one cell line (pool worker)."""
+    cell_line, summaries, plot_path, dpi = task
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    fig.suptitle(f"{str(cell_line).upper()} cells", fontsize=12)
+
+    egf_levels = sorted({s['egf_concentration'] for s in summaries})
+    for egf in egf_levels:
+        points = sorted(
+            (s for s in summaries if s['egf_concentration'] == egf),
+            key=lambda s: s['meki_concentration']
+        )
+        meki = [s['meki_concentration'] for s in points]
+        for ax, key in zip(axes, ['peak_perk', 'final_perk']):
+            ax.plot(meki, [s[key] for s in points], 'o-',
+                    label=f'EGF: {egf:.1f}')
+
+    for ax, title in zip(axes, ['Peak pERK', 'Final pERK']):
+        ax.set_title(title)
+        ax.set_xlabel('MEKi concentration')
+        ax.set_ylabel('Concentration')
+        if all(s['meki_concentration'] > 0 for s in summaries):
+            ax.set_xscale('log')
+        ax.legend()
+
+    fig.subplots_adjust(left=0.08, right=0.97, bottom=0.12, top=0.85,
+                        wspace=0.25)
+    plot_path = Path(plot_path)
+    plot_path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(plot_path, dpi=dpi)
+    plt.close(fig)
+    return plot_path
+
+
+def plot_results_files(results_files, figure_dir=None, processes=None,
+                       dpi=150, force=False):
+    """Render figures for a whole collection of results files.
+
+    Per-condition figures go to ``<figure_dir>/<results file stem>/`` and one
+    dose-response figure per cell line to ``<figure_dir>``. Figures that are
+    newer than their data are not redrawn unless ``force`` is set.
+    """
+    from multiprocessing import Pool
+
+    results_files = sorted(str(f) for f in results_files)
+    if not results_files:
+        logger.warning("No results files to plot")
+        return []
+    if figure_dir is None:
+        figure_dir = Path(results_files[0]).parent / 'figures'
+    figure_dir = Path(figure_dir)
+
+    tasks = [(f, figure_dir, dpi, force) for f in results_files]
+    n_processes = processes or os.cpu_count()
+    with Pool(n_processes) as pool:
+        chunksize = max(1, len(tasks) // (4 * n_processes))
+        summaries = list(pool.imap_unordered(render_results_file, tasks,
+                                             chunksize=chunksize))
+
+        by_cell_line = {}
+        for summary in summaries:
+            by_cell_line.setdefault(summary['cell_line'], []).append(summary)
+        dose_tasks = []
+        for cell_line, group in sorted(by_cell_line.items()):
+            plot_path = figure_dir / f'dose_response_{cell_line}.png'
+            if force or is_stale(plot_path,
+                                 *[s['results_file'] for s in group]):
+                dose_tasks.append((cell_line, group, plot_path, dpi))
+        pool.map(render_dose_response_figure, dose_tasks)
+
+    logger.info(f"Rendered figures for {len(summaries)} results files and "
+                f"{len(dose_tasks)} dose-response figures to {figure_dir}")
+    return summaries
+
 
 if __name__ == '__main__':
     import argparse
+    matplotlib.use('Agg')
+    logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser()
-    parser.add_argument('--results-file', type=str, 
+    parser.add_argument('--results-file', type=str,
                        default='/project/shakeri-lab/AP_1/pysb/results/cell_simulation_results.h5')
+    parser.add_argument('--results-dir', type=str, default=None,
+                       help='Render all *.h5 files in this directory')
+    parser.add_argument('--figure-dir', type=str, default=None,
+                       help='Output directory for batched figures '
+                            '(default: <results-dir>/figures)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--force', action='store_true',
+                       help='Redraw figures that are newer than their data')
     parser.add_argument('--n-cells', type=int, default=5)
     args = parser.parse_args()
-    
-    plot_cell_trajectories(args.results_file, args.n_cells) 
\ No newline at end of file
+
+    if args.results_dir is not None:
+        plot_results_files(Path(args.results_dir).glob('*.h5'),
+                           figure_dir=args.figure_dir,
+                           processes=args.processes, dpi=args.dpi,
+                           force=args.force)
+    else:
+        plot_cell_trajectories(args.results_file, args.n_cells)
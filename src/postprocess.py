@@ -1,15 +1,86 @@
 import h5py
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from pathlib import Path
 import logging
 
+from codec import read_trajectories
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def analyze_trajectories(h5_file):
+N_SPECIES_PLOTTED = 8
+
+# Reused between calls, only data and annotations change per condition
+_species_figure = None
+
+
+def _get_species_figure():
+    global _species_figure
+    if _species_figure is None:
+        fig, axes = plt.subplots(4, 2, figsize=(15, 20))
+        fig.suptitle('')
+        panels = []
+        for i in range(N_SPECIES_PLOTTED):
+            ax = axes[i//2, i%2]
+            line, = ax.plot([], [], 'b-', label=f'Species {i}')
+            ax.set_xlabel('Time (min)')
+            ax.set_ylabel('Concentration')
+            ax.set_title(f'Species {i}')
+            ax.grid(True)
+            min_label = ax.annotate('', xy=(0.02, 0.02), xycoords='axes fraction')
+            max_label = ax.annotate('', xy=(0.02, 0.95), xycoords='axes fraction')
+            panels.append((ax, line, min_label, max_label))
+        fig.subplots_adjust(left=0.07, right=0.97, bottom=0.04, top=0.94,
+                            wspace=0.25, hspace=0.3)
+        _species_figure = (fig, panels)
+    return _species_figure
+
+
+def close_species_figure():
+    global _species_figure
+    if _species_figure is not None:
+        plt.close(_species_figure[0])
+        _species_figure = None
+
+
+def render_species_figure(time, trajectories, attrs, output_path, dpi=100,
+                          keep_template=False):
+    """Plot the first species of one condition with min/max annotations.
+
+    With keep_template, the figure stays open for the next call.
+    """
+    fig, panels = _get_species_figure()
+    fig.suptitle(f"{str(attrs['cell_line']).upper()} cells\n"
+                 f"MEKi: {attrs['meki_concentration']:.1f}, "
+                 f"EGF: {attrs['egf_concentration']:.1f}")
+
+    n_species = min(N_SPECIES_PLOTTED, trajectories.shape[1])
+    for i, (ax, line, min_label, max_label) in enumerate(panels):
+        ax.set_visible(i < n_species)
+        if i >= n_species:
+            continue
+        line.set_data(time, trajectories[:, i])
+        ax.relim()
+        ax.autoscale_view()
+
+        # Add min/max annotations
+        ymin, ymax = trajectories[:, i].min(), trajectories[:, i].max()
+        min_label.set_text(f'Min: {ymin:.2e}')
+        max_label.set_text(f'Max: {ymax:.2e}')
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(output_path, dpi=dpi)
+    if not keep_template:
+        close_species_figure()
+    return output_path
+
+
+def analyze_trajectories(h5_file, output_path=None):
     """Analyze and plot species trajectories from HDF5 file."""
     logger.info(f"Reading data from {h5_file}")
     
@@ -17,7 +88,7 @@ def analyze_trajectories(h5_file):
         with h5py.File(h5_file, 'r') as f:
             # Load data
             time = f['time'][:].flatten()  # Ensure 1D array
-            trajectories = f['trajectories'][:]
+            trajectories = read_trajectories(f)
             
             # Get metadata
             cell_type = f.attrs.get('cell_line', 'unknown')
@@ -31,33 +102,14 @@ def analyze_trajectories(h5_file):
             logger.info(f"Number of species: {trajectories.shape[1]}")
             logger.info(f"Time range: [{time.min():.1f}, {time.max():.1f}]")
             
-            # Create figure
-            fig, axes = plt.subplots(4, 2, figsize=(15, 20))
-            fig.suptitle(f"{cell_type.upper()} cells\nMEKi: {meki_conc:.1f}, EGF: {egf_conc:.1f}")
-            
-            # Plot all species
-            for i in range(min(8, trajectories.shape[1])):
-                ax = axes[i//2, i%2]
-                ax.plot(time, trajectories[:, i], 'b-', label=f'Species {i}')
-                ax.set_xlabel('Time (min)')
-                ax.set_ylabel('Concentration')
-                ax.set_title(f'Species {i}')
-                ax.grid(True)
-                
-                # Add min/max annotations
-                ymin, ymax = trajectories[:, i].min(), trajectories[:, i].max()
-                ax.annotate(f'Min: {ymin:.2e}', xy=(0.02, 0.02), xycoords='axes fraction')
-                ax.annotate(f'Max: {ymax:.2e}', xy=(0.02, 0.95), xycoords='axes fraction')
-            
-            plt.tight_layout()
-            
-            # Save plot
-            output_dir = Path('results/analysis')
-            output_dir.mkdir(parents=True, exist_ok=True)
-            output_path = output_dir / 'species_trajectories.png'
+            if output_path is None:
+                output_path = Path('results/analysis') / 'species_trajectories.png'
             logger.info(f"Saving plot to {output_path}")
-            plt.savefig(output_path)
-            plt.close()
+            render_species_figure(time, trajectories,
+                                  {'cell_line': cell_type,
+                                   'meki_concentration': meki_conc,
+                                   'egf_concentration': egf_conc},
+                                  output_path)
             
     except FileNotFoundError:
         logger.error(f"Could not find file: {h5_file}")
@@ -66,9 +118,13 @@ def analyze_trajectories(h5_file):
 
 if __name__ == '__main__':
     import argparse
+    matplotlib.use('Agg')
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', type=str, required=True,
                        help='Path to HDF5 results file')
+    parser.add_argument('--output', type=str, default=None,
+                       help='Path of the species figure '
+                            '(default: results/analysis/species_trajectories.png)')
     args = parser.parse_args()
     
-    analyze_trajectories(args.input) 
\ No newline at end of file
+    analyze_trajectories(args.input, args.output) 
\ No newline at end of file
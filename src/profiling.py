@@ -0,0 +1,297 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from features import get_observable_matrix
+from parameter_store import open_parameter_store
+from paths import DATASET, get_analysis_results_file, get_profile_file
+from registry import load_registry, specialise_par_name
+from simulation import (MODEL_NAME, MODEL_VARIANT, create_simulator,
+                        get_drug_names, get_tspan, make_condition)
+
+logger = logging.getLogger(__name__)
+
+# parameters estimated on linear scale, all others on log10 scale
+LINEAR_SUFFIXES = ('_phi', '_dG', '_ddG')
+# 95% pointwise confidence threshold of the negative log-likelihood
+PROFILE_THRESHOLD = 0.5 * 3.841
+# a profile direction ends once it exceeds the threshold by this factor
+STOP_FACTOR = 2.0
+# objective value of failed simulations
+FAILED_OBJECTIVE = 1e10
+
+
+def to_optimization_scale(names, values):
+    return np.array([value if name.endswith(LINEAR_SUFFIXES)
+                     else np.log10(value)
+                     for name, value in zip(names, values)])
+
+
+def from_optimization_scale(names, x):
+    return np.array([value if name.endswith(LINEAR_SUFFIXES)
+                     else 10 ** value
+                     for name, value in zip(names, x)])
+
+
+def load_measurements(data_file):
+    """Measurement table with cell_line, meki, egf, time, observable, value.
+
+    rafi, prafi (default 0) and sigma (default 1) columns are optional.
+    """
+    import pandas as pd
+
+    data = pd.read_csv(data_file)
+    for column, default in [('rafi', 0.0), ('prafi', 0.0), ('sigma', 1.0)]:
+        if column not in data:
+            data[column] = default
+    return data
+
+
+class Objective:
+    """Negative log-likelihood of measurements under Gaussian noise.
+
+    Parameters are given on optimization scale in the column order of the
+    parameter store. The parameter vector of every condition is built once
+    from the condition registry as in the simulation pipeline; an evaluation
+    only overwrites its estimated entries, with drug-specific names resolved
+    like parameters.load_parameters, and passes it to the simulator.
+    """
+
+    def __init__(self, data, names, variant=MODEL_VARIANT):
+        from model_cache import load_model
+
+        self.names = list(names)
+        self.model = load_model(MODEL_NAME, variant)
+        self.equil_time, self.tspan = get_tspan()
+        compiled = load_registry().compile(self.model)
+        columns = {name: c for c, name in enumerate(self.names)}
+        self.groups = []
+        for (cell_line, meki, egf, rafi, prafi), rows in data.groupby(
+                ['cell_line', 'meki', 'egf', 'rafi', 'prafi']):
+            condition = make_condition(cell_line, meki, egf, rafi, prafi)
+            observables = sorted(rows['observable'].unique())
+            drugs = get_drug_names(condition)
+            model_index, estimated_columns = [], []
+            for j, parameter in enumerate(self.model.parameters):
+                name = specialise_par_name(parameter.name, drugs['prafi'],
+                                           drugs['rafi'], drugs['meki'])
+                if name in columns:
+                    model_index.append(j)
+                    estimated_columns.append(columns[name])
+            self.groups.append({
+                'condition': condition,
+                'observables': observables,
+                'index': [observables.index(o) for o in rows['observable']],
+                'time': rows['time'].to_numpy(dtype=float),
+                'value': rows['value'].to_numpy(dtype=float),
+                'sigma': rows['sigma'].to_numpy(dtype=float),
+                'matrix': get_observable_matrix(self.model, observables),
+                'base': compiled.parameter_values(condition),
+                'model_index': np.array(model_index, dtype=int),
+                'columns': np.array(estimated_columns, dtype=int),
+            })
+        self.sim = create_simulator(self.model, self.tspan)
+        self.n_evaluations = 0
+
+    def parameter_values(self, group, values):
+        """Parameter vector of a group with the estimated values applied."""
+        group_values = group['base'].copy()
+        group_values[group['model_index']] = values[group['columns']]
+        return group_values
+
+    def __call__(self, x):
+        self.n_evaluations += 1
+        values = from_optimization_scale(self.names, x)
+        total = 0.0
+        for group in self.groups:
+            # like simulation.simulate, the stimulation starts from the
+            # initial conditions of the parameter vector
+            try:
+                output = self.sim.run(
+                    tspan=self.tspan,
+                    param_values=self.parameter_values(group, values)
+                )
+            except Exception:
+                return FAILED_OBJECTIVE
+            trajectories = np.asarray(output.species) @ group['matrix']
+            tout = np.asarray(output.tout).flatten()
+            simulated = np.array([
+                np.interp(t, tout, trajectories[:, j])
+                for t, j in zip(group['time'], group['index'])
+            ])
+            residuals = (simulated - group['value']) / group['sigma']
+            if not np.all(np.isfinite(residuals)):
+                return FAILED_OBJECTIVE
+            total += 0.5 * np.sum(residuals ** 2)
+        return total
+
+
+def optimize_fixed(objective, x_start, fixed_index, bounds, max_iter):
+    """Minimize over all parameters except fixed_index, starting at x_start."""
+    from scipy.optimize import minimize
+
+    free = np.arange(len(x_start)) != fixed_index
+
+    def restricted(z):
+        x = x_start.copy()
+        x[free] = z
+        return objective(x)
+
+    result = minimize(restricted, x_start[free], method='L-BFGS-B',
+                      bounds=[b for b, f in zip(bounds, free) if f],
+                      options={'maxiter': max_iter})
+    x = x_start.copy()
+    x[free] = result.x
+    return x, result.fun
+
+
+def compute_profile(objective, x_opt, f_opt, index, step, max_steps,
+                    bounds, max_iter):
+    """Profile one parameter in both directions from the optimum.
+
+    Each step fixes the parameter one step further and re-optimizes the
+    others, starting from the optimum of the previous step. A direction
+    ends when the objective exceeds the confidence threshold by
+    STOP_FACTOR or the parameter leaves its bounds.
+    """
+    rows = [(x_opt[index], f_opt, x_opt)]
+    for direction in (-1, 1):
+        x = x_opt.copy()
+        for k in range(1, max_steps + 1):
+            value = x_opt[index] + direction * k * step
+            if not bounds[index][0] <= value <= bounds[index][1]:
+                break
+            x[index] = value
+            x, f = optimize_fixed(objective, x, index, bounds, max_iter)
+            rows.append((value, f, x.copy()))
+            logger.info(f"{objective.names[index]} = {value:.3g}: "
+                        f"{f - f_opt:.3g} above optimum")
+            if f - f_opt > STOP_FACTOR * PROFILE_THRESHOLD:
+                break
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def confidence_interval(values, objective_values, f_opt):
+    """Outermost crossings of the threshold, linearly interpolated.
+
+    Bounds that are not crossed within the profile are infinite.
+    """
+    ratio = np.asarray(objective_values) - f_opt - PROFILE_THRESHOLD
+    values = np.asarray(values)
+    center = int(np.argmin(ratio))
+    lower, upper = -np.inf, np.inf
+    for i in range(center, 0, -1):
+        if ratio[i - 1] > 0 >= ratio[i]:
+            lower = np.interp(0, [ratio[i], ratio[i - 1]],
+                              [values[i], values[i - 1]])
+            break
+    for i in range(center, len(values) - 1):
+        if ratio[i + 1] > 0 >= ratio[i]:
+            upper = np.interp(0, [ratio[i], ratio[i + 1]],
+                              [values[i], values[i + 1]])
+            break
+    return lower, upper
+
+
+_objective = None
+
+
+def _init_worker(data_file, names, variant):
+    global _objective
+    logging.basicConfig(level=logging.INFO)
+    _objective = Objective(load_measurements(data_file), names, variant)
+
+
+def _profile_worker(args):
+    index, x_opt, f_opt, step, max_steps, bounds, max_iter = args
+    return compute_profile(_objective, x_opt, f_opt, index, step, max_steps,
+                           bounds, max_iter)
+
+
+def run_profiles(data_file, parameters=None, start_index=0, step=0.1,
+                 max_steps=30, bound_width=3.0, max_iter=50, processes=None,
+                 variant=MODEL_VARIANT, dataset=DATASET):
+    """Profile parameters around a multistart optimum, in parallel.
+
+    Starts from row start_index of the fval-sorted parameter store. Each
+    worker process keeps its own warm model and simulator and profiles one
+    parameter at a time. Writes one CSV per parameter to the profiling
+    directory and a summary with confidence intervals to the analysis
+    results; returns the summary.
+    """
+    import pandas as pd
+    from multiprocessing import Pool
+
+    store = open_parameter_store(MODEL_NAME, variant, dataset)
+    names = store.names
+    position = store.top_k(start_index + 1)[start_index]
+    x_opt = to_optimization_scale(names, store.matrix[position])
+    bounds = [(x - bound_width, x + bound_width) for x in x_opt]
+    profiled = parameters or names
+    indices = [names.index(name) for name in profiled]
+
+    f_opt = Objective(load_measurements(data_file), names, variant)(x_opt)
+    logger.info(f"Profiling {len(indices)} parameters from start "
+                f"{start_index}, objective {f_opt:.6g}")
+    tasks = [(index, x_opt, f_opt, step, max_steps, bounds, max_iter)
+             for index in indices]
+    with Pool(processes, initializer=_init_worker,
+              initargs=(data_file, names, variant)) as pool:
+        profiles = pool.map(_profile_worker, tasks, chunksize=1)
+
+    summary = []
+    for name, rows in zip(profiled, profiles):
+        values = [row[0] for row in rows]
+        objective_values = [row[1] for row in rows]
+        table = pd.DataFrame(np.array([row[2] for row in rows]),
+                             columns=names)
+        table.insert(0, 'objective', objective_values)
+        table.insert(0, name + '_profile', values)
+        profile_file = get_profile_file(MODEL_NAME, variant, dataset, name,
+                                        start_index)
+        os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+        table.to_csv(profile_file, index=False)
+        lower, upper = confidence_interval(values, objective_values, f_opt)
+        summary.append({'parameter': name, 'optimum': x_opt[names.index(name)],
+                        'lower': lower, 'upper': upper,
+                        'identifiable': bool(np.isfinite(lower)
+                                             and np.isfinite(upper))})
+
+    summary = pd.DataFrame(summary)
+    summary_file = get_analysis_results_file(MODEL_NAME, variant, dataset,
+                                             'profiles', start_index)
+    os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    summary.to_csv(summary_file, index=False)
+    logger.info(f"{int(summary['identifiable'].sum())} of {len(summary)} "
+                f"parameters identifiable, summary in {summary_file}")
+    return summary
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Profile likelihoods of estimated parameters'
+    )
+    parser.add_argument('--data', type=str, required=True,
+                        help='CSV with cell_line, meki, egf, time, '
+                             'observable, value (and optional rafi, prafi, '
+                             'sigma) columns')
+    parser.add_argument('--parameters', nargs='+', default=None,
+                        help='Parameters to profile (default: all)')
+    parser.add_argument('--start-index', type=int, default=0,
+                        help='Rank of the multistart optimum to start from')
+    parser.add_argument('--step', type=float, default=0.1,
+                        help='Step size on optimization scale')
+    parser.add_argument('--max-steps', type=int, default=30)
+    parser.add_argument('--max-iter', type=int, default=50,
+                        help='Optimizer iterations per profile step')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--variant', type=str, default=MODEL_VARIANT)
+    args = parser.parse_args()
+
+    run_profiles(args.data, args.parameters, args.start_index, args.step,
+                 args.max_steps, max_iter=args.max_iter,
+                 processes=args.processes, variant=args.variant)
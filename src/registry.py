@@ -0,0 +1,229 @@
+"""Declarative registry of cell lines, drugs and stimuli.
+
+``models/conditions.json`` declares for each cell line the parameter table
+(variant and dataset) it was fitted with and any fixed parameter values, and
+for each input (EGF and the drugs) the model parameter that receives its
+concentration, its unit and the drug whose fitted parameters apply. The
+registry is compiled once per model into index arrays, so configuring a
+condition is a few writes into a parameter vector instead of changes to
+the model.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+from model_cache import get_parameter_overrides
+from parameter_store import open_parameter_store
+from paths import get_directory
+
+logger = logging.getLogger(__name__)
+
+# Set minimum concentration to avoid log(0)
+MIN_CONC = 1e-6
+
+# compiled registries, keyed by id(model)
+_compiled = {}
+_registries = {}
+
+
+def specialise_par_name(name, panrafi, rafi, meki):
+    """Parameter name with the drug placeholders replaced by drug names."""
+    if panrafi is not None:
+        name = name.replace('PRAFi', panrafi)
+
+    if rafi is not None:
+        name = name.replace('RAFi', rafi)
+
+    if meki is not None:
+        name = name.replace('MEKi', meki)
+
+    return name
+
+
+def get_registry_file():
+    return os.path.join(get_directory(), 'models', 'conditions.json')
+
+
+def load_registry(registry_file=None):
+    registry_file = registry_file or get_registry_file()
+    if registry_file not in _registries:
+        with open(registry_file) as f:
+            _registries[registry_file] = ConditionRegistry(json.load(f))
+    return _registries[registry_file]
+
+
+class ConditionRegistry:
+    """Cell lines, inputs and units of a registry file."""
+
+    def __init__(self, spec):
+        self.model_name = spec['model_name']
+        self.cell_lines = spec['cell_lines']
+        self.inputs = spec['inputs']
+        self.units = spec['units']
+
+    def settings(self, cell_line):
+        """Parameter table of a cell line, as passed to load_parameters."""
+        try:
+            entry = self.cell_lines[cell_line]
+        except KeyError:
+            raise ValueError(f'Unknown cell line {cell_line}, registered: '
+                             f'{", ".join(self.cell_lines)}') from None
+        return {
+            'model_name': self.model_name,
+            'variant': entry['variant'],
+            'dataset': entry['dataset'],
+        }
+
+    def drug_names(self, condition):
+        """Drugs whose fitted parameters apply to a condition.
+
+        A drug only applies if it is present; its placeholder in parameter
+        names (e.g. MEKi) is then replaced by the drug name.
+        """
+        return {
+            name: entry['drug']
+            if condition.get(name, 0.0) > MIN_CONC else None
+            for name, entry in self.inputs.items() if 'placeholder' in entry
+        }
+
+    def to_model_units(self, name, value, unit=None):
+        """Concentration of an input converted to the unit of the model."""
+        model_unit = self.inputs[name]['unit']
+        if unit is None or unit == model_unit:
+            return value
+        try:
+            return value * self.units[model_unit][unit]
+        except KeyError:
+            raise ValueError(f'Cannot convert {name} from {unit} to '
+                             f'{model_unit}') from None
+
+    def compile(self, model):
+        """Compiled registry of a model, built once per model instance.
+
+        The default parameter values are captured the first time, so the
+        model must not have been configured before.
+        """
+        names = tuple(p.name for p in model.parameters)
+        compiled = _compiled.get(id(model))
+        if compiled is None or compiled.parameter_names != names \
+                or compiled.registry is not self:
+            compiled = CompiledRegistry(self, model)
+            _compiled[id(model)] = compiled
+        return compiled
+
+
+class CompiledRegistry:
+    """Parameter vectors of conditions for one model.
+
+    Values are built from the model defaults, the row of the cell line's
+    parameter table (with drug placeholders specialized), the parameter
+    overrides of a modified model instance, the cell line's fixed values and
+    the input concentrations. Table columns are resolved once per cell line
+    and drug combination.
+    """
+
+    def __init__(self, registry, model):
+        self.registry = registry
+        self.parameter_names = tuple(p.name for p in model.parameters)
+        self.index = {name: j for j, name in enumerate(self.parameter_names)}
+        self.defaults = np.array([p.value for p in model.parameters])
+        self.nonnegative = np.array([bool(p.is_nonnegative)
+                                     for p in model.parameters])
+
+        overrides = get_parameter_overrides(model)
+        self.overrides = (
+            np.array([self.index[name] for name in overrides], dtype=int),
+            np.array(list(overrides.values()), dtype=float),
+        )
+
+        self.inputs = {}
+        for name, entry in registry.inputs.items():
+            if entry['parameter'] not in self.index:
+                raise ValueError(f"Input {name} sets {entry['parameter']}, "
+                                 f"which is not a parameter of the model")
+            self.inputs[name] = self.index[entry['parameter']]
+        self.cell_lines = {}
+        for cell_line, entry in registry.cell_lines.items():
+            unknown = set(entry.get('parameters', {})) - set(self.index)
+            if unknown:
+                raise ValueError(f"Cell line {cell_line} sets unknown "
+                                 f"parameters {', '.join(sorted(unknown))}")
+            self.cell_lines[cell_line] = (
+                np.array([self.index[name] for name in entry['parameters']],
+                         dtype=int),
+                np.array(list(entry['parameters'].values()), dtype=float),
+            )
+        self._columns = {}
+
+    def _table_columns(self, settings, drugs):
+        """(store, model parameter indices, store column indices)."""
+        store = open_parameter_store(settings['model_name'],
+                                     settings['variant'],
+                                     settings['dataset'])
+        key = (settings['variant'], settings['dataset'],
+               tuple(sorted(drugs.items(), key=lambda item: item[0])))
+        cached = self._columns.get(key)
+        # a changed CSV is re-imported into a new store object
+        if cached is not None and cached[0] is store:
+            return cached
+        store_columns = {name: c for c, name in enumerate(store.names)}
+        model_indices, columns = [], []
+        for j, name in enumerate(self.parameter_names):
+            specialized = specialise_par_name(name, drugs.get('prafi'),
+                                              drugs.get('rafi'),
+                                              drugs.get('meki'))
+            if specialized in store_columns:
+                model_indices.append(j)
+                columns.append(store_columns[specialized])
+        cached = (store, np.array(model_indices, dtype=int),
+                  np.array(columns, dtype=int))
+        self._columns[key] = cached
+        return cached
+
+    def parameter_values(self, condition, parameter_index=0):
+        """Parameter vector of a condition with EGF applied.
+
+        parameter_index is the row label of the multistart parameter table.
+        If the table cannot be read, the model defaults are used.
+        """
+        values = self.defaults.copy()
+        settings = self.registry.settings(condition['cell_line'])
+        try:
+            store, model_indices, columns = self._table_columns(
+                settings, self.registry.drug_names(condition)
+            )
+            values[model_indices] = store.matrix[
+                store.position(parameter_index)][columns]
+        except Exception as e:
+            logger.warning(f"Could not load parameters for "
+                           f"{settings['variant']}: {e}; using default "
+                           f"parameters from model definition")
+        indices, overrides = self.overrides
+        values[indices] = overrides
+        indices, fixed = self.cell_lines[condition['cell_line']]
+        values[indices] = fixed
+        for name, j in self.inputs.items():
+            values[j] = max(condition.get(name, 0.0), MIN_CONC)
+        # free energies (declared with nonnegative=False) may legitimately
+        # be zero or negative
+        values[self.nonnegative & (values <= 0)] = MIN_CONC
+        return values
+
+    def parameter_matrix(self, conditions, parameter_index=0):
+        """Parameter vectors of many conditions, (conditions, parameters)."""
+        return np.array([self.parameter_values(condition, parameter_index)
+                         for condition in conditions])
+
+    def pre_equilibration_values(self, values):
+        """Parameter vectors without EGF, for pre-equilibration."""
+        values = np.array(values, dtype=float)
+        values[..., self.inputs['egf']] = MIN_CONC
+        return values
+
+    def apply(self, model, values):
+        """Write a parameter vector into a model, for simulators that read
+        the parameters from the model."""
+        for parameter, value in zip(model.parameters, values):
+            parameter.value = value
@@ -0,0 +1,394 @@
+"""Long-lived local simulation server.
+
+Keeps the model and its compiled simulator warm and answers JSON requests
+over HTTP on a TCP port or a Unix socket:
+
+    POST /simulate  {"conditions": [{"cell_line": "mutant", "meki": 0.1,
+                                     "egf": 0.5, "parameters": {...}}],
+                     "observables": ["pERK"], "species": false}
+    GET  /health
+
+Concurrent requests are collected for a short window and solved as one
+batch on the warm simulator. Results are cached by the run hash of the
+manifest, which covers parameters, condition, time points and integrator,
+so repeated requests are served without solving.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import http.client
+import json
+import logging
+import os
+import socket
+import time
+
+import numpy as np
+
+from features import get_observable_matrix
+from manifest import compute_run_hash
+from model_cache import hash_model_source, load_model
+from registry import load_registry
+from simulation import (INTEGRATOR, INTEGRATOR_OPTIONS, MODEL_NAME,
+                        MODEL_VARIANT, configure_model, create_simulator,
+                        get_condition_key, get_tspan, make_condition)
+from solver_health import (check_health, get_conservation_matrix,
+                           simulate_with_fallback)
+
+logger = logging.getLogger(__name__)
+
+# requests arriving within this many seconds are solved together
+BATCH_WINDOW = 0.005
+MAX_BATCH_SIZE = 64
+CACHE_SIZE = 4096
+
+
+class ResultCache:
+    """LRU cache of species trajectories keyed by run hash.
+
+    With a cache directory, results are also kept on disk as
+    ``<hash>.npy`` and survive server restarts.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self._entries = collections.OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _file(self, run_hash):
+        return os.path.join(self.cache_dir, f'{run_hash}.npy')
+
+    def get(self, run_hash):
+        if run_hash in self._entries:
+            self._entries.move_to_end(run_hash)
+            return self._entries[run_hash]
+        if self.cache_dir is not None \
+                and os.path.exists(self._file(run_hash)):
+            species = np.load(self._file(run_hash))
+            self._put_memory(run_hash, species)
+            return species
+        return None
+
+    def _put_memory(self, run_hash, species):
+        self._entries[run_hash] = species
+        self._entries.move_to_end(run_hash)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put(self, run_hash, species):
+        self._put_memory(run_hash, species)
+        if self.cache_dir is not None:
+            tmp_file = f'{self._file(run_hash)}.{os.getpid()}.tmp.npy'
+            np.save(tmp_file, species)
+            os.replace(tmp_file, self._file(run_hash))
+
+
+class SimulationService:
+    """Warm model and simulator that solve batches of requests.
+
+    All model access happens in a single worker thread, since configuring a
+    condition mutates the shared model.
+    """
+
+    def __init__(self, cache, variant=MODEL_VARIANT):
+        self.cache = cache
+        self.model = load_model(MODEL_NAME, variant)
+        self.model_hash = hash_model_source(MODEL_NAME, variant)
+        self.equil_time, self.tspan = get_tspan()
+        self.conservation = get_conservation_matrix(self.model)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.sim = None
+        self.stats = collections.Counter()
+
+    def warm_up(self):
+        configure_model(self.model, make_condition('mutant', 0.0, 0.0))
+        self.sim = create_simulator(self.model, self.tspan)
+
+    def _configure(self, condition, parameters):
+        """Parameter vector of a request, without touching the model."""
+        compiled = load_registry().compile(self.model)
+        values = compiled.parameter_values(condition)
+        for name, value in (parameters or {}).items():
+            values[compiled.index[name]] = value
+        run_hash = compute_run_hash(self.model_hash,
+                                    compiled.parameter_names, values,
+                                    dict(condition, parameters=parameters),
+                                    self.tspan, INTEGRATOR,
+                                    INTEGRATOR_OPTIONS)
+        return run_hash, values, values[compiled.inputs['egf']]
+
+    def solve_batch(self, requests):
+        """Solve (condition, parameters) requests; returns per request
+        (run hash, species) or an exception."""
+        results = [None] * len(requests)
+        pending = collections.OrderedDict()
+        for i, (condition, parameters) in enumerate(requests):
+            try:
+                run_hash, values, egf = self._configure(condition, parameters)
+            except Exception as e:
+                results[i] = e
+                continue
+            species = self.cache.get(run_hash)
+            if species is not None:
+                self.stats['cache_hits'] += 1
+                results[i] = (run_hash, species)
+            else:
+                # identical concurrent requests are solved once
+                pending.setdefault(run_hash, (values, egf, []))[2].append(i)
+
+        if pending:
+            self.stats['solved'] += len(pending)
+            for run_hash, species in zip(pending,
+                                         self._solve(list(pending.values()))):
+                if not isinstance(species, Exception):
+                    self.cache.put(run_hash, species)
+                for i in pending[run_hash][2]:
+                    results[i] = species if isinstance(species, Exception) \
+                        else (run_hash, species)
+        return results
+
+    def _solve(self, batch):
+        """Run the batch in one call on the warm simulator.
+
+        Like simulation.simulate, the stimulation starts from the initial
+        conditions of the parameter vectors, so no separate
+        pre-equilibration run is made. If the batched run fails, every
+        member is retried alone, so one bad request does not fail the rest.
+        """
+        stim_values = np.array([v for v, _, _ in batch])
+        try:
+            output = self.sim.run(tspan=self.tspan, param_values=stim_values)
+        except Exception as e:
+            logger.warning(f"Batch of {len(batch)} failed ({e}), solving "
+                           f"its members alone")
+            return [self._solve_single(row) for row in stim_values]
+
+        # results of a single simulation are not wrapped in a list
+        trajectories = output.species if len(batch) > 1 \
+            else [output.species]
+        species = []
+        for row, trajectory in zip(stim_values, trajectories):
+            trajectory = np.asarray(trajectory)
+            if check_health(trajectory, self.conservation,
+                            INTEGRATOR_OPTIONS):
+                # unhealthy in the batch, retry alone with the fallbacks
+                trajectory = self._solve_single(row)
+            species.append(trajectory)
+        return species
+
+    def _solve_single(self, values):
+        """Solve one parameter vector with the fallback ladder.
+
+        The values are passed to the simulator, so the shared model is never
+        modified.
+        """
+        def simulate_fn(sim):
+            output = sim.run(tspan=self.tspan, param_values=values)
+            return output.tout, output.species
+
+        try:
+            _, species, _ = simulate_with_fallback(
+                self.model, self.tspan, simulate_fn, sim=self.sim
+            )
+        except Exception as e:
+            return e
+        return np.asarray(species)
+
+
+class SimulationServer:
+    """asyncio front end that coalesces requests into batches."""
+
+    def __init__(self, service, batch_window=BATCH_WINDOW,
+                 max_batch_size=MAX_BATCH_SIZE):
+        self.service = service
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue = None
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            requests = [request for request, _ in items]
+            try:
+                results = await loop.run_in_executor(
+                    self.service.executor, self.service.solve_batch, requests
+                )
+            except Exception as e:
+                results = [e] * len(items)
+            self.service.stats['batches'] += 1
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    async def simulate(self, condition, parameters=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((condition, parameters), future))
+        return await future
+
+    async def handle_simulate(self, body):
+        conditions = [
+            make_condition(c['cell_line'], float(c.get('meki', 0.0)),
+                           float(c.get('egf', 0.0)),
+                           float(c.get('rafi', 0.0)),
+                           float(c.get('prafi', 0.0)))
+            for c in body['conditions']
+        ]
+        parameters = [c.get('parameters') or body.get('parameters')
+                      for c in body['conditions']]
+        observables = body.get('observables') or [
+            o.name for o in self.service.model.observables
+        ]
+        matrix = get_observable_matrix(self.service.model, observables)
+        results = await asyncio.gather(*[
+            self.simulate(condition, pars)
+            for condition, pars in zip(conditions, parameters)
+        ])
+        response = []
+        for condition, (run_hash, species) in zip(conditions, results):
+            result = {
+                'key': get_condition_key(condition),
+                'hash': run_hash,
+                'time': self.service.tspan.tolist(),
+                'observables': dict(zip(observables,
+                                        (species @ matrix).T.tolist())),
+            }
+            if body.get('species'):
+                result['species'] = species.tolist()
+            response.append(result)
+        return {'results': response}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+
+                status = 200
+                try:
+                    if method == 'GET' and path == '/health':
+                        payload = {'status': 'ok',
+                                   'stats': dict(self.service.stats)}
+                    elif method == 'POST' and path == '/simulate':
+                        payload = await self.handle_simulate(json.loads(body))
+                    else:
+                        status, payload = 404, {'error': f'No route {path}'}
+                except Exception as e:
+                    logger.exception(f"Request to {path} failed")
+                    status, payload = 500, {'error': f'{type(e).__name__}: '
+                                                     f'{e}'}
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {http.client.responses[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, socket_path=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection,
+                                                     path=socket_path)
+            logger.info(f"Serving on {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle_connection,
+                                                host, port)
+            logger.info(f"Serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request_simulation(conditions, observables=None, species=False,
+                       host='127.0.0.1', port=8765, socket_path=None):
+    """Client helper: simulate conditions on a running server."""
+    if socket_path is not None:
+        connection = _UnixHTTPConnection(socket_path)
+    else:
+        connection = http.client.HTTPConnection(host, port)
+    try:
+        connection.request('POST', '/simulate', body=json.dumps({
+            'conditions': conditions,
+            'observables': observables,
+            'species': species,
+        }), headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(payload.get('error', response.reason))
+    return payload['results']
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Serve simulations from a warm model over HTTP'
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--variant', type=str, default=MODEL_VARIANT)
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Also keep cached results on disk')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    service = SimulationService(ResultCache(args.cache_size, args.cache_dir),
+                                args.variant)
+    service.warm_up()
+    logger.info(f"Simulator ready after {time.time() - start_time:.1f}s")
+    server = SimulationServer(service, batch_window=args.batch_window)
+    asyncio.run(server.serve(args.host, args.port, args.socket))
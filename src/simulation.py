@@ -0,0 +1,129 @@
+import logging
+import os
+
+import numpy as np
+
+from codec import write_trajectories
+from registry import MIN_CONC, load_registry
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'RTKERK'
+MODEL_VARIANT = 'pRAF'
+
+INTEGRATOR = 'lsoda'
+INTEGRATOR_OPTIONS = {
+    'rtol': 1e-6,  # Tighter tolerance
+    'atol': 1e-8,
+    'mxstep': 10000,  # Increased max steps for stiff equations
+}
+
+
+def get_settings(cell_line):
+    return load_registry().settings(cell_line)
+
+
+def get_tspan():
+    """Return the pre-equilibration and the full simulation time points."""
+    # Create non-uniform time points with higher resolution at the beginning
+    early_times = np.linspace(0, 600, 30)      # First 10 min, 2-min intervals
+    mid_times = np.linspace(600, 3600, 20)     # Next 50 min, ~16-min intervals
+    late_times = np.linspace(3600, 7200, 10)   # Last 60 min, 60-min intervals
+
+    # Add pre-equilibration period
+    equil_time = np.linspace(-600, 0, 4)      # 10 minutes pre-equilibration, ~3-min intervals
+    stim_time = np.concatenate([early_times, mid_times, late_times])
+    tspan = np.unique(np.concatenate([equil_time, stim_time]))
+    return equil_time, tspan
+
+
+def make_condition(cell_line, meki, egf, rafi=0.0, prafi=0.0):
+    """Condition dict; RAF inhibitors are only included if present."""
+    condition = {'cell_line': cell_line, 'meki': meki, 'egf': egf}
+    if rafi:
+        condition['rafi'] = rafi
+    if prafi:
+        condition['prafi'] = prafi
+    return condition
+
+
+def get_condition_key(condition):
+    """File-name-safe identifier of a simulation condition."""
+    key = (f"{condition['cell_line']}_meki{condition['meki']:g}"
+           f"_egf{condition['egf']:g}")
+    for drug in ['rafi', 'prafi']:
+        if condition.get(drug, 0):
+            key += f'_{drug}{condition[drug]:g}'
+    return key
+
+
+def get_drug_names(condition):
+    """Drugs whose parameter sets apply to a condition, as passed to
+    parameters.load_parameters."""
+    return load_registry().drug_names(condition)
+
+
+def configure_model(model, condition, parameter_index=0):
+    """Set the parameters of the shared model for one condition.
+
+    parameter_index is the row label of the multistart parameter table to
+    use. The values come from the condition registry, see
+    registry.CompiledRegistry.parameter_values; code that runs conditions
+    concurrently should use those vectors instead of the shared model.
+    Returns the EGF concentration that is applied after pre-equilibration.
+    """
+    compiled = load_registry().compile(model)
+    values = compiled.parameter_values(condition, parameter_index)
+    compiled.apply(model, values)
+    return values[compiled.inputs['egf']]
+
+
+def create_simulator(model, tspan, integrator=INTEGRATOR,
+                     integrator_options=None):
+    from pysb.simulator import ScipyOdeSimulator
+
+    if integrator_options is None:
+        integrator_options = INTEGRATOR_OPTIONS
+    return ScipyOdeSimulator(
+        model,
+        tspan=tspan,
+        compiler='cython',
+        integrator=integrator,
+        integrator_options=integrator_options,
+    )
+
+
+def simulate(sim, model, equil_time, egf):
+    """Pre-equilibrate without EGF, then run the EGF stimulation."""
+    # Set initial EGF to zero, then add it at t=0
+    model.parameters['EGF_0'].value = MIN_CONC
+
+    # Run pre-equilibration
+    sim.run(tspan=equil_time)
+
+    # Set EGF stimulus and continue simulation
+    model.parameters['EGF_0'].value = egf
+    return sim.run()
+
+
+def save_results(output_file, tout, species, condition, attrs=None,
+                 codec_options=None):
+    """Write a results file atomically, so partial files are never seen.
+
+    With codec_options, trajectories are stored compressed by codec.py.
+    """
+    import h5py
+
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('time', data=tout)
+        write_trajectories(f, species, tout, codec_options)
+        # Add metadata
+        f.attrs['cell_line'] = condition['cell_line']
+        f.attrs['meki_concentration'] = condition['meki']
+        f.attrs['egf_concentration'] = condition['egf']
+        f.attrs['rafi_concentration'] = condition.get('rafi', 0.0)
+        f.attrs['prafi_concentration'] = condition.get('prafi', 0.0)
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
+    os.replace(tmp_file, output_file)
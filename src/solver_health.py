@@ -0,0 +1,158 @@
+import json
+import logging
+import warnings
+
+import numpy as np
+
+from checkpoint import SimulationInterrupted
+from simulation import INTEGRATOR, INTEGRATOR_OPTIONS, create_simulator
+
+logger = logging.getLogger(__name__)
+
+# Integrators and tolerances tried in order until a run is healthy
+FALLBACK_LADDER = [
+    (INTEGRATOR, INTEGRATOR_OPTIONS),
+    ('lsoda', dict(INTEGRATOR_OPTIONS, mxstep=100000)),
+    ('vode', {'method': 'bdf', 'rtol': 1e-6, 'atol': 1e-8, 'nsteps': 100000}),
+    ('lsoda', {'rtol': 1e-8, 'atol': 1e-10, 'mxstep': 100000}),
+    ('lsoda', {'rtol': 1e-4, 'atol': 1e-6, 'mxstep': 100000}),
+]
+
+# negative values below -(NEGATIVE_ATOL_FACTOR * atol + NEGATIVE_RTOL * max)
+NEGATIVE_ATOL_FACTOR = 10
+NEGATIVE_RTOL = 1e-6
+# maximal relative change of a conserved monomer total
+CONSERVATION_RTOL = 1e-3
+
+STEP_LIMIT_MESSAGE = 'Excess work done'
+
+
+class SolverFailure(Exception):
+    """Raised if no integrator of the fallback ladder produced a healthy run."""
+
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+def get_conservation_matrix(model):
+    """Monomer counts per species for all monomers conserved by the network.
+
+    A monomer is conserved if no reaction changes its total count and it is
+    not part of a fixed initial condition. Returns (monomer names, matrix of
+    shape (species, conserved monomers)).
+    """
+    monomer_names = [m.name for m in model.monomers]
+    counts = np.zeros((len(model.species), len(monomer_names)))
+    for i, cp in enumerate(model.species):
+        for mp in cp.monomer_patterns:
+            counts[i, monomer_names.index(mp.monomer.name)] += 1
+
+    conserved = np.ones(len(monomer_names), dtype=bool)
+    for reaction in model.reactions:
+        delta = counts[list(reaction['products'])].sum(axis=0) \
+            - counts[list(reaction['reactants'])].sum(axis=0)
+        conserved &= delta == 0
+    for initial in model.initials:
+        if initial.fixed:
+            for mp in initial.pattern.monomer_patterns:
+                conserved[monomer_names.index(mp.monomer.name)] = False
+
+    names = [name for name, keep in zip(monomer_names, conserved) if keep]
+    return names, counts[:, conserved]
+
+
+def check_health(species, conservation, integrator_options,
+                 step_limit_hit=False):
+    """Return a list of problems found in a simulated trajectory."""
+    species = np.asarray(species)
+    problems = []
+    if step_limit_hit:
+        problems.append('step limit reached')
+    if not np.all(np.isfinite(species)):
+        n_rows = int(np.sum(~np.all(np.isfinite(species), axis=1)))
+        problems.append(f'non-finite values at {n_rows} time points')
+        return problems
+
+    atol = integrator_options.get('atol', 1e-8)
+    tolerance = NEGATIVE_ATOL_FACTOR * atol \
+        + NEGATIVE_RTOL * np.abs(species).max(axis=0)
+    negative = species < -tolerance
+    if np.any(negative):
+        problems.append(f'negative concentrations in '
+                        f'{int(np.any(negative, axis=0).sum())} species, '
+                        f'min {species.min():.3g}')
+
+    names, matrix = conservation
+    if len(names):
+        totals = species @ matrix
+        reference = np.maximum(np.abs(totals[0]), atol)
+        drift = np.abs(totals - totals[0]).max(axis=0) / reference
+        if np.any(drift > CONSERVATION_RTOL):
+            worst = int(np.argmax(drift))
+            problems.append(f'conservation drift of {names[worst]}: '
+                            f'{drift[worst]:.3g}')
+    return problems
+
+
+def get_fallback_ladder(integrator=INTEGRATOR, integrator_options=None):
+    """Fallback ladder starting with the requested integrator settings."""
+    if integrator_options is None:
+        integrator_options = INTEGRATOR_OPTIONS
+    first = (integrator, integrator_options)
+    return [first] + [rung for rung in FALLBACK_LADDER if rung != first]
+
+
+def simulate_with_fallback(model, tspan, simulate_fn, sim=None,
+                           ladder=None, reset_fn=None):
+    """Run simulate_fn(sim) with the fallback ladder until a run is healthy.
+
+    simulate_fn must return (tout, species). If sim is given it has to be
+    configured with the first rung of the ladder; later rungs get a new
+    simulator, whose compiled RHS comes from the Cython cache. reset_fn is
+    called after each failed attempt, e.g. to drop its checkpoint. Returns
+    (tout, species, solver metadata); raises SolverFailure if all rungs fail.
+    """
+    if ladder is None:
+        ladder = FALLBACK_LADDER
+    conservation = get_conservation_matrix(model)
+
+    attempts = []
+    for rung, (integrator, integrator_options) in enumerate(ladder):
+        if rung > 0 or sim is None:
+            sim = create_simulator(model, tspan, integrator,
+                                   integrator_options)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            try:
+                tout, species = simulate_fn(sim)
+            except SimulationInterrupted:
+                raise
+            except Exception as e:
+                tout, species = None, None
+                problems = [f'{type(e).__name__}: {e}']
+        if species is not None:
+            step_limit_hit = any(STEP_LIMIT_MESSAGE in str(w.message)
+                                 for w in caught)
+            problems = check_health(species, conservation,
+                                    integrator_options, step_limit_hit)
+
+        attempts.append({'integrator': integrator,
+                         'integrator_options': integrator_options,
+                         'problems': problems})
+        if not problems:
+            if rung > 0:
+                logger.info(f"Healthy run with fallback {rung}: "
+                            f"{integrator} {integrator_options}")
+            return tout, species, {
+                'integrator': integrator,
+                'integrator_options': json.dumps(integrator_options),
+                'solver_attempts': len(attempts),
+                'solver_problems': json.dumps(attempts[:-1]),
+            }
+        logger.warning(f"{integrator} {integrator_options}: "
+                       f"{'; '.join(problems)}")
+        if reset_fn is not None:
+            reset_fn()
+
+    raise SolverFailure(f'All {len(ladder)} integrators failed', attempts)
@@ -0,0 +1,298 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from simulation import make_condition
+
+logger = logging.getLogger(__name__)
+
+INPUTS = ['meki', 'rafi', 'egf', 'prafi']
+# (observable, feature) pairs
+DEFAULT_OUTPUTS = [('pERK', 'steady_state'), ('pERK', 'peak')]
+# concentrations below this are treated as untreated on the log scale
+LOG_FLOOR = 1e-4
+# above this many points the hyperparameters are fitted on a subsample
+MAX_FIT_POINTS = 1000
+# fall back to simulation if the predictive std exceeds this fraction of the
+# spread of the training outputs
+MAX_RELATIVE_STD = 0.05
+
+
+def condition_inputs(conditions):
+    """Log-concentration inputs of conditions, shape (conditions, INPUTS)."""
+    values = np.array([[c.get(name, 0.0) for name in INPUTS]
+                       for c in conditions], dtype=float)
+    return np.log10(np.maximum(values, LOG_FLOOR))
+
+
+def _squared_distances(a, b, lengthscales):
+    a = a / lengthscales
+    b = b / lengthscales
+    return np.maximum((a ** 2).sum(axis=1)[:, None]
+                      + (b ** 2).sum(axis=1)[None, :] - 2 * a @ b.T, 0.0)
+
+
+class GaussianProcessSurrogate:
+    """Gaussian process emulator of condition features.
+
+    Uses a squared-exponential kernel with one lengthscale per input on
+    standardized inputs and outputs. All outputs share the kernel, so a
+    single Cholesky factor serves every feature. Outputs are
+    (observable, feature) pairs.
+    """
+
+    def __init__(self, lengthscales, signal_variance, noise_variance,
+                 input_mean, input_scale, output_mean, output_scale,
+                 outputs):
+        self.lengthscales = np.asarray(lengthscales, dtype=float)
+        self.signal_variance = float(signal_variance)
+        self.noise_variance = float(noise_variance)
+        self.input_mean = np.asarray(input_mean, dtype=float)
+        self.input_scale = np.asarray(input_scale, dtype=float)
+        self.output_mean = np.asarray(output_mean, dtype=float)
+        self.output_scale = np.asarray(output_scale, dtype=float)
+        self.outputs = [tuple(str(name) for name in output)
+                        for output in outputs]
+        self.x_train = None
+        self.y_train = None
+        self.alpha = None
+        self.cholesky = None
+
+    def _kernel(self, a, b):
+        return self.signal_variance * np.exp(
+            -0.5 * _squared_distances(a, b, self.lengthscales)
+        )
+
+    def _standardize(self, x):
+        return (np.asarray(x, dtype=float) - self.input_mean) \
+            / self.input_scale
+
+    def condition(self, x, y):
+        """Condition the process on training inputs and outputs."""
+        from scipy.linalg import cho_factor, cho_solve
+
+        self.x_train = self._standardize(x)
+        self.y_train = np.asarray(y, dtype=float)
+        z = (self.y_train - self.output_mean) / self.output_scale
+        k = self._kernel(self.x_train, self.x_train)
+        k[np.diag_indices_from(k)] += self.noise_variance
+        self.cholesky = cho_factor(k, lower=True)
+        self.alpha = cho_solve(self.cholesky, z)
+        return self
+
+    def predict(self, x):
+        """Return predictive mean and std, each of shape (points, outputs)."""
+        from scipy.linalg import solve_triangular
+
+        x = self._standardize(x)
+        k_star = self._kernel(x, self.x_train)
+        mean = k_star @ self.alpha
+        v = solve_triangular(self.cholesky[0], k_star.T, lower=True)
+        variance = np.maximum(self.signal_variance - (v ** 2).sum(axis=0),
+                              0.0)
+        std = np.sqrt(variance)[:, None] * self.output_scale
+        return mean * self.output_scale + self.output_mean, \
+            np.broadcast_to(std, mean.shape).copy()
+
+    def save(self, output_file):
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        tmp_file = f'{output_file}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file, lengthscales=self.lengthscales,
+                 signal_variance=self.signal_variance,
+                 noise_variance=self.noise_variance,
+                 input_mean=self.input_mean, input_scale=self.input_scale,
+                 output_mean=self.output_mean,
+                 output_scale=self.output_scale,
+                 outputs=np.array(self.outputs),
+                 x_train=self.x_train * self.input_scale + self.input_mean,
+                 y_train=self.y_train)
+        os.replace(tmp_file, output_file)
+        return output_file
+
+    @classmethod
+    def load(cls, surrogate_file):
+        with np.load(surrogate_file) as f:
+            surrogate = cls(f['lengthscales'], f['signal_variance'],
+                            f['noise_variance'], f['input_mean'],
+                            f['input_scale'], f['output_mean'],
+                            f['output_scale'],
+                            f['outputs'].astype(str).reshape(-1, 2))
+            return surrogate.condition(f['x_train'], f['y_train'])
+
+
+def _negative_log_likelihood(log_params, x, z):
+    from scipy.linalg import cho_factor, cho_solve
+
+    n_inputs = x.shape[1]
+    lengthscales = np.exp(log_params[:n_inputs])
+    signal_variance, noise_variance = np.exp(log_params[n_inputs:])
+    k = signal_variance * np.exp(-0.5 * _squared_distances(x, x,
+                                                           lengthscales))
+    k[np.diag_indices_from(k)] += noise_variance + 1e-10
+    try:
+        cholesky = cho_factor(k, lower=True)
+    except np.linalg.LinAlgError:
+        return np.inf
+    alpha = cho_solve(cholesky, z)
+    log_det = 2 * np.log(np.diag(cholesky[0])).sum()
+    # summed over the outputs sharing the kernel
+    return 0.5 * (z * alpha).sum() + 0.5 * z.shape[1] * log_det
+
+
+def fit_surrogate(x, y, outputs, seed=0):
+    """Fit kernel hyperparameters by maximum marginal likelihood."""
+    from scipy.optimize import minimize
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    input_mean = x.mean(axis=0)
+    input_scale = np.where(x.std(axis=0) > 0, x.std(axis=0), 1.0)
+    output_mean = y.mean(axis=0)
+    output_scale = np.where(y.std(axis=0) > 0, y.std(axis=0), 1.0)
+    x_std = (x - input_mean) / input_scale
+    z = (y - output_mean) / output_scale
+
+    rng = np.random.default_rng(seed)
+    subset = np.arange(len(x))
+    if len(x) > MAX_FIT_POINTS:
+        subset = rng.choice(len(x), MAX_FIT_POINTS, replace=False)
+    initial = np.concatenate([np.zeros(x.shape[1]), [0.0, np.log(1e-3)]])
+    bounds = [(np.log(1e-2), np.log(1e2))] * x.shape[1] \
+        + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), np.log(1.0))]
+    result = minimize(_negative_log_likelihood, initial,
+                      args=(x_std[subset], z[subset]), method='L-BFGS-B',
+                      bounds=bounds)
+    n_inputs = x.shape[1]
+    params = np.exp(result.x)
+    surrogate = GaussianProcessSurrogate(
+        params[:n_inputs], params[n_inputs], params[n_inputs + 1],
+        input_mean, input_scale, output_mean, output_scale, outputs
+    )
+    logger.info(f"Fitted surrogate on {len(x)} points, lengthscales "
+                f"{dict(zip(INPUTS, np.round(params[:n_inputs], 3)))}, "
+                f"noise {params[n_inputs + 1]:.2g}")
+    return surrogate.condition(x, y)
+
+
+def get_surrogate_file(store_dir, cell_line):
+    return os.path.join(store_dir, 'surrogate', f'{cell_line}.npz')
+
+
+def train_from_features(feature_file, cell_line, outputs=None, seed=0):
+    """Train a surrogate on the feature table of a result store."""
+    from features import feature_column, load_feature_table
+
+    if outputs is None:
+        outputs = DEFAULT_OUTPUTS
+    columns = [feature_column(*output) for output in outputs]
+    table = load_feature_table(feature_file)
+    table = table[table['cell_line'] == cell_line].dropna(subset=columns)
+    if table.empty:
+        raise RuntimeError(f'No {cell_line} features in {feature_file}')
+    conditions = [
+        make_condition(cell_line, row.meki_concentration,
+                       row.egf_concentration,
+                       getattr(row, 'rafi_concentration', 0.0),
+                       getattr(row, 'prafi_concentration', 0.0))
+        for row in table.itertuples()
+    ]
+    return fit_surrogate(condition_inputs(conditions),
+                         table[columns].to_numpy(), outputs, seed=seed)
+
+
+def simulate_features(conditions, store_dir, outputs):
+    """Simulate conditions through the sweep and return their outputs."""
+    from dose_response import load_responses
+    from sweep import run_sweep
+
+    if not run_sweep(conditions, store_dir):
+        raise RuntimeError('Simulation stopped by a signal')
+    values = np.empty((len(conditions), len(outputs)))
+    for j, (observable, feature) in enumerate(outputs):
+        values[:, j] = load_responses(store_dir, conditions, observable,
+                                      feature)
+    return values
+
+
+def screen(surrogate, conditions, store_dir=None,
+           max_relative_std=MAX_RELATIVE_STD):
+    """Predict outputs of conditions, simulating where the surrogate is unsure.
+
+    A prediction is uncertain if its std exceeds max_relative_std times the
+    spread of the training outputs for any output. Uncertain conditions are
+    simulated into store_dir (if given) and their simulated values returned
+    instead. Returns (values, std, simulated mask); simulated rows have zero
+    std.
+    """
+    mean, std = surrogate.predict(condition_inputs(conditions))
+    uncertain = np.any(std > max_relative_std * surrogate.output_scale,
+                       axis=1)
+    if store_dir is not None and np.any(uncertain):
+        logger.info(f"{int(uncertain.sum())} of {len(conditions)} "
+                    f"predictions uncertain, simulating them")
+        indices = np.flatnonzero(uncertain)
+        mean[indices] = simulate_features([conditions[i] for i in indices],
+                                          store_dir, surrogate.outputs)
+        std[indices] = 0.0
+    else:
+        uncertain[:] = False
+    return mean, std, uncertain
+
+
+if __name__ == '__main__':
+    from features import get_feature_file
+    from sweep import add_condition_arguments, get_conditions
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Train a feature surrogate or screen conditions with it'
+    )
+    parser.add_argument('command', choices=['train', 'screen'])
+    add_condition_arguments(parser)
+    parser.add_argument('--outputs', nargs='+',
+                        type=lambda output: tuple(output.split(':', 1)),
+                        default=DEFAULT_OUTPUTS,
+                        help='Features as <observable>:<feature>')
+    parser.add_argument('--max-relative-std', type=float,
+                        default=MAX_RELATIVE_STD)
+    parser.add_argument('--no-fallback', action='store_true',
+                        help='Never simulate uncertain conditions')
+    parser.add_argument('--output', type=str, default=None,
+                        help='CSV file for screening results')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        for cell_line in args.cell_lines:
+            surrogate = train_from_features(get_feature_file(args.store),
+                                            cell_line, args.outputs)
+            surrogate.save(get_surrogate_file(args.store, cell_line))
+    else:
+        import pandas as pd
+        from features import feature_column
+
+        conditions = get_conditions(args)
+        tables = []
+        for cell_line in sorted({c['cell_line'] for c in conditions}):
+            subset = [c for c in conditions if c['cell_line'] == cell_line]
+            surrogate = GaussianProcessSurrogate.load(
+                get_surrogate_file(args.store, cell_line))
+            values, std, simulated = screen(
+                surrogate, subset,
+                None if args.no_fallback else args.store,
+                args.max_relative_std
+            )
+            table = pd.DataFrame([{name: c.get(name, 0.0)
+                                   for name in ['cell_line'] + INPUTS}
+                                  for c in subset])
+            for j, output in enumerate(surrogate.outputs):
+                table[feature_column(*output)] = values[:, j]
+                table[f'{feature_column(*output)}_std'] = std[:, j]
+            table['simulated'] = simulated
+            tables.append(table)
+        table = pd.concat(tables, ignore_index=True)
+        if args.output:
+            table.to_csv(args.output, index=False)
+        else:
+            print(table.to_string())
@@ -0,0 +1,208 @@
+import argparse
+import csv
+import itertools
+import logging
+import os
+import sys
+import time
+
+from checkpoint import (SimulationInterrupted, get_checkpoint_file,
+                        install_signal_handlers, remove_checkpoint,
+                        simulate_checkpointed, stop_requested)
+from manifest import (get_interrupted, get_results_file, get_run_hash,
+                      is_complete, is_failed, mark_done, mark_failed,
+                      mark_running)
+from model_cache import (hash_model_source, load_model,
+                         normalize_modifications)
+from registry import load_registry
+from simulation import (INTEGRATOR, INTEGRATOR_OPTIONS, MODEL_NAME,
+                        MODEL_VARIANT, configure_model, create_simulator,
+                        get_condition_key, get_tspan, make_condition,
+                        save_results)
+from solver_health import (SolverFailure, get_fallback_ladder,
+                           simulate_with_fallback)
+
+logger = logging.getLogger(__name__)
+
+
+def make_condition_grid(cell_lines, meki_concentrations, egf_concentrations,
+                        rafi_concentrations=(0.0,),
+                        prafi_concentrations=(0.0,)):
+    return [
+        make_condition(cell_line, meki, egf, rafi, prafi)
+        for cell_line, meki, egf, rafi, prafi in itertools.product(
+            cell_lines, meki_concentrations, egf_concentrations,
+            rafi_concentrations, prafi_concentrations
+        )
+    ]
+
+
+def load_conditions(conditions_file):
+    """Read conditions from a CSV file with cell_line, meki and egf columns.
+
+    rafi and prafi columns are optional. Concentrations are in the units of
+    the condition registry unless a ``<column>_unit`` column (e.g.
+    ``meki_unit`` with ``nM``) gives another unit.
+    """
+    registry = load_registry()
+
+    def dose(row, name):
+        return registry.to_model_units(name, float(row.get(name) or 0),
+                                       row.get(f'{name}_unit') or None)
+
+    with open(conditions_file, newline='') as f:
+        return [
+            make_condition(row['cell_line'], dose(row, 'meki'),
+                           dose(row, 'egf'), dose(row, 'rafi'),
+                           dose(row, 'prafi'))
+            for row in csv.DictReader(f)
+        ]
+
+
+def run_sweep(conditions, store_dir, force=False, integrator=INTEGRATOR,
+              integrator_options=None, checkpoint_interval=None,
+              variant=MODEL_VARIANT, modifications=None, codec_options=None,
+              parameter_index=0):
+    """Simulate all conditions into a result store, skipping valid results.
+
+    Each condition is written to ``<store_dir>/<key>.h5`` and recorded in the
+    store manifest. Conditions whose manifest hash matches the current inputs
+    are not simulated again, so re-running an interrupted or modified sweep
+    only costs the missing or changed conditions. Integrations stop at the
+    next output time after a signal and are checkpointed then and every
+    checkpoint_interval seconds; they resume from their last checkpoint.
+    Unhealthy runs are retried with the fallback integrators of
+    solver_health; conditions where all of them fail are marked as failed in
+    the manifest and skipped. variant and modifications select the model
+    instance and parameter_index the row of the multistart parameter table.
+    With codec_options, trajectories are stored compressed (see codec.py).
+    Returns False if the sweep was stopped by a signal.
+    """
+    if integrator_options is None:
+        integrator_options = INTEGRATOR_OPTIONS
+    os.makedirs(store_dir, exist_ok=True)
+
+    interrupted = get_interrupted(store_dir)
+    if interrupted:
+        logger.info(f"Resuming sweep, {len(interrupted)} runs were "
+                    f"interrupted")
+
+    modifications = normalize_modifications(modifications)
+    model = load_model(MODEL_NAME, variant, modifications=modifications)
+    model_hash = hash_model_source(MODEL_NAME, variant, modifications)
+    equil_time, tspan = get_tspan()
+    sim = None
+
+    ladder = get_fallback_ladder(integrator, integrator_options)
+
+    n_skipped = 0
+    n_failed = 0
+    for condition in conditions:
+        key = get_condition_key(condition)
+        egf = configure_model(model, condition, parameter_index)
+        run_hash = get_run_hash(model, model_hash, condition, tspan,
+                                integrator, integrator_options)
+
+        if not force and is_complete(store_dir, key, run_hash):
+            n_skipped += 1
+            continue
+        if not force and is_failed(store_dir, key, run_hash):
+            logger.info(f"Skipping {key}, all integrators failed before")
+            n_failed += 1
+            continue
+
+        # the simulator is created after the first configure_model call,
+        # which may still add parameters to the model
+        if sim is None:
+            sim = create_simulator(model, tspan, integrator,
+                                   integrator_options)
+
+        logger.info(f"Simulating {key}")
+        mark_running(store_dir, key, run_hash)
+        start_time = time.time()
+        checkpoint_file = get_checkpoint_file(store_dir, key)
+
+        def simulate_fn(sim):
+            return simulate_checkpointed(
+                sim, model, equil_time, egf, tspan, checkpoint_file,
+                run_hash, checkpoint_interval=checkpoint_interval
+            )
+
+        try:
+            tout, species, solver_info = simulate_with_fallback(
+                model, tspan, simulate_fn, sim=sim, ladder=ladder,
+                reset_fn=lambda: remove_checkpoint(checkpoint_file)
+            )
+        except SimulationInterrupted as e:
+            logger.warning(f"{key}: {e}; rerun the sweep to resume")
+            return False
+        except SolverFailure as e:
+            # a failing condition must not stop the rest of the sweep
+            logger.error(f"{key}: {e}")
+            mark_failed(store_dir, key, run_hash,
+                        {'attempts': e.attempts,
+                         'runtime': time.time() - start_time})
+            n_failed += 1
+            continue
+        save_results(get_results_file(store_dir, key), tout, species,
+                     condition, attrs=dict(solver_info, run_hash=run_hash,
+                                           model_variant=variant,
+                                           modifications=modifications or ''),
+                     codec_options=codec_options)
+        mark_done(store_dir, key, run_hash,
+                  dict(solver_info, runtime=time.time() - start_time))
+        remove_checkpoint(checkpoint_file)
+
+        if stop_requested():
+            logger.warning("Stopping sweep after signal; rerun to resume")
+            return False
+
+    logger.info(f"Sweep finished: "
+                f"{len(conditions) - n_skipped - n_failed} simulated, "
+                f"{n_skipped} already complete, {n_failed} failed")
+    return True
+
+
+def add_condition_arguments(parser):
+    parser.add_argument('--store', type=str, default='results/sweep',
+                        help='Result store directory')
+    parser.add_argument('--conditions', type=str, default=None,
+                        help='CSV file with cell_line, meki, egf columns')
+    parser.add_argument('--cell-lines', nargs='+', default=['mutant'],
+                        choices=list(load_registry().cell_lines))
+    parser.add_argument('--meki', nargs='+', type=float, default=[0.0])
+    parser.add_argument('--egf', nargs='+', type=float, default=[0.0])
+    parser.add_argument('--rafi', nargs='+', type=float, default=[0.0])
+    parser.add_argument('--prafi', nargs='+', type=float, default=[0.0])
+    parser.add_argument('--force', action='store_true',
+                        help='Re-simulate conditions with valid results')
+    parser.add_argument('--checkpoint-interval', type=float, default=None,
+                        help='Checkpoint each integration every this many '
+                             'seconds and resume from existing checkpoints')
+
+
+def get_conditions(args):
+    if args.conditions is not None:
+        return load_conditions(args.conditions)
+    return make_condition_grid(args.cell_lines, args.meki, args.egf,
+                               args.rafi, args.prafi)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Simulate a set of conditions into a result store'
+    )
+    add_condition_arguments(parser)
+    parser.add_argument('--compress-rtol', type=float, default=None,
+                        help='Store trajectories compressed with this '
+                             'tolerance relative to each species maximum')
+    args = parser.parse_args()
+
+    codec_options = None if args.compress_rtol is None \
+        else {'rtol': args.compress_rtol}
+    install_signal_handlers()
+    if not run_sweep(get_conditions(args), args.store, force=args.force,
+                     checkpoint_interval=args.checkpoint_interval,
+                     codec_options=codec_options):
+        sys.exit(1)
@@ -0,0 +1,138 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+
+from checkpoint import install_signal_handlers
+from distributed import _run_shard_process, merge_store, warm_up
+from model_cache import get_modification_file, normalize_modifications
+from paths import DATASET, get_directory, get_model_name_dataset
+from simulation import MODEL_NAME
+from sweep import add_condition_arguments, get_conditions
+
+logger = logging.getLogger(__name__)
+
+
+def discover_variants(name=MODEL_NAME):
+    """Variants with a flat model module ``models/<name>__<variant>.py``."""
+    pattern = os.path.join(get_directory(), 'models', f'{name}__*.py')
+    return sorted(os.path.basename(path)[len(name) + 2:-3]
+                  for path in glob.glob(pattern))
+
+
+def discover_modifications():
+    """Modifications defined as ``models/modifications/<name>.json``."""
+    pattern = get_modification_file('*')
+    return sorted(os.path.splitext(os.path.basename(path))[0]
+                  for path in glob.glob(pattern))
+
+
+def get_instances(name=MODEL_NAME, variants=None, modification_sets=None):
+    """(variant, modifications) pairs of a model comparison.
+
+    Every variant is combined with every modification set; None stands for
+    the unmodified variant. By default all discovered variants are run
+    unmodified and with each single discovered modification.
+    """
+    if variants is None:
+        variants = discover_variants(name)
+    if modification_sets is None:
+        modification_sets = [None] + discover_modifications()
+    return [(variant, normalize_modifications(modifications))
+            for variant in variants for modifications in modification_sets]
+
+
+def get_instance_store(store_dir, variant, modifications, name=MODEL_NAME):
+    return os.path.join(store_dir, get_model_name_dataset(
+        name, variant, DATASET, normalize_modifications(modifications)
+    ))
+
+
+def _warm_up_process(args):
+    conditions, variant, modifications = args
+    logging.basicConfig(level=logging.INFO)
+    warm_up(conditions, variant, modifications)
+
+
+def build_instances(conditions, instances, n_processes):
+    """Build the network, snapshot and compiled RHS of every instance.
+
+    Variants are built in parallel first; modified instances then only copy
+    their variant's network and reuse its compiled RHS.
+    """
+    from multiprocessing import Pool
+
+    with Pool(n_processes) as pool:
+        variants = sorted({variant for variant, _ in instances})
+        pool.map(_warm_up_process,
+                 [(conditions, variant, None) for variant in variants])
+        pool.map(_warm_up_process,
+                 [(conditions, variant, modifications)
+                  for variant, modifications in instances if modifications])
+
+
+def run_variants(conditions, store_dir, instances, n_processes, force=False,
+                 checkpoint_interval=None):
+    """Run the same conditions for several model instances in parallel.
+
+    Each instance gets its own result store below store_dir, named like its
+    build directory, and is split into shards so that all n_processes
+    workers are busy. Completed stores are merged. Returns False if any
+    shard was stopped by a signal.
+    """
+    from multiprocessing import Pool
+
+    build_instances(conditions, instances, n_processes)
+    n_shards = max(1, -(-n_processes // len(instances)))
+    tasks = [(conditions, get_instance_store(store_dir, variant,
+                                             modifications),
+              shard, n_shards, force, checkpoint_interval, variant,
+              modifications, 0)
+             for variant, modifications in instances
+             for shard in range(n_shards)]
+    logger.info(f"Running {len(conditions)} conditions for "
+                f"{len(instances)} model instances in {len(tasks)} shards")
+    with Pool(n_processes) as pool:
+        if not all(pool.map(_run_shard_process, tasks)):
+            return False
+
+    for variant, modifications in instances:
+        merge_store(get_instance_store(store_dir, variant, modifications),
+                    conditions)
+    return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Run a condition set across model variants and '
+                    'modification sets'
+    )
+    parser.add_argument('command', choices=['list', 'run'])
+    add_condition_arguments(parser)
+    parser.add_argument('--variants', nargs='+', default=None,
+                        help='Variants to compare (default: all discovered)')
+    parser.add_argument('--modifications', nargs='+', default=None,
+                        help='Modification sets, e.g. A B_C; "none" for '
+                             'the unmodified variant (default: none and '
+                             'every discovered modification)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    modification_sets = None
+    if args.modifications is not None:
+        modification_sets = [None if m == 'none' else m
+                             for m in args.modifications]
+    instances = get_instances(MODEL_NAME, args.variants, modification_sets)
+
+    if args.command == 'list':
+        for variant, modifications in instances:
+            print(get_model_name_dataset(MODEL_NAME, variant, DATASET,
+                                         modifications))
+    else:
+        install_signal_handlers()
+        if not run_variants(get_conditions(args), args.store, instances,
+                            args.processes, force=args.force,
+                            checkpoint_interval=args.checkpoint_interval):
+            sys.exit(1)
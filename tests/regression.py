@@ -0,0 +1,296 @@
+"""Golden trajectories and performance budgets of the default model.
+
+Golden observable trajectories of representative conditions are simulated
+with the reference engine (PySB ScipyOdeSimulator through
+simulation.simulate) and stored compactly in ``tests/golden``. Engines are
+functions that simulate a list of cases; new engines are checked against
+the golden trajectories within ENGINE_RTOL. measure_phases times the phases
+of a single run and records peak traced memory, which the tests compare
+with ``tests/budgets.json``.
+
+Regenerate after an intended change of the model or its parameters:
+```bash
+python tests/regression.py golden
+python tests/regression.py budgets
+```
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from model_cache import hash_model_source, load_model  # noqa: E402
+from simulation import (MIN_CONC, MODEL_NAME, MODEL_VARIANT,  # noqa: E402
+                        make_condition)
+
+logger = logging.getLogger(__name__)
+
+GOLDEN_FILE = os.path.join(TESTS_DIR, 'golden',
+                           f'{MODEL_NAME}__{MODEL_VARIANT}.npz')
+BUDGETS_FILE = os.path.join(TESTS_DIR, 'budgets.json')
+
+OBSERVABLES = ['pERK', 'pMEK', 'pEGFR', 'gtpRAS', 'tDUSP']
+
+# EGF is washed out at this time in pulse cases
+PULSE_END = 600.0
+
+CASES = [
+    {'name': 'wildtype_egf',
+     'condition': make_condition('wildtype', 0.0, 0.5)},
+    {'name': 'wildtype_egf_meki',
+     'condition': make_condition('wildtype', 1.0, 0.5)},
+    {'name': 'wildtype_egf_rafi',
+     'condition': make_condition('wildtype', 0.0, 0.5, rafi=1.0)},
+    {'name': 'wildtype_egf_pulse',
+     'condition': make_condition('wildtype', 0.0, 0.5), 'pulse': True},
+    {'name': 'mutant_egf',
+     'condition': make_condition('mutant', 0.0, 0.5)},
+    {'name': 'mutant_egf_meki',
+     'condition': make_condition('mutant', 1.0, 0.5)},
+    {'name': 'mutant_egf_rafi',
+     'condition': make_condition('mutant', 0.0, 0.5, rafi=1.0)},
+    {'name': 'mutant_egf_pulse',
+     'condition': make_condition('mutant', 0.0, 0.5), 'pulse': True},
+]
+
+# deviation allowed per observable: ATOL + RTOL * max(|golden|)
+REFERENCE_RTOL = 1e-4
+ENGINE_RTOL = 1e-3
+ATOL = 1e-8
+
+PHASES = ['restore_model', 'configure', 'create_simulator', 'integrate',
+          'save']
+# recorded budgets are the measurement times this factor
+BUDGET_HEADROOM = 2.0
+
+
+def get_model():
+    return load_model(MODEL_NAME, MODEL_VARIANT)
+
+
+def _egf_species(model):
+    """Index of the fixed EGF species and its initial condition."""
+    for initial in model.initials:
+        if initial.pattern.monomer_patterns[0].monomer.name == 'EGF':
+            return model.get_species_index(initial.pattern), initial
+    raise ValueError('The model has no EGF initial condition')
+
+
+def _split_tspan(tspan):
+    """Time points up to and from the end of the EGF pulse."""
+    return tspan[tspan <= PULSE_END], tspan[tspan >= PULSE_END]
+
+
+def simulate_reference(model, cases, tspan, equil_time):
+    """Reference engine: simulation.simulate, and two runs for pulses."""
+    from simulation import configure_model, create_simulator, simulate
+
+    results = []
+    sim = None
+    egf_index, egf_initial = _egf_species(model)
+    for case in cases:
+        egf = configure_model(model, case['condition'])
+        if sim is None:
+            sim = create_simulator(model, tspan)
+        if not case.get('pulse'):
+            output = simulate(sim, model, equil_time, egf)
+            results.append(np.asarray(output.species))
+            continue
+        before, after = _split_tspan(tspan)
+        model.parameters['EGF_0'].value = egf
+        first = np.asarray(sim.run(tspan=before).species)
+        model.parameters['EGF_0'].value = MIN_CONC
+        state = first[-1].copy()
+        state[egf_index] = egf_initial.value.get_value() \
+            if hasattr(egf_initial.value, 'get_value') \
+            else egf_initial.value.value
+        second = np.asarray(sim.run(tspan=after, initials=state).species)
+        results.append(np.concatenate([first, second[1:]]))
+    return results
+
+
+def simulate_batched(model, cases, tspan, equil_time):
+    """Batched engine: all cases in one lockstep batch."""
+    from batched import BatchedModel, integrate
+    from registry import load_registry
+
+    compiled = load_registry().compile(model)
+    values = compiled.parameter_matrix([case['condition'] for case in cases])
+    batched_model = BatchedModel(model,
+                                 model_hash=hash_model_source(MODEL_NAME,
+                                                              MODEL_VARIANT))
+    before, after = _split_tspan(tspan)
+    first, success, _ = integrate(batched_model, before, values)
+    state = first[:, -1].copy()
+    pulse = np.array([bool(case.get('pulse')) for case in cases])
+    egf_index, _ = _egf_species(model)
+    washout = batched_model.initial_values(
+        compiled.pre_equilibration_values(values))
+    state[pulse, egf_index] = washout[pulse, egf_index]
+    second, success_after, _ = integrate(batched_model, after, values,
+                                         initials=state)
+    if not np.all(success & success_after):
+        failed = [case['name'] for case, ok in
+                  zip(cases, success & success_after) if not ok]
+        raise RuntimeError(f'Batched integration failed for {failed}')
+    return list(np.concatenate([first, second[:, 1:]], axis=1))
+
+
+ENGINES = {
+    'reference': simulate_reference,
+    'batched': simulate_batched,
+}
+
+
+def simulate_observables(engine, cases=None):
+    """Observable trajectories of cases, (cases, observables, time)."""
+    from features import get_observable_matrix
+    from simulation import get_tspan
+
+    cases = cases or CASES
+    model = get_model()
+    equil_time, tspan = get_tspan()
+    matrix = get_observable_matrix(model, OBSERVABLES)
+    species = ENGINES[engine](model, cases, tspan, equil_time)
+    return tspan, np.array([np.swapaxes(s @ matrix, 0, 1) for s in species])
+
+
+def write_golden(golden_file=GOLDEN_FILE):
+    """Simulate the cases with the reference engine and store them."""
+    tspan, values = simulate_observables('reference')
+    os.makedirs(os.path.dirname(golden_file), exist_ok=True)
+    np.savez_compressed(
+        golden_file, time=tspan, values=values.astype('f4'),
+        cases=np.array([case['name'] for case in CASES]),
+        observables=np.array(OBSERVABLES),
+        model_hash=np.array(hash_model_source(MODEL_NAME, MODEL_VARIANT)),
+    )
+    logger.info(f"Wrote golden trajectories to {golden_file}")
+    return golden_file
+
+
+def load_golden(golden_file=GOLDEN_FILE):
+    with np.load(golden_file) as f:
+        return {name: f[name] for name in f.files}
+
+
+def trajectory_errors(values, golden, rtol):
+    """Largest deviation of each case and observable in units of its
+    allowed deviation; values above 1 fail."""
+    golden = np.asarray(golden, dtype=float)
+    allowed = ATOL + rtol * np.abs(golden).max(axis=-1, keepdims=True)
+    return (np.abs(np.asarray(values) - golden) / allowed).max(axis=-1)
+
+
+def measure_phases(case=None):
+    """Wall time (s) and peak traced memory (MB) of the phases of one run.
+
+    Memory is measured with tracemalloc, so it covers Python and NumPy
+    allocations but not the Cython compiler running as a subprocess.
+    """
+    import h5py
+    from codec import read_trajectories
+    from model_cache import read_model_snapshot
+    from simulation import (configure_model, create_simulator, get_tspan,
+                            save_results, simulate)
+
+    case = case or CASES[0]
+    # the snapshot is built outside the measurement
+    get_model()
+    equil_time, tspan = get_tspan()
+    measurements = {}
+    state = {}
+
+    def phase(name, fn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = fn()
+        finally:
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        measurements[name] = {'seconds': seconds, 'peak_mb': peak / 2 ** 20}
+        return result
+
+    def save():
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results_file = os.path.join(tmp_dir, 'results.h5')
+            save_results(results_file, tspan, state['species'],
+                         case['condition'])
+            with h5py.File(results_file, 'r') as f:
+                read_trajectories(f)
+
+    model = phase('restore_model',
+                  lambda: read_model_snapshot(MODEL_NAME, MODEL_VARIANT))
+    egf = phase('configure', lambda: configure_model(model,
+                                                     case['condition']))
+    sim = phase('create_simulator', lambda: create_simulator(model, tspan))
+    state['species'] = np.asarray(phase(
+        'integrate', lambda: simulate(sim, model, equil_time, egf)
+    ).species)
+    phase('save', save)
+    return measurements
+
+
+def load_budgets(budgets_file=BUDGETS_FILE):
+    with open(budgets_file) as f:
+        return json.load(f)
+
+
+def check_budgets(measurements, budgets):
+    """Phases that exceeded their time or memory budget."""
+    return [
+        f"{name}: {measurements[name][key]:.3g} > {budgets[name][key]:.3g} "
+        f"{key}"
+        for name in PHASES if name in budgets
+        for key in ['seconds', 'peak_mb']
+        if measurements[name][key] > budgets[name][key]
+    ]
+
+
+def write_budgets(measurements, budgets_file=BUDGETS_FILE):
+    budgets = {
+        name: {key: round(BUDGET_HEADROOM * value, 3)
+               for key, value in measurements[name].items()}
+        for name in PHASES
+    }
+    with open(budgets_file, 'w') as f:
+        json.dump(budgets, f, indent=2)
+        f.write('\n')
+    return budgets
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Regenerate golden trajectories or performance budgets'
+    )
+    parser.add_argument('command', choices=['golden', 'budgets', 'check'])
+    parser.add_argument('--engine', choices=list(ENGINES), default='batched',
+                        help='Engine compared by check')
+    args = parser.parse_args()
+
+    if args.command == 'golden':
+        write_golden()
+    elif args.command == 'budgets':
+        print(json.dumps(write_budgets(measure_phases()), indent=2))
+    else:
+        golden = load_golden()
+        _, values = simulate_observables(args.engine)
+        errors = trajectory_errors(values, golden['values'], ENGINE_RTOL)
+        for name, row in zip(golden['cases'], errors):
+            print(f"{name:24s} " + ' '.join(
+                f'{observable}={error:.3g}'
+                for observable, error in zip(golden['observables'], row)
+            ))
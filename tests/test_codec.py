@@ -0,0 +1,67 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from codec import (compress_trajectories, decompress_trajectories,  # noqa: E402
+                   pla_knots)
+
+
+def _trajectories():
+    time = np.concatenate([np.linspace(-600, 0, 4), np.linspace(0, 7200, 400)])
+    time = np.unique(time)
+    t = np.maximum(time, 0)
+    return time, np.column_stack([
+        np.full_like(time, 3.0),                      # flat
+        100 * t / 3600 * np.exp(1 - t / 3600),        # transient peak
+        1 - np.exp(-t / 60) + 0.1 * np.sin(t / 100),  # oscillating
+        1e-9 * (1 + np.cos(t / 500)),                 # below atol
+    ])
+
+
+@pytest.mark.parametrize('rtol', [1e-2, 1e-4, 1e-6])
+def test_error_bound(rtol):
+    time, species = _trajectories()
+    atol = 1e-8
+    compressed = compress_trajectories(time, species, rtol, atol)
+    restored = decompress_trajectories(
+        time, compressed['counts'], compressed['index_delta'],
+        compressed['values']
+    )
+    bound = atol + rtol * np.abs(species).max(axis=0)
+    assert np.all(np.abs(restored - species) <= bound)
+    assert np.all(compressed['max_error'] <= bound)
+
+
+def test_peaks_and_flat_series():
+    time, species = _trajectories()
+    compressed = compress_trajectories(time, species, 1e-4, 1e-8)
+    restored = decompress_trajectories(
+        time, compressed['counts'], compressed['index_delta'],
+        compressed['values']
+    )
+    np.testing.assert_array_equal(restored.max(axis=0), species.max(axis=0))
+    np.testing.assert_array_equal(restored.min(axis=0), species.min(axis=0))
+    assert compressed['counts'][0] == 2
+    assert compressed['counts'][1] < len(time) / 4
+
+
+def test_non_finite_series_are_kept():
+    time = np.arange(10.0)
+    values = np.ones(10)
+    values[4] = np.nan
+    np.testing.assert_array_equal(pla_knots(time, values, 1e-3),
+                                  np.arange(10))
+
+
+def test_column_subset():
+    time, species = _trajectories()
+    compressed = compress_trajectories(time, species)
+    restored = decompress_trajectories(
+        time, compressed['counts'], compressed['index_delta'],
+        compressed['values'], columns=[2, 1]
+    )
+    full = decompress_trajectories(
+        time, compressed['counts'], compressed['index_delta'],
+        compressed['values']
+    )
+    np.testing.assert_array_equal(restored, full[:, [2, 1]])
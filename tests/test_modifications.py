@@ -0,0 +1,94 @@
+"""Parameter overrides of modified model instances.
+
+The tests build a small network with BioNetGen, so they are skipped where
+PySB or BioNetGen is not installed.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('pysb')
+
+from pysb import (Initial, Model, Monomer, Observable, Parameter,  # noqa: E402
+                  Rule)
+from pysb.simulator import ScipyOdeSimulator  # noqa: E402
+
+import registry as registry_module  # noqa: E402
+from model_cache import apply_modifications  # noqa: E402
+from parameter_store import ParameterStore, write_parameter_store  # noqa: E402
+from simulation import make_condition  # noqa: E402
+
+
+def _bng_available():
+    from pysb.pathfinder import get_path
+
+    try:
+        get_path('bng')
+    except Exception:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(not _bng_available(),
+                                reason='BioNetGen is not installed')
+
+SPEC = {
+    'model_name': 'toy',
+    'cell_lines': {
+        'wildtype': {'variant': 'base', 'dataset': 'toy', 'parameters': {}},
+    },
+    'inputs': {
+        'egf': {'parameter': 'EGF_0', 'unit': 'ng/ml'},
+        'meki': {'parameter': 'MEKi_0', 'unit': 'uM', 'placeholder': 'MEKi',
+                 'drug': 'Cobimetinib'},
+    },
+    'units': {},
+}
+
+
+def make_model():
+    """A -> B with rate constant kf, plus the registry's input parameters."""
+    model = Model(_export=False)
+    a = Monomer('A', _export=False)
+    b = Monomer('B', _export=False)
+    a_0 = Parameter('A_0', 1.0, _export=False)
+    kf = Parameter('kf', 0.1, _export=False)
+    for component in [a, b, a_0, kf,
+                      Parameter('EGF_0', 0.0, _export=False),
+                      Parameter('MEKi_0', 0.0, _export=False),
+                      Rule('convert', a() >> b(), kf, _export=False),
+                      Observable('B_obs', b(), _export=False)]:
+        model.add_component(component)
+    model.add_initial(Initial(a(), a_0, _export=False))
+    return model
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    """Registry whose parameter table estimates kf."""
+    store = ParameterStore(write_parameter_store(
+        str(tmp_path / 'toy.h5'), ['kf'], [[0.5]], [0]
+    ))
+    monkeypatch.setattr(registry_module, 'open_parameter_store',
+                        lambda *args: store)
+    return registry_module.ConditionRegistry(SPEC)
+
+
+def test_modification_overrides_parameter_table(registry):
+    condition = make_condition('wildtype', 0.0, 1.0)
+    base = make_model()
+    modified = apply_modifications(make_model(), {'kf': 0.05})
+    tspan = np.linspace(0, 20, 11)
+
+    trajectories = []
+    for model, kf in [(base, 0.5), (modified, 0.05)]:
+        compiled = registry.compile(model)
+        values = compiled.parameter_values(condition)
+        assert values[compiled.index['kf']] == kf
+        output = ScipyOdeSimulator(model, tspan, compiler='python').run(
+            param_values=values
+        )
+        trajectories.append(np.asarray(output.observables['B_obs']))
+
+    assert not np.allclose(trajectories[0], trajectories[1])
+    # the slower conversion of the modified instance lags behind
+    assert np.all(trajectories[1][1:] < trajectories[0][1:])
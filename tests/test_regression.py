@@ -0,0 +1,65 @@
+"""Regression tests against golden trajectories and performance budgets.
+
+Golden trajectories and budgets are created with tests/regression.py and
+committed with the tests, which are skipped where PySB is not installed.
+"""
+import os
+
+import pytest
+
+pytest.importorskip('pysb')
+
+import numpy as np  # noqa: E402
+
+import regression  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def golden():
+    if not os.path.exists(regression.GOLDEN_FILE):
+        pytest.fail('No golden trajectories, create them with '
+                    '"python tests/regression.py golden"')
+    golden = regression.load_golden()
+    assert str(golden['model_hash']) == regression.hash_model_source(
+        regression.MODEL_NAME, regression.MODEL_VARIANT
+    ), ('The model source changed since the golden trajectories were '
+        'made; regenerate them if the change is intended')
+    assert list(golden['cases']) == [c['name'] for c in regression.CASES]
+    assert list(golden['observables']) == regression.OBSERVABLES
+    return golden
+
+
+def _check_engine(engine, golden, rtol):
+    tspan, values = regression.simulate_observables(engine)
+    np.testing.assert_array_equal(tspan, golden['time'])
+    errors = regression.trajectory_errors(values, golden['values'], rtol)
+    failures = [
+        f'{case}/{observable}: {error:.3g}'
+        for case, row in zip(golden['cases'], errors)
+        for observable, error in zip(golden['observables'], row)
+        if not error <= 1
+    ]
+    assert not failures, (f'{engine} deviates from the golden trajectories '
+                          f'(in units of the allowed deviation): '
+                          f'{", ".join(failures)}')
+
+
+def test_reference_engine(golden):
+    _check_engine('reference', golden, regression.REFERENCE_RTOL)
+
+
+@pytest.mark.parametrize('engine', [e for e in regression.ENGINES
+                                    if e != 'reference'])
+def test_engine(engine, golden):
+    _check_engine(engine, golden, regression.ENGINE_RTOL)
+
+
+def test_phase_budgets():
+    if not os.path.exists(regression.BUDGETS_FILE):
+        pytest.skip('No budgets, record them with '
+                    '"python tests/regression.py budgets"')
+    budgets = regression.load_budgets()
+    # a cold run compiles the RHS, which is not what the budgets measure
+    regression.measure_phases()
+    exceeded = regression.check_budgets(regression.measure_phases(), budgets)
+    assert not exceeded, f'Performance budgets exceeded: {exceeded}'